@@ -3,11 +3,65 @@
 import os
 import sys
 import re
+import time
+import shutil
 import argparse
+import collections
 import configparser
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from subprocess import Popen, PIPE, call
 
-def sort_index(bam, samtools):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ConsensusCruncher'))
+from trace_helper import Tracer, start_trace, finish_trace, file_size, wait_child, run_child
+from shard_writer import MANIFEST, MANIFEST_DONE
+
+# Chromosome shards processed by downstream stages at the same time (--chrom-pipeline)
+SHARD_JOBS = 2
+# BAM outputs of a consensus run (--outputs): output directory and file name (<sample>.<name>.sorted.bam)
+OUTPUTS = collections.OrderedDict([('sscs', ('sscs', 'sscs')),
+                                   ('singleton', ('sscs', 'singleton')),
+                                   ('bad_reads', ('sscs', 'badReads')),
+                                   ('dcs', ('dcs', 'dcs')),
+                                   ('sscs_singleton', ('dcs', 'sscs.singleton')),
+                                   ('sscs_correction', ('sscs_sc', 'sscs.correction')),
+                                   ('singleton_correction', ('sscs_sc', 'singleton.correction')),
+                                   ('uncorrected', ('sscs_sc', 'uncorrected')),
+                                   ('sscs_sc', ('sscs_sc', 'sscs.sc')),
+                                   ('dcs_sc', ('dcs_sc', 'dcs.sc')),
+                                   ('sscs_sc_singleton', ('dcs_sc', 'sscs.sc.singleton')),
+                                   ('all_unique', ('dcs_sc', 'all.unique.dcs'))])
+# Outputs kept with --cleanup True
+CLEANUP_OUTPUTS = ['sscs', 'singleton', 'dcs', 'sscs_sc', 'dcs_sc', 'all_unique']
+
+
+def index_file(bam):
+    """
+    Return path to index of BAM (.bai) or CRAM (.crai) file.
+
+    :param bam: Path to BAM or CRAM file.
+    :type bam: str
+    :returns: Path to index.
+    """
+    return bam + ('.crai' if bam.endswith('.cram') else '.bai')
+
+
+def format_options(outfile, reference=None):
+    """
+    Return samtools options to write outfile (CRAM if it ends with .cram) and decode CRAM inputs against reference.
+
+    :param outfile: Path to output file.
+    :type outfile: str
+    :param reference: Path to reference genome (FASTA).
+    :type reference: str
+    :returns: samtools options (empty for BAM output without reference).
+    """
+    options = ' -O cram' if outfile.endswith('.cram') else ''
+    if reference is not None:
+        options += ' --reference {}'.format(reference)
+    return options
+
+
+def sort_index(bam, samtools, tracer=None, sorted_bam=None, level=None, reference=None):
     """
     Sort and index BAM file.
 
@@ -15,25 +69,653 @@ def sort_index(bam, samtools):
     :type bam: str
     :param samtools: Path to samtools.
     :type samtools: str
+    :param tracer: Trace event recorder for sort and index timings (optional).
+    :type tracer: Tracer
+    :param sorted_bam: Path to sorted BAM file (default: next to BAM file).
+    :type sorted_bam: str
+    :param level: Compression level of sorted BAM file (0: uncompressed, default: samtools default).
+    :type level: int
+    :param reference: Reference genome (FASTA) to write sorted CRAM file (sorted_bam ending with .cram).
+    :type reference: str
     :returns: Path to sorted BAM file.
     """
-    identifier = bam.split('.bam', 1)[0]
-    sorted_bam = '{}.sorted.bam'.format(identifier)
-
-    sam1 = Popen((samtools + ' view -bu ' + bam).split(' '), stdout=PIPE)
-    sam2 = Popen(
-        (samtools + ' sort -').split(' '),
-        stdin=sam1.stdout,
-        stdout=open(
-            sorted_bam,
-            'w'))
-    sam2.communicate()
+    if tracer is None:
+        tracer = Tracer()
+
+    if sorted_bam is None:
+        identifier = bam.split('.bam', 1)[0]
+        sorted_bam = '{}.sorted.bam'.format(identifier)
+    sort_cmd = samtools + ' sort' if level is None else '{} sort -l {}'.format(samtools, level)
+    sort_cmd += format_options(sorted_bam, reference) + ' -'
+
+    with tracer.span('sort {}'.format(os.path.basename(bam)), 'sort') as span:
+        sam1 = Popen((samtools + ' view -bu ' + bam).split(' '), stdout=PIPE)
+        with open(sorted_bam, 'w') as out:
+            sam2 = Popen(sort_cmd.split(' '), stdin=sam1.stdout, stdout=out)
+        sam1.stdout.close()
+        wait_child(sam2, span)
+        wait_child(sam1, span)
+        span['bytes'] = file_size(sorted_bam)
     os.remove(bam)
-    call("{} index {}".format(samtools, sorted_bam).split(' '))
+
+    with tracer.span('index {}'.format(os.path.basename(sorted_bam)), 'index') as span:
+        run_child("{} index {}".format(samtools, sorted_bam).split(' '), span)
+        span['bytes'] = file_size(index_file(sorted_bam))
 
     return sorted_bam
 
 
+def run_stage(cmd, name, tracer):
+    """
+    Run consensus stage script and record its wall/CPU time (CPU time of the stage and its children only, other stages
+    may run at the same time).
+
+    :param cmd: Command to run.
+    :type cmd: str
+    :param name: Stage name used in trace.
+    :type name: str
+    :param tracer: Trace event recorder.
+    :type tracer: Tracer
+    """
+    print(cmd)
+    with tracer.span(name, 'process') as span:
+        run_child(cmd, span, shell=True)
+
+
+def division_args(args):
+    """
+    Return command line options controlling how stage scripts divide BAM files into regions.
+
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :returns: Options to append to stage commands.
+    """
+    options = ''
+    if args.bedfile == 'auto' and args.region_reads is not None:
+        options += ' --region-reads {}'.format(args.region_reads)
+    # Targeted panels: only capture intervals are processed
+    if args.targets is not None:
+        options += ' --targets {}'.format(args.targets)
+    if args.regions is not None:
+        # Regions from config file are given as a whitespace separated string
+        regions = args.regions.split() if isinstance(args.regions, str) else args.regions
+        options += ' --regions {}'.format(' '.join(regions))
+    if args.padding is not None:
+        options += ' --padding {}'.format(args.padding)
+
+    return options
+
+
+def memory_args(args):
+    """
+    Return command line options bounding the memory used by stage scripts.
+
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :returns: Options to append to stage commands.
+    """
+    options = ''
+    if args.max_pending is not None:
+        options += ' --max-pending {}'.format(args.max_pending)
+    # Regions above budget are split before fetching
+    if args.max_region_reads is not None:
+        options += ' --max-region-reads {}'.format(args.max_region_reads)
+    if args.max_memory is not None:
+        options += ' --max-memory {}'.format(args.max_memory)
+
+    return options
+
+
+def io_args(args):
+    """
+    Return command line options for reading input and writing output of stage scripts.
+
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :returns: Options to append to stage commands.
+    """
+    options = ''
+    # Next region is fetched while the current one is collapsed
+    if args.prefetch == 'True':
+        options += ' --prefetch'
+    # Stage outputs are intermediates that are sorted afterwards, skip compressing them
+    options += ' --uncompressed'
+    # CRAM input (and sorted CRAM outputs read by later stages) are decoded against the reference
+    if args.reference is not None:
+        options += ' --reference {}'.format(args.reference)
+
+    return options
+
+
+def merge_bams(samtools, outfile, bams, tracer, level=None, reference=None):
+    """
+    Merge position-sorted BAM files with samtools and record merge timing. samtools merge streams a k-way merge of the
+    sorted inputs, so the merged file is sorted as well and only needs to be indexed.
+
+    :param samtools: Path to samtools.
+    :type samtools: str
+    :param outfile: Path to merged BAM file.
+    :type outfile: str
+    :param bams: Paths to BAM files to be merged.
+    :type bams: list
+    :param tracer: Trace event recorder.
+    :type tracer: Tracer
+    :param level: Compression level of merged BAM file (0: uncompressed, default: samtools default).
+    :type level: int
+    :param reference: Reference genome (FASTA) to read CRAM inputs and write CRAM outfile (ending with .cram).
+    :type reference: str
+    """
+    options = format_options(outfile, reference)
+    if level is not None:
+        options = ' -l {}'.format(level) + options
+    merge_cmd = "{} merge{} {} {}".format(samtools, options, outfile, ' '.join(bams))
+    print(merge_cmd)
+    with tracer.span('merge {}'.format(os.path.basename(outfile)), 'merge') as span:
+        run_child(merge_cmd.split(' '), span)
+        span['bytes'] = file_size(outfile)
+
+
+def index_bam(bam, samtools, tracer):
+    """
+    Index position-sorted BAM file.
+
+    :param bam: Path to sorted BAM file.
+    :type bam: str
+    :param samtools: Path to samtools.
+    :type samtools: str
+    :param tracer: Trace event recorder.
+    :type tracer: Tracer
+    :returns: Path to BAM file.
+    """
+    with tracer.span('index {}'.format(os.path.basename(bam)), 'index') as span:
+        run_child("{} index {}".format(samtools, bam).split(' '), span)
+        span['bytes'] = file_size(index_file(bam))
+
+    return bam
+
+
+def output_list(value):
+    """
+    Parse comma separated list of outputs (--outputs).
+
+    :param value: Comma separated outputs.
+    :type value: str
+    :returns: List of outputs.
+    """
+    outputs = value.split(',')
+    unknown = [output for output in outputs if output not in OUTPUTS]
+    if unknown:
+        raise argparse.ArgumentTypeError("unknown outputs: {} (choose from {})".format(
+            ', '.join(unknown), ', '.join(OUTPUTS)))
+    return outputs
+
+
+def output_plan(args):
+    """
+    Return outputs requested with --outputs (default: outputs kept by --cleanup True, otherwise all outputs) and
+    whether each output has to be produced, either because it is requested or because requested outputs are made
+    from it.
+
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :returns: (requested outputs, {output: produced})
+    """
+    if args.outputs is not None:
+        requested = set(args.outputs)
+    elif args.cleanup == 'True':
+        requested = set(CLEANUP_OUTPUTS)
+    else:
+        requested = set(OUTPUTS)
+
+    def needed(*outputs):
+        return bool(requested.intersection(outputs))
+
+    sc = args.scorrect != 'False'
+    produced = {'sscs': True,
+                'singleton': True,
+                'bad_reads': needed('bad_reads'),
+                'dcs': needed('dcs', 'sscs_singleton'),
+                'sscs_singleton': needed('sscs_singleton'),
+                # Singleton correction always writes both corrected files
+                'sscs_correction': sc and needed('sscs_correction', 'singleton_correction', 'uncorrected', 'sscs_sc',
+                                                 'dcs_sc', 'sscs_sc_singleton', 'all_unique'),
+                'singleton_correction': sc and needed('sscs_correction', 'singleton_correction', 'uncorrected',
+                                                      'sscs_sc', 'dcs_sc', 'sscs_sc_singleton', 'all_unique'),
+                'uncorrected': sc and needed('uncorrected', 'all_unique'),
+                'sscs_sc': sc and needed('sscs_sc'),
+                'dcs_sc': sc and needed('dcs_sc', 'sscs_sc_singleton', 'all_unique'),
+                'sscs_sc_singleton': sc and needed('sscs_sc_singleton', 'all_unique'),
+                'all_unique': sc and needed('all_unique')}
+
+    return requested, produced
+
+
+def output_bam(sample_dir, identifier, name, suffix='.sorted.bam'):
+    """
+    Return path to BAM file of output.
+
+    :param sample_dir: Sample output directory.
+    :type sample_dir: str
+    :param identifier: Sample name.
+    :type identifier: str
+    :param name: Output name (see OUTPUTS).
+    :type name: str
+    :param suffix: File suffix ('.bam' for unsorted output of stage).
+    :type suffix: str
+    :returns: Path to BAM file.
+    """
+    return '{}/{}/{}.{}{}'.format(sample_dir, OUTPUTS[name][0], identifier, OUTPUTS[name][1], suffix)
+
+
+def output_suffix(args, requested, name):
+    """
+    Return file suffix of sorted output. Requested outputs are written as CRAM with --cram True. SSCSs and singletons
+    are read together by singleton correction (SSCS file is found next to the singletons), so they share a format.
+
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :param requested: Requested outputs (see output_plan).
+    :type requested: set
+    :param name: Output name (see OUTPUTS).
+    :type name: str
+    :returns: '.sorted.cram' or '.sorted.bam'
+    """
+    kept = set(requested)
+    if kept.intersection(['sscs', 'singleton']):
+        kept.update(['sscs', 'singleton'])
+    return '.sorted.cram' if args.cram == 'True' and name in kept else '.sorted.bam'
+
+
+def output_level(args, requested, name):
+    """
+    Return compression level of sorted BAM file of output. Requested outputs are written at --compression level
+    (samtools default if None), outputs only needed to make them are intermediates written uncompressed.
+
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :param requested: Requested outputs (see output_plan).
+    :type requested: set
+    :param name: Output name (see OUTPUTS).
+    :type name: str
+    :returns: Compression level (0-9) or None
+    """
+    return args.compression if name in requested else 0
+
+
+def dcs_command(code_dir, infiles, outfile, args, trace_file, singletons=True):
+    """
+    Return DCS_maker command.
+
+    :param code_dir: ConsensusCruncher directory.
+    :type code_dir: str
+    :param infiles: Sorted and indexed SSCS BAM file(s), merged on the fly by DCS_maker (e.g. SSCS + corrected
+                    singletons).
+    :type infiles: list
+    :param outfile: DCS BAM file.
+    :type outfile: str
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :param trace_file: Trace event file.
+    :type trace_file: str
+    :param singletons: Write SSCSs without complementary strand (otherwise only counted).
+    :type singletons: bool
+    :returns: Command to run.
+    """
+    if args.bedfile == 'False':
+        dcs_cmd = "{}/ConsensusCruncher/DCS_maker.py --infile {} --outfile {}".format(
+            code_dir, ' '.join(infiles), outfile)
+    else:
+        dcs_cmd = "{}/ConsensusCruncher/DCS_maker.py --infile {} --outfile {} --bedfile {}".format(
+            code_dir, ' '.join(infiles), outfile, args.bedfile)
+    if not singletons:
+        dcs_cmd += " --discard singleton"
+
+    return dcs_cmd + division_args(args) + memory_args(args) + io_args(args) + " --trace {}".format(trace_file)
+
+
+def sc_command(code_dir, singleton, args, trace_file, stats_file, uncorrected=True):
+    """
+    Return singleton_correction command.
+
+    :param code_dir: ConsensusCruncher directory.
+    :type code_dir: str
+    :param singleton: Sorted singleton BAM file (SSCS BAM file is inferred from its name).
+    :type singleton: str
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :param trace_file: Trace event file.
+    :type trace_file: str
+    :param stats_file: Stats file of singleton correction.
+    :type stats_file: str
+    :param uncorrected: Write uncorrected singletons (otherwise only counted).
+    :type uncorrected: bool
+    :returns: Command to run.
+    """
+    if args.bedfile == 'False':
+        sc_cmd = "{}/ConsensusCruncher/singleton_correction.py --singleton {}".format(
+            code_dir, singleton)
+    else:
+        sc_cmd = "{}/ConsensusCruncher/singleton_correction.py --singleton {} --bedfile {}".format(
+            code_dir, singleton, args.bedfile)
+    if args.sscs_lookup is not None:
+        sc_cmd += " --sscs-lookup {}".format(args.sscs_lookup)
+    sc_cmd += " --stats {}".format(stats_file)
+    if not uncorrected:
+        sc_cmd += " --discard uncorrected"
+
+    return sc_cmd + division_args(args) + memory_args(args) + io_args(args) + " --trace {}".format(trace_file)
+
+
+def run_graph(stages, cores, tracer):
+    """
+    Run stages of a dependency graph. A stage starts once all stages it depends on are done, and independent stages
+    run concurrently as long as their cores fit into the core budget (a stage needing more cores than the budget runs
+    on its own).
+
+    :param stages: {stage name: (function, [names of stages it depends on], cores)} in order of priority. Functions are
+                   called with the results of finished stages by stage name.
+    :type stages: collections.OrderedDict
+    :param cores: Core budget.
+    :type cores: int
+    :param tracer: Trace event recorder.
+    :type tracer: Tracer
+    :returns: Result of the function of each stage by stage name.
+    """
+    results = {}
+    running = {}
+    waiting = list(stages)
+    used = 0
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        while waiting or running:
+            for name in list(waiting):
+                function, depends, stage_cores = stages[name]
+                if all(stage in results for stage in depends) and (used == 0 or used + stage_cores <= cores):
+                    waiting.remove(name)
+                    running[executor.submit(function, results)] = name
+                    used += stage_cores
+
+            if not running:
+                raise ValueError("Stages with unknown or circular dependencies: {}".format(', '.join(waiting)))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                used -= stages[name][2]
+                results[name] = future.result()
+                tracer.event('{} done'.format(name), 'graph', 'i', {'running': len(running), 'cores': used})
+
+    return results
+
+
+def concatenate(files, outfile):
+    """
+    Concatenate stats (or time tracker) files written by each stage into one file, and remove the stage files.
+
+    :param files: Stage files in stage order (missing files are skipped).
+    :type files: list
+    :param outfile: Merged file.
+    :type outfile: str
+    """
+    with open(outfile, 'w') as out:
+        for path in files:
+            if os.path.exists(path):
+                with open(path) as f:
+                    out.write(f.read())
+                os.remove(path)
+
+
+def combine_stats(stats_files):
+    """
+    Return summary statistics of shards combined into one summary per section. Counts are summed and percentage lines
+    ('% <label>') are recomputed as percentage of the first count of their section.
+
+    :param stats_files: Stats files of each shard.
+    :type stats_files: list
+    :returns: Combined summary statistics.
+    """
+    sections = collections.OrderedDict()
+    for stats_file in stats_files:
+        section = None
+        with open(stats_file) as f:
+            for line in f:
+                if line.startswith('#'):
+                    section = sections.setdefault(line.strip(), collections.OrderedDict())
+                elif ':' in line and section is not None:
+                    label, value = line.rsplit(':', 1)
+                    label = label.strip()
+                    if label.startswith('%'):
+                        section[label] = None
+                    else:
+                        section[label] = section.get(label, 0) + int(value)
+
+    summary = ''
+    for header, section in sections.items():
+        summary += header + '\n'
+        total = next((value for value in section.values() if value is not None), 0)
+        for label, value in section.items():
+            if value is None:
+                value = section.get(label[1:].strip(), 0) / total * 100 if total else 0
+            summary += '{}: {}\n'.format(label, value)
+
+    return summary
+
+
+def sealed_shards(manifest, process, poll=1):
+    """
+    Yield shards of a stage writing per-chromosome shards (see ConsensusCruncher/shard_writer.py) as soon as they are
+    sealed.
+
+    :param manifest: Shard manifest of the stage.
+    :type manifest: str
+    :param process: Running stage.
+    :type process: subprocess.Popen
+    :param poll: Seconds between checks of the manifest.
+    :type poll: int
+    :returns: Generator of (shard name, [BAM file of each output]).
+    """
+    seen = 0
+    while True:
+        # Check whether the stage exited without reaping it, so its CPU time can still be taken by wait_child
+        running = os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None
+        lines = []
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                # Complete lines only
+                lines = f.read().split('\n')[:-1]
+
+        for line in lines[seen:]:
+            if line == MANIFEST_DONE:
+                return
+            fields = line.split('\t')
+            yield fields[0], fields[1:]
+        seen = len(lines)
+
+        if not running:
+            raise RuntimeError("Stage exited (status {}) before sealing all shards of {}".format(
+                process.wait(), manifest))
+        time.sleep(poll)
+
+
+def shard_stages(args, produced, code_dir, work_dir, shard, sscs, singleton, trace_file, tracer):
+    """
+    Run DCS_maker (and singleton correction followed by DCS_maker on SSCS + SC) on the SSCS and singleton shards of a
+    chromosome. Shards are intermediates, written uncompressed to the work dir.
+
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :param produced: Outputs to produce (see output_plan).
+    :type produced: dict
+    :param code_dir: ConsensusCruncher directory.
+    :type code_dir: str
+    :param work_dir: Directory of intermediate files.
+    :type work_dir: str
+    :param shard: Shard name (chromosome).
+    :type shard: str
+    :param sscs: Unsorted SSCS shard.
+    :type sscs: str
+    :param singleton: Unsorted singleton shard.
+    :type singleton: str
+    :param trace_file: Trace event file.
+    :type trace_file: str
+    :param tracer: Trace event recorder.
+    :type tracer: Tracer
+    :returns: Sorted BAM file of shard for each produced output.
+    """
+    def shard_bam(name, stage_dir=None, suffix='.bam'):
+        return '{}/{}/shards/{}.{}{}'.format(work_dir, stage_dir or OUTPUTS[name][0], shard, OUTPUTS[name][1], suffix)
+
+    outputs = {'sscs': sort_index(sscs, args.samtools, tracer, level=0),
+               'singleton': sort_index(singleton, args.samtools, tracer, level=0)}
+
+    # DCS
+    if produced['dcs']:
+        dcs = shard_bam('dcs')
+        run_stage(dcs_command(code_dir, [outputs['sscs']], dcs, args, trace_file,
+                              singletons=produced['sscs_singleton']),
+                  'DCS_maker {}'.format(shard), tracer)
+        outputs['dcs'] = sort_index(dcs, args.samtools, tracer, level=0)
+        if produced['sscs_singleton']:
+            outputs['sscs_singleton'] = sort_index(shard_bam('sscs_singleton'), args.samtools, tracer, level=0)
+
+    if produced['sscs_correction']:
+        # Singleton correction (outputs are written next to the singleton shard)
+        run_stage(sc_command(code_dir, outputs['singleton'], args, trace_file,
+                             '{}/sscs_sc/shards/{}.stats.txt'.format(work_dir, shard),
+                             uncorrected=produced['uncorrected']),
+                  'singleton_correction {}'.format(shard), tracer)
+        for name in ['sscs_correction', 'singleton_correction', 'uncorrected']:
+            if produced[name]:
+                outputs[name] = sort_index(shard_bam(name, 'sscs'), args.samtools, tracer, level=0)
+        sscs_sc = [outputs['sscs'], outputs['sscs_correction'], outputs['singleton_correction']]
+
+        # SSCS + SC (inputs are sorted, so the merge is sorted)
+        if produced['sscs_sc']:
+            outputs['sscs_sc'] = shard_bam('sscs_sc', suffix='.sorted.bam')
+            merge_bams(args.samtools, outputs['sscs_sc'], sscs_sc, tracer, level=0)
+
+        # DCS + SC
+        if produced['dcs_sc']:
+            dcs_sc = shard_bam('dcs_sc')
+            run_stage(dcs_command(code_dir, sscs_sc, dcs_sc, args, trace_file,
+                                  singletons=produced['sscs_sc_singleton']),
+                      'DCS_maker (SC) {}'.format(shard), tracer)
+            outputs['dcs_sc'] = sort_index(dcs_sc, args.samtools, tracer, level=0)
+            if produced['sscs_sc_singleton']:
+                outputs['sscs_sc_singleton'] = sort_index(shard_bam('sscs_sc_singleton'), args.samtools, tracer,
+                                                          level=0)
+
+    return outputs
+
+
+def chromosome_pipeline(args, requested, produced, code_dir, sample_dir, work_dir, identifier, sscs_cmd, trace_file,
+                        tracer):
+    """
+    Run SSCS_maker writing per-chromosome shards and start DCS_maker (and singleton correction) on each chromosome as
+    soon as its shard is sealed, while SSCS_maker continues with the next chromosome. Shard outputs are merged into
+    the same files as a stage by stage run, stats and time trackers into the sample dir.
+
+    :param args: Consensus mode arguments.
+    :type args: argparse.Namespace
+    :param requested: Requested outputs (see output_plan).
+    :type requested: set
+    :param produced: Outputs to produce (see output_plan).
+    :type produced: dict
+    :param code_dir: ConsensusCruncher directory.
+    :type code_dir: str
+    :param sample_dir: Sample output directory.
+    :type sample_dir: str
+    :param work_dir: Directory of intermediate files (shards).
+    :type work_dir: str
+    :param identifier: Sample name.
+    :type identifier: str
+    :param sscs_cmd: SSCS_maker command.
+    :type sscs_cmd: str
+    :param trace_file: Trace event file.
+    :type trace_file: str
+    :param tracer: Trace event recorder.
+    :type tracer: Tracer
+    :returns: Merged sorted BAM file for each produced output.
+    """
+    stage_dirs = [stage_dir for stage_dir, output in [('sscs', 'sscs'), ('dcs', 'dcs'), ('sscs_sc', 'sscs_correction'),
+                                                      ('dcs_sc', 'dcs_sc')] if produced[output]]
+    for stage_dir in stage_dirs:
+        os.makedirs('{}/{}/shards'.format(work_dir, stage_dir), exist_ok=True)
+
+    shard_dir = '{}/sscs/shards'.format(work_dir)
+    sscs_cmd += " --shards {}".format(shard_dir)
+    print(sscs_cmd)
+
+    shards = []
+    jobs = []
+    with ThreadPoolExecutor(max_workers=args.shard_jobs or SHARD_JOBS) as executor:
+        with tracer.span('SSCS_maker', 'process') as span:
+            process = Popen(sscs_cmd, shell=True)
+            for shard, (sscs, singleton) in sealed_shards(os.path.join(shard_dir, MANIFEST), process):
+                shards.append(shard)
+                jobs.append(executor.submit(shard_stages, args, produced, code_dir, work_dir, shard, sscs, singleton,
+                                            trace_file, tracer))
+            wait_child(process, span)
+        shard_outputs = [job.result() for job in jobs]
+
+    # ===== Merge shards (sorted shards merge into a sorted file) =====
+    outputs = {}
+    for name in shard_outputs[0]:
+        outputs[name] = output_bam(work_dir, identifier, name, output_suffix(args, requested, name))
+        merge_bams(args.samtools, outputs[name], [shard_output[name] for shard_output in shard_outputs], tracer,
+                   output_level(args, requested, name), args.reference)
+        index_bam(outputs[name], args.samtools, tracer)
+
+    # ===== Combine stats and time tracker of shards (in stage order) into sample dir =====
+    sscs_stats = '{}/sscs/{}.stats.txt'.format(work_dir, identifier)
+    time_trackers = ['{}/sscs/{}.time_tracker.txt'.format(work_dir, identifier)]
+    summary = ''
+    for stage_dir in stage_dirs[1:]:
+        summary += combine_stats(['{}/{}/shards/{}.stats.txt'.format(work_dir, stage_dir, shard)
+                                  for shard in shards])
+        time_trackers += ['{}/{}/shards/{}.time_tracker.txt'.format(work_dir, stage_dir, shard) for shard in shards]
+
+    with open(sscs_stats) as f:
+        summary = f.read() + summary
+    with open('{}/{}.stats.txt'.format(sample_dir, identifier), 'w') as f:
+        f.write(summary)
+    os.remove(sscs_stats)
+    concatenate(time_trackers, '{}/{}.time_tracker.txt'.format(sample_dir, identifier))
+
+    for stage_dir in stage_dirs:
+        shutil.rmtree('{}/{}/shards'.format(work_dir, stage_dir))
+
+    return outputs
+
+
+def run_report(count_files, span=None):
+    """(list, dict) -> None
+    Format and plot raw count files with report.py (skipped if none of the files exist), adding its CPU time to span.
+    """
+    count_files = [f for f in count_files if os.path.exists(f)]
+    if count_files:
+        run_child(['{}/ConsensusCruncher/report.py'.format(code_dir), '--input'] + count_files, span)
+
+
+def report(args):
+    """
+    Create plots and formatted frequency tables from the raw count files of a project or sample directory
+    (tag family sizes from '*.read_families.txt' and barcode frequencies from '*_barcode_counts.txt').
+
+    Reports are made at the end of 'fastq2bam' and 'consensus' and can be regenerated with this mode (e.g. if plotting
+    libraries were not available on the compute node).
+    """
+    count_files = []
+    for root, dirs, files in os.walk(args.r_input):
+        for f in sorted(files):
+            if f.endswith('.read_families.txt') or f.endswith('_barcode_counts.txt'):
+                count_files.append(os.path.join(root, f))
+
+    if not count_files:
+        raise OSError("No read families or barcode count files found in: %s" % args.r_input)
+
+    run_report(count_files)
+
+
 def fastq2bam(args):
     """
     Extract molecular barcodes from paired-end sequencing reads using a barcode list,
@@ -86,6 +768,9 @@ def fastq2bam(args):
     print(extractb_cmd)
     os.system(extractb_cmd)
 
+    # Barcode frequency tables and histogram
+    run_report(['{}_barcode_counts.txt'.format(outfile)])
+
     # Create directories for bad barcodes and barcode distribution histograms
     if args.blist is not None:
         bad_barcode_dir = '{}/fastq_tag/bad_barcode'.format(args.output)
@@ -101,8 +786,11 @@ def fastq2bam(args):
               '{}/{}_r1_bad_barcodes.txt'.format(bad_barcode_dir, filename))
         os.rename('{}/{}_r2_bad_barcodes.txt'.format(fastq_dir, filename),
               '{}/{}_r2_bad_barcodes.txt'.format(bad_barcode_dir, filename))
-        os.rename('{}/{}_barcode_stats.png'.format(fastq_dir, filename),
-              '{}/{}_barcode_stats.png'.format(barcode_dist_dir, filename))
+        # Histogram is missing if the report failed (e.g. plotting libraries not available), alignment goes on without
+        # it and the report can be regenerated with 'report' mode
+        if os.path.exists('{}/{}_barcode_stats.png'.format(fastq_dir, filename)):
+            os.rename('{}/{}_barcode_stats.png'.format(fastq_dir, filename),
+                  '{}/{}_barcode_stats.png'.format(barcode_dist_dir, filename))
 
     #############
     # BWA Align #
@@ -141,8 +829,10 @@ def consensus(args):
 
     code_dir = os.path.dirname(os.path.realpath(__file__))
 
-    # Change bedfile if genome is hg38 or hg38_noAlt
-    if args.genome == 'hg38':
+    # Change bedfile if genome is hg38 or hg38_noAlt (regions planned from the BAM index are genome independent)
+    if args.bedfile == 'auto':
+        pass
+    elif args.genome == 'hg38':
         # Determine code directory and set bedfile to split data
         args.bedfile = '{}/ConsensusCruncher/hg38_cytoBand.txt'.format(
             code_dir)
@@ -153,19 +843,37 @@ def consensus(args):
             code_dir)
 
     # Create sample directory to hold consensus sequences
-    identifier = os.path.basename(args.bam).split('.bam', 1)[0]
+    identifier = re.split(r'\.(?:bam|cram)', os.path.basename(args.bam), 1)[0]
     sample_dir = '{}/{}'.format(args.c_output, identifier)
 
     # Check if dir exists and there's permission to write
     os.makedirs(sample_dir, exist_ok=True)
 
+    # Trace events of every stage, region, sort, index and merge (chrome://tracing / Perfetto format)
+    trace_file = '{}/{}.trace.json'.format(sample_dir, identifier)
+    start_trace(trace_file)
+    tracer = Tracer(trace_file, 'ConsensusCruncher')
+    consensus_span = tracer.begin(identifier, 'sample', children=True)
+
+    # Outputs to keep, and outputs to produce for them
+    requested, produced = output_plan(args)
+
+    # Intermediate files are written to scratch dir if provided (e.g. node-local disk or /dev/shm)
+    work_dir = sample_dir if args.scratch is None else '{}/{}'.format(args.scratch, identifier)
+
+    if args.reference is not None:
+        # Index reference once, instead of every stage process indexing it at the same time
+        if not os.path.exists(args.reference + '.fai'):
+            call([args.samtools, 'faidx', args.reference])
+        # Cache references htslib looks up by MD5 (CRAM input encoded against another copy of the reference)
+        os.environ.setdefault('REF_CACHE', '{}/.ref_cache/%2s/%2s/%s'.format(os.path.abspath(args.c_output)))
+
     ########
     # SSCS #
     ########
     # Set variables
-    os.makedirs(sample_dir + '/sscs')
-    sscs = '{}/sscs/{}.sscs.bam'.format(sample_dir, identifier)
-    sing = '{}/sscs/{}.singleton.bam'.format(sample_dir, identifier)
+    os.makedirs(work_dir + '/sscs', exist_ok=True)
+    sscs = '{}/sscs/{}.sscs.bam'.format(work_dir, identifier)
 
     # Run SSCS_maker
     if args.bedfile == 'False' and args.bdelim == '|':
@@ -180,170 +888,160 @@ def consensus(args):
     else:
         sscs_cmd = "{}/ConsensusCruncher/SSCS_maker.py --infile {} --outfile {} --cutoff {} --bedfile {} --bdelim {}".format(
             code_dir, args.bam, sscs, args.cutoff, args.bedfile, args.bdelim)
-
-    print(sscs_cmd)
-    os.system(sscs_cmd)
-
-    # Sort and index BAM files
-    sscs = sort_index(sscs, args.samtools)
-    sing = sort_index(sing, args.samtools)
-
-    #######
-    # DCS #
-    #######
-    # Set variables
-    os.makedirs(sample_dir + '/dcs')
-    dcs = '{}/dcs/{}.dcs.bam'.format(sample_dir, identifier)
-    sscs_sing = '{}/dcs/{}.sscs.singleton.bam'.format(sample_dir, identifier)
-
-    # Move stats and time tracker file to next dir
-    os.rename('{}/sscs/{}.stats.txt'.format(sample_dir, identifier),
-              '{}/dcs/{}.stats.txt'.format(sample_dir, identifier))
-    os.rename('{}/sscs/{}.time_tracker.txt'.format(sample_dir, identifier),
-              '{}/dcs/{}.time_tracker.txt'.format(sample_dir, identifier))
-
-    # Run DCS_maker
-    if args.bedfile == 'False':
-        dcs_cmd = "{}/ConsensusCruncher/DCS_maker.py --infile {} --outfile {}".format(
-            code_dir, sscs, dcs)
+    if args.umi_tag is not None:
+        sscs_cmd += " --umi-tag {}".format(args.umi_tag)
+    if args.max_family_size is not None:
+        sscs_cmd += " --max-family-size {}".format(args.max_family_size)
+    if args.processes is not None:
+        sscs_cmd += " --processes {}".format(args.processes)
+    if args.pipeline == 'True':
+        sscs_cmd += " --pipeline"
+    if args.batch_consensus == 'True':
+        sscs_cmd += " --batch-consensus"
+    if not produced['bad_reads']:
+        sscs_cmd += " --discard badReads"
+    sscs_cmd += division_args(args) + memory_args(args) + io_args(args) + " --trace {}".format(trace_file)
+
+    if args.chrom_pipeline == 'True':
+        # Downstream stages start on each chromosome as soon as SSCS_maker has moved on to the next one
+        files = chromosome_pipeline(args, requested, produced, code_dir, sample_dir, work_dir, identifier, sscs_cmd,
+                                    trace_file, tracer)
     else:
-        dcs_cmd = "{}/ConsensusCruncher/DCS_maker.py --infile {} --outfile {} --bedfile {}".format(
-            code_dir, sscs, dcs, args.bedfile)
-    print(dcs_cmd)
-    os.system(dcs_cmd)
-
-    # Sort and index BAM files
-    dcs = sort_index(dcs, args.samtools)
-    sscs_sing = sort_index(sscs_sing, args.samtools)
-
-    #############################
-    # Singleton Correction (SC) #
-    #############################
-    if args.scorrect != 'False':
-        os.makedirs(sample_dir + '/sscs_sc')
-        # Move stats and time tracker file to next dir
-        os.rename('{}/dcs/{}.stats.txt'.format(sample_dir, identifier),
-                  '{}/sscs/{}.stats.txt'.format(sample_dir, identifier))
-        os.rename('{}/dcs/{}.time_tracker.txt'.format(sample_dir, identifier),
-                  '{}/sscs/{}.time_tracker.txt'.format(sample_dir, identifier))
-
-        if args.bedfile == 'False':
-            sc_cmd = "{}/ConsensusCruncher/singleton_correction.py --singleton {}".format(
-                code_dir, sing)
-        else:
-            sc_cmd = "{}/ConsensusCruncher/singleton_correction.py --singleton {} --bedfile {}".format(
-                code_dir, sing, args.bedfile)
-        print(sc_cmd)
-        os.system(sc_cmd)
-
-        # Sort and index BAM files
-        sscs_cor = '{}/sscs_sc/{}.sscs.correction.bam'.format(
-            sample_dir, identifier)
-        os.rename(
-            '{}/sscs/{}.sscs.correction.bam'.format(sample_dir, identifier), sscs_cor)
-        sscs_cor = sort_index(sscs_cor, args.samtools)
-
-        sing_cor = '{}/sscs_sc/{}.singleton.correction.bam'.format(
-            sample_dir, identifier)
-        os.rename(
-            '{}/sscs/{}.singleton.correction.bam'.format(sample_dir, identifier), sing_cor)
-        sing_cor = sort_index(sing_cor, args.samtools)
-
-        uncorrected = '{}/sscs_sc/{}.uncorrected.bam'.format(
-            sample_dir, identifier)
-        os.rename('{}/sscs/{}.uncorrected.bam'.format(sample_dir,
-                                                      identifier), uncorrected)
-        uncorrected = sort_index(uncorrected, args.samtools)
-
-        #############
-        # SSCS + SC #
-        #############
-        # Merge corrected singletons with consensus sequences
-        sscs_sc = '{}/sscs_sc/{}.sscs.sc.bam'.format(sample_dir, identifier)
-        merge_sc = "{} merge {} {} {} {}".format(
-            args.samtools, sscs_sc, sscs, sscs_cor, sing_cor)
-        print(merge_sc)
-        call(merge_sc.split(' '))
-        sscs_sc = sort_index(sscs_sc, args.samtools)
-
-        ############
-        # DCS + SC #
-        ############
-        os.makedirs(sample_dir + '/dcs_sc')
-        dcs_sc = '{}/dcs_sc/{}.dcs.sc.bam'.format(sample_dir, identifier)
-        # Move stats and time tracker file to next dir
-        os.rename('{}/sscs/{}.stats.txt'.format(sample_dir, identifier),
-                  '{}/dcs_sc/{}.stats.txt'.format(sample_dir, identifier))
-        os.rename('{}/sscs/{}.time_tracker.txt'.format(sample_dir, identifier),
-                  '{}/dcs_sc/{}.time_tracker.txt'.format(sample_dir, identifier))
-
-        if args.bedfile == 'False':
-            dcs_sc_cmd = "{}/ConsensusCruncher/DCS_maker.py --infile {} --outfile {}".format(
-                code_dir, sscs_sc, dcs_sc)
-        else:
-            dcs_sc_cmd = "{}/ConsensusCruncher/DCS_maker.py --infile {} --outfile {} --bedfile {}".format(
-                code_dir, sscs_sc, dcs_sc, args.bedfile)
-        print(dcs_sc_cmd)
-        os.system(dcs_sc_cmd)
-
-        # Sort and index BAM files
-        dcs_sc = sort_index(dcs_sc, args.samtools)
-        sscs_sc_sing = '{}/dcs_sc/{}.sscs.sc.singleton.bam'.format(
-            sample_dir, identifier)
-        sscs_sc_sing = sort_index(sscs_sc_sing, args.samtools)
-
+        # Stages as a dependency graph, independent stages (e.g. DCS and singleton correction, sorting of SSCS and
+        # singletons) run concurrently within --cores. Each stage writes its own stats and time tracker file, which are
+        # merged once all stages are done. Only outputs that are requested (or needed for requested outputs) are
+        # written and sorted, stage outputs are sorted into the sample dir (requested) or work dir (intermediates).
+        stages = collections.OrderedDict()
+
+        def sort_stage(name, depends, stage_dir=None):
+            def sort(results):
+                bam = '{}/{}/{}.{}.bam'.format(work_dir, stage_dir or OUTPUTS[name][0], identifier, OUTPUTS[name][1])
+                sorted_bam = output_bam(work_dir, identifier, name, output_suffix(args, requested, name))
+                return sort_index(bam, args.samtools, tracer, sorted_bam, output_level(args, requested, name),
+                                  args.reference)
+            stages[name] = (sort, depends, 1)
+
+        stages['SSCS'] = (lambda results: run_stage(sscs_cmd, 'SSCS_maker', tracer), [], args.processes or 1)
+        sort_stage('sscs', ['SSCS'])
+        sort_stage('singleton', ['SSCS'])
+
+        #######
+        # DCS #
+        #######
+        if produced['dcs']:
+            os.makedirs(work_dir + '/dcs', exist_ok=True)
+
+            def dcs_stage(results):
+                run_stage(dcs_command(code_dir, [results['sscs']], output_bam(work_dir, identifier, 'dcs', '.bam'),
+                                      args, trace_file, singletons=produced['sscs_singleton']), 'DCS_maker', tracer)
+            stages['DCS'] = (dcs_stage, ['sscs'], 1)
+            sort_stage('dcs', ['DCS'])
+            if produced['sscs_singleton']:
+                sort_stage('sscs_singleton', ['DCS'])
+
+        #############################
+        # Singleton Correction (SC) #
+        #############################
+        if produced['sscs_correction']:
+            os.makedirs(work_dir + '/sscs_sc', exist_ok=True)
+
+            def sc_stage(results):
+                run_stage(sc_command(code_dir, results['singleton'], args, trace_file,
+                                     '{}/sscs_sc/{}.stats.txt'.format(work_dir, identifier),
+                                     uncorrected=produced['uncorrected']), 'singleton_correction', tracer)
+            stages['SC'] = (sc_stage, ['sscs', 'singleton'], 1)
+
+            # Sort and index BAM files (singleton correction writes its outputs next to the singletons)
+            for name in ['sscs_correction', 'singleton_correction', 'uncorrected']:
+                if produced[name]:
+                    sort_stage(name, ['SC'], 'sscs')
+            sc_inputs = ['sscs', 'sscs_correction', 'singleton_correction']
+
+            #############
+            # SSCS + SC #
+            #############
+            # Merge corrected singletons with consensus sequences (inputs are sorted, so the merge is sorted)
+            if produced['sscs_sc']:
+                def merge_sscs_sc(results):
+                    sscs_sc = output_bam(work_dir, identifier, 'sscs_sc', output_suffix(args, requested, 'sscs_sc'))
+                    merge_bams(args.samtools, sscs_sc, [results[x] for x in sc_inputs], tracer,
+                               output_level(args, requested, 'sscs_sc'), args.reference)
+                    return index_bam(sscs_sc, args.samtools, tracer)
+                stages['sscs_sc'] = (merge_sscs_sc, sc_inputs, 1)
+
+            ############
+            # DCS + SC #
+            ############
+            # DCS_maker merges SSCS and corrected singletons on the fly
+            if produced['dcs_sc']:
+                os.makedirs(work_dir + '/dcs_sc', exist_ok=True)
+
+                def dcs_sc_stage(results):
+                    run_stage(dcs_command(code_dir, [results[x] for x in sc_inputs],
+                                          output_bam(work_dir, identifier, 'dcs_sc', '.bam'), args, trace_file,
+                                          singletons=produced['sscs_sc_singleton']), 'DCS_maker (SC)', tracer)
+                stages['DCS + SC'] = (dcs_sc_stage, sc_inputs, 1)
+                sort_stage('dcs_sc', ['DCS + SC'])
+                if produced['sscs_sc_singleton']:
+                    sort_stage('sscs_sc_singleton', ['DCS + SC'])
+
+        results = run_graph(stages, args.cores or 1, tracer)
+        files = {name: results[name] for name in OUTPUTS if name in results}
+
+        # Merge stats and time tracker files of stages (in stage order of a sequential run)
+        stage_dirs = ['sscs', 'dcs', 'sscs_sc', 'dcs_sc']
+        concatenate(['{}/{}/{}.stats.txt'.format(work_dir, x, identifier) for x in stage_dirs],
+                    '{}/{}.stats.txt'.format(sample_dir, identifier))
+        concatenate(['{}/{}/{}.time_tracker.txt'.format(work_dir, x, identifier) for x in stage_dirs],
+                    '{}/{}.time_tracker.txt'.format(sample_dir, identifier))
+
+    if produced['bad_reads']:
+        files['bad_reads'] = output_bam(work_dir, identifier, 'bad_reads', '.bam')
+
+    if produced['all_unique']:
         ########################
         # All Unique Molecules #
         ########################
-        # Merge DCS_SC + SSCS_SC singletons + uncorrected singletons
-        all_unique = '{}/dcs_sc/{}.all.unique.dcs.bam'.format(
-            sample_dir, identifier)
-        merge_all_unique = "{} merge {} {} {} {}".format(
-            args.samtools, all_unique, dcs_sc, sscs_sc_sing, uncorrected).split(' ')
-        print(all_unique)
-        call(merge_all_unique)
-        all_unique = sort_index(all_unique, args.samtools)
-
-        # Move stats and time tracker file to sample_dir
-        os.rename('{}/dcs_sc/{}.stats.txt'.format(sample_dir, identifier),
-                  '{}/{}.stats.txt'.format(sample_dir, identifier))
-        os.rename('{}/dcs_sc/{}.time_tracker.txt'.format(sample_dir, identifier),
-                  '{}/{}.time_tracker.txt'.format(sample_dir, identifier))
-    else:
-        os.rename('{}/dcs/{}.stats.txt'.format(sample_dir, identifier),
-                  '{}/{}.stats.txt'.format(sample_dir, identifier))
-        os.rename('{}/dcs/{}.time_tracker.txt'.format(sample_dir, identifier),
-                  '{}/{}.time_tracker.txt'.format(sample_dir, identifier))
-
-    # Move stats and time tracker file to sample dir
-    os.rename('{}/sscs/{}_tag_fam_size.png'.format(sample_dir, identifier),
-              '{}/{}_tag_fam_size.png'.format(sample_dir, identifier))
-    os.rename('{}/sscs/{}.read_families.txt'.format(sample_dir, identifier),
-              '{}/{}.read_families.txt'.format(sample_dir, identifier))
+        # Merge DCS_SC + SSCS_SC singletons + uncorrected singletons (inputs are sorted, so the merge is sorted)
+        files['all_unique'] = output_bam(work_dir, identifier, 'all_unique',
+                                         output_suffix(args, requested, 'all_unique'))
+        merge_bams(args.samtools, files['all_unique'],
+                   [files['dcs_sc'], files['sscs_sc_singleton'], files['uncorrected']], tracer,
+                   output_level(args, requested, 'all_unique'), args.reference)
+        index_bam(files['all_unique'], args.samtools, tracer)
+
+    # Move read families file to sample dir and plot tag family size distribution
+    shutil.move('{}/sscs/{}.read_families.txt'.format(work_dir, identifier),
+                '{}/{}.read_families.txt'.format(sample_dir, identifier))
+    with tracer.span('report') as span:
+        run_report(['{}/{}.read_families.txt'.format(sample_dir, identifier)], span)
+
+    # Remove outputs that were only needed to make requested outputs
+    for name, bam in files.items():
+        if name not in requested:
+            os.remove(bam)
+            if os.path.exists(index_file(bam)):
+                os.remove(index_file(bam))
+
+    # Move requested outputs from scratch dir to sample dir
+    if work_dir != sample_dir:
+        for name in requested:
+            if name in files:
+                bam = '{}/{}'.format(sample_dir, os.path.relpath(files[name], work_dir))
+                os.makedirs(os.path.dirname(bam), exist_ok=True)
+                shutil.move(files[name], bam)
+                if os.path.exists(index_file(files[name])):
+                    shutil.move(index_file(files[name]), index_file(bam))
+                files[name] = bam
+        shutil.rmtree(work_dir)
 
     # Remove intermediate files
     if args.cleanup == 'True':
         os.remove('{}/{}.time_tracker.txt'.format(sample_dir, identifier))
-        os.remove('{}/sscs/{}.badReads.bam'.format(sample_dir, identifier))
-        # Remove SSCSs that could not be formed into DCSs
-        os.remove(sscs_sing)
-        os.remove(
-            '{}/dcs/{}.sscs.singleton.sorted.bam.bai'.format(sample_dir, identifier))
-        if args.scorrect != 'False':
-            # Remove singleton correction files and only keep merged files
-            os.remove(sing_cor)
-            os.remove(
-                '{}/sscs_sc/{}.singleton.correction.sorted.bam.bai'.format(sample_dir, identifier))
-            os.remove(sscs_cor)
-            os.remove(
-                '{}/sscs_sc/{}.sscs.correction.sorted.bam.bai'.format(sample_dir, identifier))
-            os.remove(uncorrected)
-            os.remove(
-                '{}/sscs_sc/{}.uncorrected.sorted.bam.bai'.format(sample_dir, identifier))
-            # Remove SSCS_SC that could not be formed into DCSs
-            os.remove(sscs_sc_sing)
-            os.remove(
-                '{}/dcs_sc/{}.sscs.sc.singleton.sorted.bam.bai'.format(sample_dir, identifier))
+
+    # Complete trace of the sample (open in chrome://tracing or https://ui.perfetto.dev)
+    tracer.end(consensus_span)
+    finish_trace(trace_file)
 
 
 if __name__ == '__main__':
@@ -373,10 +1071,13 @@ if __name__ == '__main__':
     mode_consensus_help = "Almalgamate duplicate reads in BAM files into single-strand consensus sequences (SSCS) and" \
                           " duplex consensus sequences (DCS). Single reads with complementary duplex strands can also" \
                           " be corrected with 'Singleton Correction'."
+    mode_report_help = "Plot tag family size and barcode distributions from raw count files written by 'fastq2bam' " \
+                       "and 'consensus'."
 
     # Add subparsers
     sub_a = sub.add_parser('fastq2bam', help=mode_fastq2bam_help)
     sub_b = sub.add_parser('consensus', help=mode_consensus_help)
+    sub_c = sub.add_parser('report', help=mode_report_help)
 
     # fastq2bam arg help messages
     fastq1_help = "FASTQ containing Read 1 of paired-end reads. [MANDATORY]"
@@ -398,7 +1099,9 @@ if __name__ == '__main__':
                   "(e.g. '|' in 'HWI-D00331:196:C900FANXX:7:1110:14056:43945|TTTT')"
 
     # Consensus arg help messages
-    bam_help = "Input BAM file with barcodes extracted into header."
+    umi_tag_help = "Aux tag holding barcodes (e.g. RX, '-' separating R1 and R2 barcodes), read instead of parsing " \
+                   "barcodes from read names (--bdelim), so BAMs with UMI tags don't need to be renamed first."
+    bam_help = "Input BAM file with barcodes extracted into header (or into an aux tag, see --umi-tag)."
     coutput_help = "Output directory, where a folder will be created for the BAM file and consensus sequences."
     scorrect_help = "Singleton correction, default: True."
     bedfile_help = "Bedfile, default: cytoBand.txt. WARNING: It is HIGHLY RECOMMENDED that you use the default " \
@@ -406,8 +1109,54 @@ if __name__ == '__main__':
                    "bedfile is needed for data segmentation (file can be formatted with the bed_separator.R tool). " \
                    "For small BAM files, you may choose to turn off data splitting with '-b False' and process " \
                    "everything all at once (Division of data is only required for large data sets to offload the " \
-                   "memory burden)."
+                   "memory burden). Use '-b auto' to plan regions of balanced read count from the BAM index " \
+                   "instead (works for any genome build)."
+    region_reads_help = "Approximate number of reads per region when regions are planned with '-b auto', " \
+                        "default: 500000."
+    targets_help = "Capture panel BED file. Only padded and merged target intervals are processed and reads outside " \
+                   "of the targets are passed straight through to badReads.bam (overrides -b)."
+    regions_help = "Regions to process (e.g. chr7:55241614-55241736), alternative to --targets."
+    padding_help = "Padding (bp) added to both sides of targets/regions, default: 250."
+    max_family_size_help = "Maximum number of reads used per consensus. Larger families (e.g. ultra-deep amplicon " \
+                           "hotspots) are downsampled by reservoir sampling, true family size is still reported."
+    sscs_lookup_help = "How singleton correction finds complementary SSCSs: 'region' loads all SSCSs of each region, " \
+                       "'index' only fetches SSCSs at the coordinates of singletons from the indexed SSCS BAM " \
+                       "(faster when singletons are sparse), default: region."
+    max_pending_help = "Maximum number of reads waiting for their mate kept in memory. Reads with distant mates (e.g. " \
+                       "translocations) are spilled to temporary BAM files and read back when the mate is reached, " \
+                       "default: no limit."
+    max_region_reads_help = "Maximum number of reads per region. Regions estimated (from the BAM index) to hold more " \
+                            "reads, e.g. hotspots, are split at positions that no read pair spans, default: no limit."
+    max_memory_help = "Approximate memory budget (MB) for the reads of a region, regions above budget are split " \
+                      "(see --max-region-reads), default: no limit."
+    processes_help = "Number of worker processes making SSCSs (families are passed to workers through shared " \
+                     "memory), default: 1."
+    pipeline_help = "Read, collapse and write SSCSs concurrently, handing families over as soon as they are " \
+                    "complete. Recommended without bedfile (-b False) or with few large regions, default: False."
+    batch_consensus_help = "Make SSCSs of many families at once in padded NumPy arrays (same result, faster for " \
+                           "typical small families), default: False."
+    prefetch_help = "Fetch and decode reads of the next region in a background thread while the current region is " \
+                    "collapsed (hides decompression and network storage latency), default: False."
+    chrom_pipeline_help = "Write SSCSs to per-chromosome shards and start DCS_maker (and singleton correction) on " \
+                          "each chromosome as soon as SSCS_maker has moved on, instead of after the whole genome. " \
+                          "Regions of a chromosome must be contiguous in the bedfile, default: False."
+    cores_help = "Core budget of stages running at the same time. Stages are run as a dependency graph, so " \
+                 "independent stages (e.g. DCS_maker and singleton correction, sorting of SSCSs and singletons) run " \
+                 "concurrently while their cores (SSCS_maker: --processes, others: 1) fit, default: 1 (one stage at " \
+                 "a time)."
+    shard_jobs_help = "Number of chromosome shards processed by downstream stages at the same time with " \
+                      "--chrom-pipeline, default: {}.".format(SHARD_JOBS)
     cleanup_help = "Remove intermediate files."
+    scratch_help = "Directory for intermediate files (e.g. node-local disk or /dev/shm), removed once the sample is " \
+                   "done. Kept outputs are moved to the output directory at the end, default: sample output directory."
+    compression_help = "Compression level (0-9) of BAM files kept in the output directory, intermediates are written " \
+                       "uncompressed, default: samtools default."
+    reference_help = "Reference genome (FASTA) CRAM files are read and written against. Input BAM may be a CRAM " \
+                     "file (decoded by every stage directly, no conversion to BAM)."
+    cram_help = "Write kept outputs as CRAM files (.sorted.cram, requires --reference), default: False."
+    outputs_help = "Comma separated BAM outputs to keep ({}). Stages only write and sort files that are kept or " \
+                   "needed to make kept files (others are only counted in stats), default: {} with --cleanup True, " \
+                   "otherwise all.".format(', '.join(OUTPUTS), ','.join(CLEANUP_OUTPUTS))
 
     # Determine code directory and set bedfile to split data
     code_dir = os.path.dirname(os.path.realpath(__file__))
@@ -432,7 +1181,29 @@ if __name__ == '__main__':
                     "bedfile": bedfile,
                     "cutoff": 0.7,
                     "bdelim": '|',
-                    "cleanup": cleanup_help}
+                    "umi_tag": None,
+                    "cleanup": cleanup_help,
+                    "region_reads": None,
+                    "targets": None,
+                    "regions": None,
+                    "padding": None,
+                    "max_family_size": None,
+                    "sscs_lookup": None,
+                    "max_pending": None,
+                    "max_region_reads": None,
+                    "max_memory": None,
+                    "processes": None,
+                    "pipeline": 'False',
+                    "prefetch": 'False',
+                    "batch_consensus": 'False',
+                    "chrom_pipeline": 'False',
+                    "shard_jobs": None,
+                    "cores": None,
+                    "outputs": None,
+                    "scratch": None,
+                    "compression": None,
+                    "reference": None,
+                    "cram": 'False'}
 
         config = configparser.ConfigParser()
         config.read(sub_args.config)
@@ -499,17 +1270,52 @@ if __name__ == '__main__':
             'hg38',
             'hg38_noAlt'])
     sub_b.add_argument('-b', '--bedfile', help=bedfile_help, type=str)
+    sub_b.add_argument(
+        '--region-reads',
+        metavar="READS",
+        dest='region_reads',
+        type=int,
+        help=region_reads_help)
+    sub_b.add_argument('--targets', metavar="BED", dest='targets', type=str, help=targets_help)
+    sub_b.add_argument('--regions', metavar="REGION", dest='regions', nargs='+', type=str, help=regions_help)
+    sub_b.add_argument('--padding', metavar="BP", dest='padding', type=int, help=padding_help)
     sub_b.add_argument(
         '--cutoff',
         type=float,
         help="Consensus cut-off, default: 0.7 (70%% of reads must have the "
         "same base to form a consensus).")
+    sub_b.add_argument(
+        '--max-family-size',
+        metavar="READS",
+        dest='max_family_size',
+        type=int,
+        help=max_family_size_help)
+    sub_b.add_argument('--max-region-reads', metavar="READS", dest='max_region_reads', type=int,
+                       help=max_region_reads_help)
+    sub_b.add_argument('--max-memory', metavar="MB", dest='max_memory', type=int, help=max_memory_help)
+    sub_b.add_argument('--max-pending', metavar="READS", dest='max_pending', type=int, help=max_pending_help)
+    sub_b.add_argument('--processes', metavar="N", dest='processes', type=int, help=processes_help)
+    sub_b.add_argument('--pipeline', choices=['True', 'False'], help=pipeline_help)
+    sub_b.add_argument('--batch-consensus', dest='batch_consensus', choices=['True', 'False'],
+                       help=batch_consensus_help)
+    sub_b.add_argument('--prefetch', choices=['True', 'False'], help=prefetch_help)
+    sub_b.add_argument('--chrom-pipeline', dest='chrom_pipeline', choices=['True', 'False'], help=chrom_pipeline_help)
+    sub_b.add_argument('--shard-jobs', metavar="N", dest='shard_jobs', type=int, help=shard_jobs_help)
+    sub_b.add_argument('--cores', metavar="N", dest='cores', type=int, help=cores_help)
+    sub_b.add_argument('--outputs', metavar="OUTPUTS", dest='outputs', type=output_list, help=outputs_help)
+    sub_b.add_argument('--scratch', metavar="DIR", dest='scratch', type=str, help=scratch_help)
+    sub_b.add_argument('--compression', metavar="LEVEL", dest='compression', type=int, choices=range(10),
+                       help=compression_help)
+    sub_b.add_argument('--reference', metavar="FASTA", dest='reference', type=str, help=reference_help)
+    sub_b.add_argument('--cram', choices=['True', 'False'], help=cram_help)
+    sub_b.add_argument('--sscs-lookup', dest='sscs_lookup', choices=['region', 'index'], help=sscs_lookup_help)
     sub_b.add_argument(
         '-d',
         '--bdelim',
         metavar="DELIMITER",
         type=str,
         help=bdelim_help)
+    sub_b.add_argument('--umi-tag', metavar="TAG", dest='umi_tag', type=str, help=umi_tag_help)
     sub_b.add_argument(
         '--cleanup',
         choices=[
@@ -518,6 +1324,12 @@ if __name__ == '__main__':
         help=cleanup_help)  # Make default
     sub_b.set_defaults(func=consensus)
 
+    # Report args
+    r_input_help = "Project or sample directory containing '*.read_families.txt' and/or '*_barcode_counts.txt' " \
+                   "files. [MANDATORY]"
+    sub_c.add_argument('-i', '--input', dest='r_input', metavar="DIR", type=str, help=r_input_help)
+    sub_c.set_defaults(func=report)
+
     # Parse args
     args = main_p.parse_args()
 
@@ -560,6 +1372,13 @@ if __name__ == '__main__':
             # Check if required arguments provided
             if args.bam is None or args.c_output is None or args.samtools is None:
                 sub_b.print_help()
+            elif args.cram == 'True' and args.reference is None:
+                sub_b.error("--cram True requires --reference.")
+            else:
+                args.func(args)
+        elif args.subparser_name == 'report':
+            if args.r_input is None:
+                sub_c.print_help()
             else:
                 args.func(args)
         else:
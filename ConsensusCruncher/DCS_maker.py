@@ -18,13 +18,27 @@
 # Python3 DCS_maker.py [--infile INFILE] [--outfile OUTFILE] [--bedfile BEDFILE]
 #
 # Arguments:
-# --infile INFILE     input BAM file
-# --outfile OUTFILE   output BAM file
+# --infile INFILE [INFILE ...]
+#                     input BAM (or CRAM) file(s). Several position-sorted files (e.g. SSCS + corrected singletons) are
+#                     read in position order through a k-way merge instead of being merged and re-sorted beforehand
+#                     ('--bedfile auto' regions are planned from the index of the first file)
+# --outfile OUTFILE   output BAM file (CRAM if it ends with ".cram", SSCS singletons follow its format)
+# --reference FASTA   Reference genome the CRAM files are read and written against
 # --bedfile BEDFILE   Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt -
 #                     See bed_separator.R for making your own bed file based on a target panel / specific coordinates)
+#                     Use 'auto' to plan regions of balanced read count from the BAM index (region_planner.py)
+# --region-reads N   Approximate number of reads per region for '--bedfile auto' (default: 500000)
+# --targets BED      Capture panel BED file, only padded and merged targets are processed (alternative: --regions)
+# --max-pending N     Spill reads waiting for distant mates to temporary BAM files above N pending reads
+# --max-region-reads N Split regions holding more reads (estimated from BAM index) at positions no pair spans
+# --max-memory MB     Memory budget for reads of a region, regions above budget are split
+# --prefetch          Fetch and decode the next region in a background thread while the current one is collapsed
+# --discard singleton Only count SSCS singletons instead of writing them to "sscs.singleton.bam"
+# --uncompressed      Write output BAM files uncompressed (intermediates that are sorted afterwards)
 #
 # Inputs:
-# 1. A position-sorted BAM file containing paired-end reads with SSCS consensus identifier in the header/query name
+# 1. Position-sorted BAM file(s) containing paired-end reads with SSCS consensus identifier in the header/query name
+#    (or in molecule aux tags ZB/Z1/Z2/ZS/ZF/ZM written by SSCS_maker.py, used when present)
 # 2. A BED file containing coordinates subdividing the entire ref genome for more manageable data processing
 #
 # Outputs:
@@ -32,6 +46,7 @@
 # 2. A SSCS singleton BAM file containing SSCSs without reads from the complementary strand - "sscs.singleton.bam"
 # 3. A text file containing summary statistics (Total SSCS reads, Unmmaped SSCS reads, Secondary/Supplementary SSCS
 #    reads, DCS reads, and SSCS singletons) - "stats.txt" (Stats pended to same stats file as SSCS)
+# 4. (Optional) Trace events for the stage and each genomic region appended to the --trace file
 #
 # Concepts:
 #    - Read family: reads that share the same molecular barcode, chr, and start
@@ -50,8 +65,13 @@ import array
 from random import randint
 from argparse import ArgumentParser
 import math
+import os
 
 from consensus_helper import *
+from trace_helper import Tracer, file_size
+from region_planner import *
+from pair_store import PairStore
+from pipeline import prefetch_regions, fetch_merged
 
 
 ###############################
@@ -73,11 +93,12 @@ def dcs_consensus_tag(tag, ds):
     >>> dcs_consensus_tag('TTTC_7_140477735_7_140477790_98M_98M_neg:3', 'TCTT_7_140477735_7_140477790_98M_98M_pos:2')
     'TCTT_TTTC_7_140477735_7_140477790_98M_98M:2_3'
     """
-    barcode = tag.split('_')[0]
-    duplex_barcode = ds.split('_')[0]
-    tag_coor = tag.split('_', 1)[1].rsplit('_', 1)[0]
-    tag_fam_size = tag.split(':')[1]
-    ds_fam_size = ds.split(':')[1]
+    barcode, _, tag_coor = tag.partition('_')
+    duplex_barcode = ds.partition('_')[0]
+    # Coordinates, cigar and strand (absolute insert size and family size removed)
+    tag_coor = tag_coor.rpartition('_')[0]
+    tag_fam_size = tag.rpartition(':')[2]
+    ds_fam_size = ds.rpartition(':')[2]
 
     # Order tag barcodes and family size based on strand (pos then negative)
     if 'pos' in tag:
@@ -96,6 +117,29 @@ def dcs_consensus_tag(tag, ds):
     return dcs_query_name
 
 
+def duplex_query_name(read, ds_read):
+    """(pysam.calignedsegment.AlignedSegment, pysam.calignedsegment.AlignedSegment) -> str
+    Return consensus tag for duplex reads (see dcs_consensus_tag), taken from their molecule aux tags (see family_tags)
+    instead of their query names when both reads have them.
+    """
+    if not (read.has_tag(MOLECULE_TAG) and ds_read.has_tag(MOLECULE_TAG)):
+        return dcs_consensus_tag(read.qname, ds_read.qname)
+
+    barcode = read.get_tag(BARCODE_TAG)
+    duplex_barcode = ds_read.get_tag(BARCODE_TAG)
+    strand = read.get_tag(STRAND_TAG)
+    # Coordinates, cigar and strand (barcode and absolute insert size removed from molecule id)
+    tag_coor = '{}_{}'.format(read.get_tag(MOLECULE_TAG)[len(barcode) + 1:].rpartition('_')[0], strand)
+    tag_fam_size = read.get_tag(FAMILY_SIZE_TAG)
+    ds_fam_size = ds_read.get_tag(FAMILY_SIZE_TAG)
+
+    # Order tag barcodes and family size based on strand (pos then negative)
+    if strand == 'pos':
+        return "{}_{}_{}:{}_{}".format(barcode, duplex_barcode, tag_coor, tag_fam_size, ds_fam_size)
+    else:
+        return "{}_{}_{}:{}_{}".format(duplex_barcode, barcode, tag_coor, ds_fam_size, tag_fam_size)
+
+
 def duplex_consensus(read1, read2):
     """(pysam.calignedsegment.AlignedSegment, pysam.calignedsegment.AlignedSegment) -> pysam.calignedsegment.AlignedSegment
 
@@ -134,7 +178,8 @@ def main():
         "--infile",
         action="store",
         dest="infile",
-        help="Input BAM file",
+        nargs='+',
+        help="Input BAM file(s), several position-sorted files are merged on the fly",
         required=True)
     parser.add_argument(
         "--outfile",
@@ -147,7 +192,93 @@ def main():
         action="store",
         dest="bedfile",
         help="Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt - \
-                        See bed_separator.R for making your own bed file based on a target panel/specific coordinates)",
+                        See bed_separator.R for making your own bed file based on a target panel/specific coordinates). \
+                        Use 'auto' to plan regions of balanced read count from the BAM index",
+        required=False)
+    parser.add_argument(
+        "--region-reads",
+        action="store",
+        dest="region_reads",
+        type=int,
+        default=REGION_READS,
+        help="Approximate number of reads per region when regions are planned with '--bedfile auto', default: {}".format(
+            REGION_READS),
+        required=False)
+    parser.add_argument(
+        "--targets",
+        action="store",
+        dest="targets",
+        help="Capture panel BED file, only (padded and merged) target intervals are processed",
+        required=False)
+    parser.add_argument(
+        "--regions",
+        action="store",
+        dest="regions",
+        nargs='+',
+        help="Regions to process (e.g. chr7:55241614-55241736), alternative to --targets",
+        required=False)
+    parser.add_argument(
+        "--padding",
+        action="store",
+        dest="padding",
+        type=int,
+        default=TARGET_PADDING,
+        help="Padding (bp) added to both sides of targets/regions, default: {}".format(TARGET_PADDING),
+        required=False)
+    parser.add_argument(
+        "--max-region-reads",
+        action="store",
+        dest="max_region_reads",
+        type=int,
+        help="Split regions estimated (from BAM index) to hold more reads than this at positions no read pair spans",
+        required=False)
+    parser.add_argument(
+        "--max-memory",
+        action="store",
+        dest="max_memory",
+        type=int,
+        help="Approximate memory budget (MB) for reads of a region, regions above budget are split",
+        required=False)
+    parser.add_argument(
+        "--max-pending",
+        action="store",
+        dest="max_pending",
+        type=int,
+        help="Maximum number of reads waiting for their mate kept in memory, reads with distant mates (e.g. "
+             "translocations) are spilled to temporary BAM files next to the output, default: no limit",
+        required=False)
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        dest="prefetch",
+        help="Fetch and decode reads of the next region in a background thread while the current region is collapsed",
+        required=False)
+    parser.add_argument(
+        "--uncompressed",
+        action="store_true",
+        dest="uncompressed",
+        help="Write output BAM files uncompressed (intermediates to be sorted)",
+        required=False)
+    parser.add_argument(
+        "--reference",
+        action="store",
+        dest="reference",
+        help="Reference genome (FASTA) to read and write CRAM files",
+        required=False)
+    parser.add_argument(
+        "--discard",
+        action="store",
+        dest="discard",
+        nargs='+',
+        choices=['singleton'],
+        default=[],
+        help="Outputs not written (reads are only counted)",
+        required=False)
+    parser.add_argument(
+        "--trace",
+        action="store",
+        dest="trace",
+        help="Trace event file to append stage and region timings to (chrome://tracing / Perfetto format)",
         required=False)
     args = parser.parse_args()
 
@@ -156,24 +287,32 @@ def main():
     ######################
     start_time = time.time()
     # ===== Initialize input and output bam files =====
-    args.infile = str(args.infile)
     args.outfile = str(args.outfile)
 
-    sscs_bam = pysam.AlignmentFile(args.infile, "rb")
-    dcs_bam = pysam.AlignmentFile(args.outfile, "wb", template=sscs_bam)
+    tracer = Tracer(args.trace, 'DCS_maker')
+
+    sscs_bams = [open_alignment(infile, "rb", args.reference) for infile in args.infile]
+    sscs_bam = sscs_bams[0]
+    mode = "wbu" if args.uncompressed else "wb"
+    dcs_bam = open_alignment(args.outfile, mode, args.reference, template=sscs_bam)
 
     if re.search('dcs\.sc', args.outfile) is not None:
-        sscs_singleton_bam = pysam.AlignmentFile(
-            '{}.sscs.sc.singleton.bam'.format(
-                args.outfile.split('.dcs.sc')[0]), "wb", template=sscs_bam)
+        sscs_singleton_file = '{}.sscs.sc.singleton{}'.format(
+            args.outfile.split('.dcs.sc')[0], alignment_suffix(args.outfile))
         dcs_header = "DCS - Singleton Correction"
         sc_header = " SC"
     else:
-        sscs_singleton_bam = pysam.AlignmentFile(
-            '{}.sscs.singleton.bam'.format(
-                args.outfile.split('.dcs')[0]), "wb", template=sscs_bam)
+        sscs_singleton_file = '{}.sscs.singleton{}'.format(
+            args.outfile.split('.dcs')[0], alignment_suffix(args.outfile))
         dcs_header = "DCS"
         sc_header = ""
+    if 'singleton' in args.discard:
+        sscs_singleton_bam = NullBam()
+    else:
+        sscs_singleton_bam = open_alignment(
+            sscs_singleton_file, mode, args.reference, template=sscs_bam)
+
+    stage_span = tracer.begin(dcs_header, children=True)
 
     stats = open('{}.stats.txt'.format(args.outfile.split('.dcs')[0]), 'a')
     time_tracker = open(
@@ -183,7 +322,7 @@ def main():
     # ===== Initialize dictionaries and counters=====
     read_dict = collections.OrderedDict()
     tag_dict = collections.defaultdict(int)
-    pair_dict = collections.defaultdict(list)
+    pair_dict = PairStore(sscs_bam, args.max_pending, os.path.dirname(os.path.abspath(args.outfile)))
     csn_pair_dict = collections.defaultdict(list)
 
     unmapped = 0
@@ -200,13 +339,14 @@ def main():
     #   SPLIT BY REGION   #
     #######################
     # ===== Determine data division coordinates =====
-    # division by bed file if provided
-    if args.bedfile is not None:
-        division_coor = bed_separator(args.bedfile)
-    else:
-        division_coor = [1]
+    # division by bed file (or regions planned from BAM index) if provided
+    division_coor = division_coordinates(args.infile[0], args.bedfile, args.region_reads,
+                                         targets=args.targets, regions=args.regions, padding=args.padding,
+                                         max_region_reads=region_budget(args.max_region_reads, args.max_memory),
+                                         reference=args.reference)
 
     # ===== Process data in chunks =====
+    prefetched = prefetch_regions(args.infile, division_coor, reference=args.reference) if args.prefetch else None
     for x in division_coor:
         if division_coor == [1]:
             read_chr = None
@@ -217,6 +357,9 @@ def main():
             read_start = division_coor[x][0]
             read_end = division_coor[x][1]
 
+        region_span = tracer.begin(str(x), 'region')
+        region_written = 0
+
         chr_data = read_bam(sscs_bam,
                             pair_dict=pair_dict,
                             read_dict=read_dict,
@@ -226,7 +369,9 @@ def main():
                             duplex=True,
                             read_chr=read_chr,
                             read_start=read_start,
-                            read_end=read_end
+                            read_end=read_end,
+                            reads=next(prefetched) if prefetched is not None else
+                            fetch_merged(sscs_bams, division_coor, x) if len(sscs_bams) > 1 else None
                             )
 
         read_dict = chr_data[0]
@@ -244,12 +389,12 @@ def main():
         # ===== Create consenus seq for reads =====
         for readPair in list(csn_pair_dict.keys()):
             for tag in csn_pair_dict[readPair]:
-                # Determine tag of duplex read
+                # Determine tag of duplex read (same molecule key, opposite strand bit)
                 ds = duplex_tag(tag)
 
                 # === Group duplex read pairs and create consensus ===
                 # Check presence of duplex pair
-                if ds not in duplex_dict.keys():
+                if ds not in duplex_dict:
                     if tag in tag_dict and ds in tag_dict:
                         duplex_count += 1
 
@@ -258,9 +403,9 @@ def main():
                             read_dict[tag][0], read_dict[ds][0])
 
                         # consensus duplex tag
-                        dcs_query_name = dcs_consensus_tag(
-                            read_dict[tag][0].qname,
-                            read_dict[ds][0].qname)  # New query name containing both barcodes
+                        dcs_query_name = duplex_query_name(
+                            read_dict[tag][0],
+                            read_dict[ds][0])  # New query name containing both barcodes
 
                         dcs_read = create_aligned_segment([read_dict[tag][0], read_dict[ds][0]], consensus_seq,
                                                           consensus_qual, dcs_query_name)
@@ -268,12 +413,16 @@ def main():
                         # add duplex tag to dictionary to prevent making a
                         # duplex for the same sequences twice
                         duplex_dict[tag] += 1
+                        # Complementary read is skipped when its tag comes up (tag in duplex_dict), remove it now
+                        del read_dict[ds]
 
                         dcs_bam.write(dcs_read)
+                        region_written += 1
 
                     else:
                         sscs_singleton_bam.write(read_dict[tag][0])
                         sscs_singletons += 1
+                        region_written += 1
 
                     # Remove read from dictionary after writing
                     del read_dict[tag]
@@ -281,6 +430,17 @@ def main():
             # Remove key from dictionary after writing
             del csn_pair_dict[readPair]
 
+        # === Clear bookkeeping of processed region ===
+        # Complementary SSCSs share coordinates and are paired within the same region, so tags written in this region
+        # are not needed later and memory stays flat regardless of genome size. Reads whose mates fall in a later
+        # region remain in pair_dict.
+        tag_dict.clear()
+        duplex_dict.clear()
+        read_dict.clear()
+        csn_pair_dict.clear()
+
+        tracer.end(region_span, reads=chr_data[4], written=region_written)
+
     ######################
     #       SUMMARY      #
     ######################
@@ -309,12 +469,15 @@ SSCS{} singletons: {} \n'''.format(
     time_tracker.write(str((time.time() - start_time) / 60) + '\n')
 
     # Close files
+    pair_dict.close()
     time_tracker.close()
     stats.close()
     dcs_bam.close()
     sscs_singleton_bam.close()
 
-    return duplex_dict
+    tracer.end(stage_span, reads=counter, bytes=file_size(args.outfile, sscs_singleton_file))
+
+    return duplex_count
 
 
 ###############################
@@ -1,11 +1,5 @@
 #!/usr/bin/env python3
 
-import os
-import matplotlib as mpl
-if os.environ.get('DISPLAY','') == '':
-     print('no display found. Using non-interactive Agg backend')
-     mpl.use('Agg')
-
 ###############################################################
 #
 #      Single Stranded Consensus Sequence (SSCS) Generator
@@ -33,10 +27,30 @@ if os.environ.get('DISPLAY','') == '':
 #                              Read 3: ACTGATACCT
 #                              Read 4: ACTGATACTT
 #                           The resulting SSCS is: ACTGATACNT
-# --infile INFILE     Input BAM file
-# --outfile OUTFILE   Output BAM file
+# --infile INFILE     Input BAM (or CRAM) file
+# --outfile OUTFILE   Output BAM file (CRAM if it ends with ".cram", other outputs follow its format)
+# --reference FASTA   Reference genome the CRAM files are read and written against
 # --bedfile BEDFILE   Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt -
 #                     See bed_separator.R for making your own bed file based on a target panel / specific coordinates)
+#                     Use 'auto' to plan regions of balanced read count from the BAM index (region_planner.py)
+# --region-reads N   Approximate number of reads per region for '--bedfile auto' (default: 500000)
+# --umi-tag TAG       Read barcodes from aux tag TAG (e.g. RX, "-" separating R1 and R2 barcodes) instead of the
+#                     read name (--bdelim)
+# --targets BED      Capture panel BED file, only padded and merged targets are processed (alternative: --regions)
+# --max-family-size N Reservoir sample at most N reads per family for consensus making (true family size is kept)
+# --max-pending N     Spill reads waiting for distant mates to temporary BAM files above N pending reads
+# --max-region-reads N Split regions holding more reads (estimated from BAM index) at positions no pair spans
+# --max-memory MB     Memory budget for reads of a region, regions above budget are split
+# --processes N       Make consensus sequences in N worker processes (families passed through shared memory)
+# --batch-consensus   Collapse families in padded NumPy arrays, many families at once (see batch_consensus.py)
+# --prefetch          Fetch and decode the next region in a background thread while the current one is collapsed
+# --discard badReads  Only count bad reads instead of writing them to "badReads.bam"
+# --uncompressed      Write SSCS and singleton BAM files uncompressed (intermediates that are sorted afterwards)
+# --shards DIR        Write SSCS and singleton reads to per-chromosome shards in DIR, listed in DIR/manifest.txt once
+#                     sealed (see shard_writer.py), so downstream stages can start before the whole genome is done
+# --pipeline          Read, collapse and write concurrently (reader thread -> consensus -> writer thread), handing
+#                     over families as soon as they are complete instead of once per region (see pipeline.py).
+#                     Recommended for runs without bedfile or with few large regions (e.g. amplicon panels)
 #
 # Inputs:
 # 1. A position-sorted BAM file containing paired-end reads with duplex barcode in the header
@@ -45,11 +59,17 @@ if os.environ.get('DISPLAY','') == '':
 # Outputs:
 # 1. A SSCS BAM file containing paired single stranded consensus sequences - "sscs.bam"
 # 2. A singleton BAM file containing single reads - "singleton.bam"
+#    (SSCSs and singletons carry their molecule identity as aux tags: ZB barcode, Z1/Z2 barcode halves, ZS strand,
+#    ZF family size and ZM molecule id shared by both strands, read by DCS_maker.py and singleton_correction.py instead
+#    of parsing query names)
 # 3. A bad read BAM file containing unpaired, unmapped, and multiple mapping reads - "badReads.bam"
+#    (with --targets/--regions, reads outside of the capture targets are passed straight through to this file)
 # 4. A text file containing summary statistics (Total reads, Unmmaped reads, Secondary/Supplementary reads, SSCS reads,
 #    and singletons) - "stats.txt"
-# 5. A tag family size distribution plot (x-axis: family size, y-axis: number of reads) - "tag_fam_size.png"
+# 5. A text file containing the tag family size distribution (family size, frequency) - "read_families.txt"
+#    (plotted to "tag_fam_size.png" by report.py)
 # 6. A text file tracking the time to complete each genomic region (based on bed file) - "time_tracker.txt"
+# 7. (Optional) Trace events for the stage and each genomic region appended to the --trace file
 #
 # Concepts:
 #    - Read family: reads that share the same molecular barcode, genome
@@ -68,16 +88,45 @@ import array
 from random import *
 from itertools import chain
 import argparse
-import matplotlib.pyplot as plt
-import math
+import os
 import time
 
 from consensus_helper import *
+from trace_helper import Tracer, file_size
+from region_planner import *
+from pair_store import PairStore
+from shm_transport import parallel_consensus
+from batch_consensus import batch_consensus_maker
+from pipeline import *
+from shard_writer import ShardWriter
+from multiprocessing import Pool
 
 
 ###############################
 #       Helper Functions      #
 ###############################
+def identical_consensus(readList, cutoff):
+    """(list, float) -> str, list
+    Return consensus sequence and quality score of reads with identical sequences and all bases >= Q30 (every
+    position agrees, so no per-position counting is needed), otherwise None.
+    """
+    sequence = readList[0].query_sequence
+    if len(sequence) != readList[0].infer_query_length() or 'N' in sequence or cutoff > 1:
+        return None
+
+    for read in readList[1:]:
+        if read.query_sequence != sequence:
+            return None
+    for read in readList:
+        if min(read.query_qualities) < 30:
+            return None
+
+    # Sum of two or more qualities >= Q30 always reaches the Q60 cap
+    if len(readList) > 1:
+        return sequence, [60] * len(sequence)
+    return sequence, list(readList[0].query_qualities)
+
+
 def consensus_maker(readList, cutoff):
     """(list, int) -> str, list, list
     Return consensus sequence and quality score.
@@ -97,6 +146,8 @@ def consensus_maker(readList, cutoff):
           most frequent base
         - If a majority can't be determined (i.e. a tie with 2 maximums), N will be assigned as these bases won't pass
           the proportion cut-off
+        - Families of identical reads with all bases >= Q30 take a fast path in collapse_families before reaching
+          consensus_maker (see identical_consensus)
     """
     # Initialize counters
     nuc_lst = ['A', 'C', 'G', 'T', 'N']
@@ -168,6 +219,135 @@ def consensus_maker(readList, cutoff):
     return consensus_read, quality_consensus
 
 
+def complete_families(csn_pair_dict, read_dict, tag_dict, family_qnames, scan_key=None):
+    """(dict, dict, dict, dict, tuple) -> list, list
+    Remove read families of complete pairs from dictionaries and return singleton reads (renamed to their unique query
+    name and tagged with molecule aux tags) and families [(query name, reads, molecule aux tags)] to collapse.
+
+    With scan_key ((reference id, start) of the last read grouped from a sorted scan), pairs with a read starting
+    after scan_key are left in the dictionaries as more reads of their families may follow.
+    """
+    singletons = []
+    families = []
+    for readPair in list(csn_pair_dict.keys()):
+        if len(csn_pair_dict[readPair]) == 2:
+            if scan_key is not None:
+                key = csn_pair_dict[readPair][0][0]
+                if max((key[1], key[2]), (key[3], key[4])) > scan_key:
+                    continue
+
+            for tag in csn_pair_dict[readPair]:
+                query_name = readPair + ':' + str(tag_dict[tag])
+                tags = family_tags(tag, read_dict[tag][0], readPair, tag_dict[tag])
+                # Check for singletons
+                if tag_dict[tag] == 1:
+                    # Assign singletons our unique query name
+                    read_dict[tag][0].query_name = query_name
+                    for aux_tag, value, value_type in tags:
+                        read_dict[tag][0].set_tag(aux_tag, value, value_type)
+                    singletons.append(read_dict[tag][0])
+                else:
+                    families.append((query_name, read_dict[tag], tags))
+
+                # Remove read from dictionary once handed over
+                del read_dict[tag]
+                family_qnames.pop(tag, None)
+
+            # Remove key from dictionary
+            del csn_pair_dict[readPair]
+
+    return singletons, families
+
+
+def collapse_families(families, cutoff, pool=None, processes=1, batch=False, stats=None):
+    """(list, float, Pool, int, bool, Counter) -> generator
+    Yield collapsed SSCS read of each family [(query name, reads, molecule aux tags)].
+
+    Families of identical reads are collapsed right away (see identical_consensus, counted as stats['identical']),
+    other families by pool workers (processes of pool) if given and by the NumPy batch kernel (batch_consensus_maker)
+    if batch.
+    """
+    consensus = [identical_consensus(reads, cutoff) for query_name, reads, tags in families]
+    family_reads = [reads for (query_name, reads, tags), SSCS in zip(families, consensus) if SSCS is None]
+    if stats is not None:
+        stats['identical'] += len(families) - len(family_reads)
+
+    if pool is not None:
+        general = parallel_consensus(pool, processes, batch_consensus_maker if batch else consensus_maker,
+                                     family_reads, (cutoff,), batch=batch)
+    elif batch:
+        general = iter(batch_consensus_maker(family_reads, cutoff))
+    else:
+        general = (consensus_maker(reads, cutoff) for reads in family_reads)
+
+    for (query_name, reads, tags), SSCS in zip(families, consensus):
+        if SSCS is None:
+            SSCS = next(general)
+        yield create_aligned_segment(reads, SSCS[0], SSCS[1], query_name, tags)
+
+
+def contig_batches(singletons, sscs_reads):
+    """(list, list) -> generator
+    Yield (singletons, SSCSs) of each contig of a batch of reads in reference order. Per-chromosome shards (see
+    shard_writer.py) are sealed once a read of another chromosome is written, so a batch spanning chromosomes (whole
+    genome scan without bedfile, pipeline windows) must be written contig by contig rather than output by output.
+    """
+    contigs = sorted({read.reference_id for read in chain(singletons, sscs_reads)})
+    if len(contigs) <= 1:
+        yield singletons, sscs_reads
+        return
+
+    for contig in contigs:
+        yield ([read for read in singletons if read.reference_id == contig],
+               [read for read in sscs_reads if read.reference_id == contig])
+
+
+def grouped_families(bamfile, division_coor, read_dict, tag_dict, pair_dict, csn_pair_dict, family_qnames,
+                     badRead_bam, args, counts, tracer, time_tracker, start_time):
+    """(pysam.AlignmentFile, dict, dict, dict, dict, dict, dict, pysam.AlignmentFile, Namespace, Counter, Tracer, file,
+    float) -> generator
+    Yield (singletons, families) of complete pairs (see complete_families) while grouping reads of each region in
+    windows of WINDOW_READS reads (reader stage of --pipeline). Read counters are added to counts.
+    """
+    for x in division_coor:
+        read_chr = None if division_coor == [1] else x.rsplit('_', 1)[0]
+        reads = fetch_region(bamfile, division_coor, x)
+
+        region_span = tracer.begin(str(x), 'region')
+        region_reads = 0
+
+        for window in windows(reads, WINDOW_READS):
+            chr_data = read_bam(bamfile,
+                                read_dict=read_dict,
+                                tag_dict=tag_dict,
+                                pair_dict=pair_dict,
+                                csn_pair_dict=csn_pair_dict,
+                                badRead_bam=badRead_bam,
+                                duplex=None,
+                                barcode_delim=args.bdelim,
+                                umi_tag=args.umi_tag,
+                                max_family_size=args.max_family_size,
+                                family_qnames=family_qnames,
+                                read_end=None if read_chr is None else division_coor[x][1],
+                                reads=window)
+            counts['counter'] += chr_data[4]
+            counts['unmapped'] += chr_data[5]
+            counts['multiple_mapping'] += chr_data[6]
+            counts['bad_spacer'] += chr_data[7]
+            region_reads += chr_data[4]
+
+            yield complete_families(csn_pair_dict, read_dict, tag_dict, family_qnames,
+                                    (window[-1].reference_id, window[-1].reference_start))
+
+        # Remaining pairs of region
+        yield complete_families(csn_pair_dict, read_dict, tag_dict, family_qnames)
+
+        tracer.end(region_span, reads=region_reads)
+        if read_chr is not None:
+            time_tracker.write(x + ': ')
+            time_tracker.write(str((time.time() - start_time) / 60) + '\n')
+
+
 # Improve readability of argument help documentation
 class SmartFormatter(argparse.HelpFormatter):
 
@@ -216,27 +396,174 @@ def main():
         dest="bdelim",
         default="|",
         help="Delimiter to differentiate barcodes from read name, default: '|'")
+    parser.add_argument(
+        "--umi-tag",
+        action="store",
+        dest="umi_tag",
+        help="Aux tag holding barcodes (e.g. RX), read instead of parsing barcodes from read names (--bdelim)",
+        required=False)
     parser.add_argument(
         "--bedfile",
         action="store",
         dest="bedfile",
         help="Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt - \
-                        See bed_separator.R for making your own bed file based on a target panel/specific coordinates)",
+                        See bed_separator.R for making your own bed file based on a target panel/specific coordinates). \
+                        Use 'auto' to plan regions of balanced read count from the BAM index",
+        required=False)
+    parser.add_argument(
+        "--region-reads",
+        action="store",
+        dest="region_reads",
+        type=int,
+        default=REGION_READS,
+        help="Approximate number of reads per region when regions are planned with '--bedfile auto', default: {}".format(
+            REGION_READS),
+        required=False)
+    parser.add_argument(
+        "--targets",
+        action="store",
+        dest="targets",
+        help="Capture panel BED file, only (padded and merged) target intervals are processed",
+        required=False)
+    parser.add_argument(
+        "--regions",
+        action="store",
+        dest="regions",
+        nargs='+',
+        help="Regions to process (e.g. chr7:55241614-55241736), alternative to --targets",
+        required=False)
+    parser.add_argument(
+        "--padding",
+        action="store",
+        dest="padding",
+        type=int,
+        default=TARGET_PADDING,
+        help="Padding (bp) added to both sides of targets/regions, default: {}".format(TARGET_PADDING),
+        required=False)
+    parser.add_argument(
+        "--max-family-size",
+        action="store",
+        dest="max_family_size",
+        type=int,
+        help="Maximum number of reads used to make a consensus, larger families are downsampled by reservoir sampling "
+             "(true family size is kept in query name and read_families.txt), default: no limit",
+        required=False)
+    parser.add_argument(
+        "--max-region-reads",
+        action="store",
+        dest="max_region_reads",
+        type=int,
+        help="Split regions estimated (from BAM index) to hold more reads than this at positions no read pair spans",
+        required=False)
+    parser.add_argument(
+        "--max-memory",
+        action="store",
+        dest="max_memory",
+        type=int,
+        help="Approximate memory budget (MB) for reads of a region, regions above budget are split",
+        required=False)
+    parser.add_argument(
+        "--max-pending",
+        action="store",
+        dest="max_pending",
+        type=int,
+        help="Maximum number of reads waiting for their mate kept in memory, reads with distant mates (e.g. "
+             "translocations) are spilled to temporary BAM files next to the output, default: no limit",
+        required=False)
+    parser.add_argument(
+        "--processes",
+        action="store",
+        dest="processes",
+        type=int,
+        default=1,
+        help="Number of worker processes making consensus sequences, default: 1",
+        required=False)
+    parser.add_argument(
+        "--batch-consensus",
+        action="store_true",
+        dest="batch_consensus",
+        help="Collapse families of a region in a few NumPy array operations (same result, faster for many small "
+             "families)",
+        required=False)
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        dest="pipeline",
+        help="Read, collapse and write concurrently, handing over families as soon as they are complete (recommended "
+             "without bedfile or with few large regions, reads are always fetched ahead so --prefetch is not needed)",
+        required=False)
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        dest="prefetch",
+        help="Fetch and decode reads of the next region in a background thread while the current region is collapsed",
+        required=False)
+    parser.add_argument(
+        "--shards",
+        action="store",
+        dest="shards",
+        help="Write SSCS and singleton reads to per-chromosome BAM shards in this directory instead of --outfile, "
+             "sealed shards are listed in manifest.txt as soon as the scan moves on (see shard_writer.py)",
+        required=False)
+    parser.add_argument(
+        "--uncompressed",
+        action="store_true",
+        dest="uncompressed",
+        help="Write SSCS and singleton BAM files uncompressed (intermediates to be sorted)",
+        required=False)
+    parser.add_argument(
+        "--reference",
+        action="store",
+        dest="reference",
+        help="Reference genome (FASTA) to read and write CRAM files",
+        required=False)
+    parser.add_argument(
+        "--discard",
+        action="store",
+        dest="discard",
+        nargs='+',
+        choices=['badReads'],
+        default=[],
+        help="Outputs not written (reads are only counted)",
+        required=False)
+    parser.add_argument(
+        "--trace",
+        action="store",
+        dest="trace",
+        help="Trace event file to append stage and region timings to (chrome://tracing / Perfetto format)",
         required=False)
     args = parser.parse_args()
 
+    if args.max_family_size is not None and args.max_family_size < 1:
+        parser.error("--max-family-size must be at least 1")
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+
     ######################
     #       SETUP        #
     ######################
     start_time = time.time()
+    tracer = Tracer(args.trace, 'SSCS_maker')
+    stage_span = tracer.begin('SSCS', children=True)
     # ===== Initialize input and output bam files =====
-    bamfile = pysam.AlignmentFile(args.infile, "rb")
-    SSCS_bam = pysam.AlignmentFile(args.outfile, "wb", template=bamfile)
+    bamfile = open_alignment(args.infile, "rb", args.reference)
     stats = open('{}.stats.txt'.format(args.outfile.split('.sscs')[0]), 'w')
-    singleton_bam = pysam.AlignmentFile('{}.singleton.bam'.format(
-        args.outfile.split('.sscs')[0]), "wb", template=bamfile)
-    badRead_bam = pysam.AlignmentFile('{}.badReads.bam'.format(
-        args.outfile.split('.sscs')[0]), "wb", template=bamfile)
+    mode = "wbu" if args.uncompressed else "wb"
+    suffix = alignment_suffix(args.outfile)
+    if args.shards is None:
+        SSCS_bam = open_alignment(args.outfile, mode, args.reference, template=bamfile)
+        singleton_bam = open_alignment('{}.singleton{}'.format(
+            args.outfile.split('.sscs')[0], suffix), mode, args.reference, template=bamfile)
+    else:
+        # Per-chromosome shards, sealed as soon as the scan moves on to the next chromosome
+        shards = ShardWriter(args.shards, bamfile, ['sscs', 'singleton'], mode)
+        SSCS_bam = shards.output('sscs')
+        singleton_bam = shards.output('singleton')
+    if 'badReads' in args.discard:
+        badRead_bam = NullBam()
+    else:
+        badRead_bam = open_alignment('{}.badReads{}'.format(
+            args.outfile.split('.sscs')[0], suffix), "wb", args.reference, template=bamfile)
 
     # set up time tracker
     time_tracker = open(
@@ -246,8 +573,14 @@ def main():
     # ===== Initialize dictionaries =====
     read_dict = collections.OrderedDict()
     tag_dict = collections.defaultdict(int)
-    pair_dict = collections.defaultdict(list)
+    pair_dict = PairStore(bamfile, args.max_pending, os.path.dirname(os.path.abspath(args.outfile)))
     csn_pair_dict = collections.defaultdict(list)
+    family_qnames = collections.defaultdict(set)
+
+    consensus_stats = collections.Counter()  # Families collapsed by fast path
+
+    # ===== Initialize consensus workers =====
+    pool = Pool(args.processes) if args.processes > 1 else None
 
     # ===== Initialize counters =====
     unmapped = 0
@@ -261,89 +594,132 @@ def main():
     #   SPLIT BY REGION   #
     #######################
     # ===== Determine data division coordinates =====
-    # division by bed file if provided
-    if args.bedfile is not None:
-        division_coor = bed_separator(args.bedfile)
+    # division by bed file (or regions planned from BAM index) if provided
+    division_coor = division_coordinates(args.infile, args.bedfile, args.region_reads,
+                                         targets=args.targets, regions=args.regions, padding=args.padding,
+                                         max_region_reads=region_budget(args.max_region_reads, args.max_memory),
+                                         reference=args.reference)
+
+    if args.pipeline:
+        # ===== Reader thread -> consensus -> writer thread =====
+        counts = collections.Counter()
+        writer = Writer()
+        for singles, families in threaded(grouped_families(bamfile, division_coor, read_dict, tag_dict, pair_dict,
+                                                           csn_pair_dict, family_qnames, badRead_bam, args, counts,
+                                                           tracer, time_tracker, start_time)):
+            sscs_reads = list(collapse_families(families, float(args.cutoff), pool, args.processes,
+                                                args.batch_consensus, consensus_stats))
+            for contig_singles, contig_sscs in contig_batches(singles, sscs_reads):
+                writer.write(singleton_bam, contig_singles)
+                writer.write(SSCS_bam, contig_sscs)
+            singletons += len(singles)
+            SSCS_reads += len(families)
+        writer.close()
+
+        counter += counts['counter']
+        unmapped += counts['unmapped']
+        multiple_mapping += counts['multiple_mapping']
+        bad_spacer += counts['bad_spacer']
     else:
-        division_coor = [1]
+        # ===== Process data in chunks =====
+        region = 0
+        prefetched = prefetch_regions(args.infile, division_coor, reference=args.reference) if args.prefetch else None
+        for x in division_coor:
+            if division_coor == [1]:
+                read_chr = None
+                read_start = None
+                read_end = None
+            else:
+                read_chr = x.rsplit('_', 1)[0]
+                read_start = division_coor[x][0]
+                read_end = division_coor[x][1]
+
+            region_span = tracer.begin(str(x), 'region')
+
+            # === Construct dictionaries for consensus making ===
+            chr_data = read_bam(bamfile,
+                                read_dict=read_dict,
+                                tag_dict=tag_dict,
+                                pair_dict=pair_dict,
+                                csn_pair_dict=csn_pair_dict,
+                                badRead_bam=badRead_bam,
+                                duplex=None,
+                                # this indicates bamfile is not for making DCS
+                                # (thus headers are diff)
+                                read_chr=read_chr,
+                                read_start=read_start,
+                                read_end=read_end,
+                                barcode_delim=args.bdelim,
+                                umi_tag=args.umi_tag,
+                                max_family_size=args.max_family_size,
+                                family_qnames=family_qnames,
+                                reads=None if prefetched is None else next(prefetched))
+
+            # Set dicts and update counters
+            read_dict = chr_data[0]
+            tag_dict = chr_data[1]
+            pair_dict = chr_data[2]
+            csn_pair_dict = chr_data[3]
+
+            counter += chr_data[4]
+            unmapped += chr_data[5]
+            multiple_mapping += chr_data[6]
+            bad_spacer += chr_data[7]
+
+            ######################
+            #     CONSENSUS      #
+            ######################
+            # ===== Create consensus sequences for paired reads =====
+            singles, families = complete_families(csn_pair_dict, read_dict, tag_dict, family_qnames)
+            singletons += len(singles)
+
+            # Create collapsed SSCSs
+            sscs_reads = collapse_families(families, float(args.cutoff), pool, args.processes, args.batch_consensus,
+                                           consensus_stats)
+            if args.shards is not None:
+                # Region may span chromosomes (no bedfile), write contig by contig so shards are sealed in order
+                batches = contig_batches(singles, list(sscs_reads))
+            else:
+                batches = [(singles, sscs_reads)]
+            for contig_singles, contig_sscs in batches:
+                for read in contig_singles:
+                    singleton_bam.write(read)
+                for SSCS_read in contig_sscs:
+                    SSCS_bam.write(SSCS_read)
+            SSCS_reads += len(families)
+            region_written = len(singles) + len(families)
+            del families
+
+            tracer.end(region_span, reads=chr_data[4], written=region_written)
 
-    # ===== Process data in chunks =====
-    region = 0
-    for x in division_coor:
-        if division_coor == [1]:
-            read_chr = None
-            read_start = None
-            read_end = None
-        else:
-            read_chr = x.rsplit('_', 1)[0]
-            read_start = division_coor[x][0]
-            read_end = division_coor[x][1]
-
-        # === Construct dictionaries for consensus making ===
-        chr_data = read_bam(bamfile,
-                            read_dict=read_dict,
-                            tag_dict=tag_dict,
-                            pair_dict=pair_dict,
-                            csn_pair_dict=csn_pair_dict,
-                            badRead_bam=badRead_bam,
-                            duplex=None,
-                            # this indicates bamfile is not for making DCS
-                            # (thus headers are diff)
-                            read_chr=read_chr,
-                            read_start=read_start,
-                            read_end=read_end,
-                            barcode_delim=args.bdelim)
-
-        # Set dicts and update counters
-        read_dict = chr_data[0]
-        tag_dict = chr_data[1]
-        pair_dict = chr_data[2]
-        csn_pair_dict = chr_data[3]
-
-        counter += chr_data[4]
-        unmapped += chr_data[5]
-        multiple_mapping += chr_data[6]
-        bad_spacer += chr_data[7]
-
-        ######################
-        #     CONSENSUS      #
-        ######################
-        # ===== Create consensus sequences for paired reads =====
-        for readPair in list(csn_pair_dict.keys()):
-            if len(csn_pair_dict[readPair]) == 2:
-                for tag in csn_pair_dict[readPair]:
-                    # Check for singletons
-                    if tag_dict[tag] == 1:
-                        singletons += 1
-                        # Assign singletons our unique query name
-                        read_dict[tag][0].query_name = readPair + \
-                            ':' + str(tag_dict[tag])
-                        singleton_bam.write(read_dict[tag][0])
-                    else:
-                        # Create collapsed SSCSs
-                        SSCS = consensus_maker(
-                            read_dict[tag], float(args.cutoff))
-
-                        query_name = readPair + ':' + str(tag_dict[tag])
-                        SSCS_read = create_aligned_segment(
-                            read_dict[tag], SSCS[0], SSCS[1], query_name)
-
-                        # Write consensus bam
-                        SSCS_bam.write(SSCS_read)
-                        SSCS_reads += 1
-
-                    # Remove read from dictionary after writing
-                    del read_dict[tag]
-
-                # Remove key from dictionary after writing
-                del csn_pair_dict[readPair]
-
-        try:
-            time_tracker.write(x + ': ')
-            time_tracker.write(str((time.time() - start_time) / 60) + '\n')
-        except BaseException:
-            # When no genomic coordinates (x) provided for data division
-            continue
+            try:
+                time_tracker.write(x + ': ')
+                time_tracker.write(str((time.time() - start_time) / 60) + '\n')
+            except BaseException:
+                # When no genomic coordinates (x) provided for data division
+                continue
+
+    # ===== Seal remaining shards =====
+    if args.shards is not None:
+        shards.close()
+
+    #######################
+    #     OFF-TARGET      #
+    #######################
+    # ===== Pass reads outside of capture targets straight through to bad reads =====
+    target_mode = args.targets is not None or args.regions is not None
+    offtarget = 0
+    unpaired = 0
+    if target_mode:
+        with tracer.span('off-target', 'region') as span:
+            # Reads with mates outside of the targets can't be paired
+            pair_dict.drain()
+            for qname in list(pair_dict.keys()):
+                for read in pair_dict.pop(qname):
+                    badRead_bam.write(read)
+                    unpaired += 1
+            offtarget = write_offtarget(bamfile, badRead_bam, offtarget_coordinates(bamfile, division_coor))
+            span['reads'] = offtarget + unpaired
 
     ######################
     #       SUMMARY      #
@@ -356,7 +732,13 @@ Uncollapsed - Unmapped reads: {}
 Uncollapsed - Secondary/Supplementary reads: {}
 SSCS reads: {}
 Singletons: {}
-Bad spacers: {}\n'''.format(counter, unmapped, multiple_mapping, SSCS_reads, singletons, bad_spacer)
+Bad spacers: {}
+SSCS reads of identical families (fast path): {} ({:.2%})\n'''.format(
+        counter, unmapped, multiple_mapping, SSCS_reads, singletons, bad_spacer, consensus_stats['identical'],
+        consensus_stats['identical'] / max(SSCS_reads, 1))
+    if target_mode:
+        summary_stats += '''Unpaired reads (mate off-target): {}
+Off-target reads: {}\n'''.format(unpaired, offtarget)
 
     stats.write(summary_stats)
     print(summary_stats)
@@ -366,6 +748,11 @@ Bad spacers: {}\n'''.format(counter, unmapped, multiple_mapping, SSCS_reads, sin
     print('Total uncollapsed reads: {}'.format(counter))
     print('Total mapped reads in bam file: {}'.format(bamfile.mapped))
 
+    pair_dict.drain()
+    pair_dict.close()
+    if pair_dict.spilled > 0:
+        print('Reads spilled to disk while waiting for mates: {}'.format(pair_dict.spilled))
+
     print("QC: check dictionaries to see if there are any remaining reads")
     print('=== pair_dict remaining ===')
     if bool(pair_dict):
@@ -407,23 +794,23 @@ Bad spacers: {}\n'''.format(counter, unmapped, multiple_mapping, SSCS_reads, sin
         stat_file.write('family_size\tfrequency\n')
         stat_file.write('\n'.join('%s\t%s' % x for x in lst_tags_per_fam))
 
-    # ===== Create tag family size plot =====
-    total_reads = sum(tag_dict.values())
-    # Read fraction = family size * frequency of family / total reads
-    read_fraction = [(i * j) / total_reads for i, j in lst_tags_per_fam]
-
-    plt.bar(list(tags_per_fam), read_fraction)
-    # Determine read family size range to standardize plot axis
-    plt.xlim([0, math.ceil(lst_tags_per_fam[-1][0] / 10) * 10])
-    plt.savefig(args.outfile.split('.sscs')[0] + '_tag_fam_size.png')
-
     # ===== Close files =====
+    if pool is not None:
+        pool.close()
+        pool.join()
     time_tracker.close()
     stats.close()
     bamfile.close()
     SSCS_bam.close()
+    singleton_bam.close()
     badRead_bam.close()
 
+    tracer.end(stage_span,
+               reads=counter,
+               bytes=file_size(args.outfile,
+                               '{}.singleton{}'.format(args.outfile.split('.sscs')[0], suffix),
+                               '{}.badReads{}'.format(args.outfile.split('.sscs')[0], suffix)))
+
 
 ###############################
 #            Main             #
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                   Batch Consensus Maker
+#
+###############################################################
+# Function:
+# Make single strand consensus sequences of many families at once with NumPy (same result as consensus_maker of
+# SSCS_maker.py), so millions of small families (size 2-5) don't each pay per-base Python and per-call NumPy overhead.
+#
+# Families are sorted by size and packed into padded (families x max family size x read length) uint8 arrays of
+# bases and qualities plus a validity mask (padding reads and positions past the end of a read). Each consensus rule
+# is then one array operation over the whole batch:
+#    - Bases below Q30 are excluded
+#    - Most frequent base (first of A, C, G, T, N on ties) is taken if its proportion of passing bases >= cutoff,
+#      otherwise N
+#    - Consensus quality is the sum of the qualities of the most frequent base, capped at Q60
+#
+# NumPy is only imported when a batch is collapsed.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+BATCH_CELLS = 2 ** 22  # Maximum number of padded bases (families x family size x read length) per array batch
+NUCLEOTIDES = b'ACGTN'
+
+
+###############################
+#          Functions          #
+###############################
+def size_batches(sizes, lengths, max_cells=BATCH_CELLS):
+    """(list, list, int) -> list of lists
+    Return indices of families grouped into batches of similar size, each holding at most max_cells padded bases
+    (a family larger than max_cells is batched on its own).
+
+    >>> size_batches([2, 9, 2, 3], [10, 10, 10, 10], max_cells=60)
+    [[0, 2], [3], [1]]
+    """
+    batches = []
+    batch = []
+    max_size = 0
+    max_length = 0
+    for i in sorted(range(len(sizes)), key=lambda i: sizes[i]):
+        size = max(max_size, sizes[i])
+        length = max(max_length, lengths[i])
+        if batch and (len(batch) + 1) * size * length > max_cells:
+            batches.append(batch)
+            batch = []
+            size = sizes[i]
+            length = lengths[i]
+        batch.append(i)
+        max_size = size
+        max_length = length
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def batch_consensus_maker(readLists, cutoff, max_cells=BATCH_CELLS):
+    """(list, float, int) -> list of tuples
+    Return consensus (sequence, quality list) of each family (list of reads) in readLists, in order.
+
+    Test cases (same result as consensus_maker on ties, bases < Q30 (at all reads of a position), reads longer than the
+    first read of the family and reads of shared memory family blocks):
+    >>> from array import array
+    >>> from shm_transport import PackedRead
+    >>> from SSCS_maker import consensus_maker
+    >>> def family(*reads):
+    ...     return [PackedRead(seq.encode(), memoryview(array('B', qual)), 99, 60, 100) for seq, qual in reads]
+    >>> families = [family(('ACGT', [40] * 4), ('ACTT', [40] * 4)),
+    ...             family(('ACGT', [40, 10, 40, 40]), ('ACGT', [35, 20, 40, 40]), ('TCGA', [40, 10, 10, 40])),
+    ...             family(('ACG', [40] * 3), ('ACGTA', [40] * 5), ('AGGTT', [30] * 5))]
+    >>> batch_consensus_maker(families, 0.7)
+    [('ACNT', [60, 60, 40, 60]), ('NNGN', [60, 0, 60, 60]), ('ANG', [60, 60, 60])]
+    >>> [batch_consensus_maker(families, cutoff, max_cells=12) == [consensus_maker(reads, cutoff) for reads in families]
+    ...  for cutoff in (0.5, 0.7, 1)]
+    [True, True, True]
+    """
+    import numpy as np
+
+    # Base codes (A, C, G, T = 0-3, anything else = N)
+    codes = np.full(256, 4, dtype=np.uint8)
+    for code, nuc in enumerate(NUCLEOTIDES[:4]):
+        codes[nuc] = code
+    nucleotides = np.frombuffer(NUCLEOTIDES, dtype=np.uint8)
+
+    lengths = [readList[0].infer_query_length() for readList in readLists]
+    results = [None] * len(readLists)
+
+    for batch in size_batches([len(readList) for readList in readLists], lengths, max_cells):
+        n_families = len(batch)
+        max_size = max(len(readLists[f]) for f in batch)
+        read_length = max(lengths[f] for f in batch)
+
+        # === Padded arrays ===
+        seq = np.full((n_families, max_size, read_length), 4, dtype=np.uint8)
+        qual = np.zeros((n_families, max_size, read_length), dtype=np.uint8)
+        valid = np.zeros((n_families, max_size, read_length), dtype=bool)
+        for b, f in enumerate(batch):
+            length = lengths[f]
+            for j, read in enumerate(readLists[f]):
+                n = min(length, len(read.query_sequence))
+                seq[b, j, :n] = codes[np.frombuffer(read.query_sequence.encode('ascii'), dtype=np.uint8)[:n]]
+                qual[b, j, :n] = np.frombuffer(bytes(read.query_qualities), dtype=np.uint8)[:n]
+                valid[b, j, :n] = True
+
+        # === Count passing (>= Q30) bases and sum their qualities per nucleotide ===
+        passed = valid & (qual >= 30)
+        onehot = (seq[..., None] == np.arange(5, dtype=np.uint8)) & passed[..., None]  # families x size x length x 5
+        counts = onehot.sum(axis=1, dtype=np.int32)  # families x length x 5
+        qual_sums = (onehot * qual[..., None]).sum(axis=1, dtype=np.int32)
+
+        # === Most frequent base (first maximum on ties), its proportion and molecular quality ===
+        max_nuc = counts.argmax(axis=-1)
+        max_count = counts.max(axis=-1)
+        mol_qual = np.minimum(qual_sums[np.arange(n_families)[:, None], np.arange(read_length), max_nuc], 60)
+        pass_reads = counts.sum(axis=-1)
+        consensus = (pass_reads > 0) & (max_count / np.maximum(pass_reads, 1) >= cutoff)
+
+        bases = nucleotides[np.where(consensus, max_nuc, 4)]
+        for b, f in enumerate(batch):
+            results[f] = (bases[b, :lengths[f]].tobytes().decode('ascii'), mol_qual[b, :lengths[f]].tolist())
+
+    return results
@@ -32,6 +32,98 @@ import os
 import inspect
 
 
+###############################
+#         Flag Table          #
+###############################
+# Every flag (0-4095) is classified once at import so per-read checks are a single tuple index:
+#   bits 0-1: read number (FLAG_R1 | FLAG_R2)
+#   bits 2-3: strand class (STRAND_POS | STRAND_NEG | STRAND_NO_ORI, 0 if flag is not a uniquely mapped pair)
+#   bits 4-5: filter category (FILTER_PASS | FILTER_UNMAPPED | FILTER_MATE_UNMAPPED | FILTER_MULTIPLE_MAPPING)
+READ1_FLAGS = (99, 83, 67, 115, 81, 97, 65, 113)
+READ2_FLAGS = (147, 163, 131, 179, 161, 145, 129, 177)
+POS_FLAGS = (99, 147, 67, 131)
+NEG_FLAGS = (83, 163, 115, 179)
+NO_ORI_FLAGS = (65, 129, 113, 177, 81, 161, 97, 145)  # direction not defined
+MATE_UNMAPPED_FLAGS = (73, 89, 121, 153, 185, 137)
+
+FLAG_R1 = 0x1
+FLAG_R2 = 0x2
+READ_MASK = 0x3
+READ_NAMES = (None, 'R1', 'R2')
+
+STRAND_POS = 0x4
+STRAND_NEG = 0x8
+STRAND_NO_ORI = 0xC
+STRAND_MASK = 0xC
+
+FILTER_PASS = 0x00
+FILTER_UNMAPPED = 0x10
+FILTER_MATE_UNMAPPED = 0x20
+FILTER_MULTIPLE_MAPPING = 0x30  # secondary/supplementary
+FILTER_MASK = 0x30
+
+# Flags prioritized (in order) when multiple flags tie for consensus flag (properly mapped/paired)
+CONSENSUS_FLAG_RANK = {99: 0, 83: 1, 147: 2, 163: 3}
+
+
+def classify_flag(flag):
+    """(int) -> int
+    Return packed read number, strand class and filter category of flag (see Flag Table).
+
+    >>> classify_flag(99) == FLAG_R1 | STRAND_POS | FILTER_PASS
+    True
+    >>> classify_flag(177) == FLAG_R2 | STRAND_NO_ORI | FILTER_PASS
+    True
+    >>> classify_flag(137) == FILTER_MATE_UNMAPPED
+    True
+    >>> classify_flag(2147) == FILTER_MULTIPLE_MAPPING
+    True
+    """
+    code = 0
+
+    if flag in READ1_FLAGS:
+        code |= FLAG_R1
+    elif flag in READ2_FLAGS:
+        code |= FLAG_R2
+
+    if flag in POS_FLAGS:
+        code |= STRAND_POS
+    elif flag in NEG_FLAGS:
+        code |= STRAND_NEG
+    elif flag in NO_ORI_FLAGS:
+        code |= STRAND_NO_ORI
+
+    # Same order of precedence as read filtering (unmapped > mate unmapped > secondary/supplementary)
+    if flag & 0x4:
+        code |= FILTER_UNMAPPED
+    elif flag in MATE_UNMAPPED_FLAGS:
+        code |= FILTER_MATE_UNMAPPED
+    elif flag & 0x100 or flag & 0x800:
+        code |= FILTER_MULTIPLE_MAPPING
+
+    return code
+
+
+FLAG_TABLE = tuple(classify_flag(flag) for flag in range(4096))
+
+
+###############################
+#        Molecule Tags        #
+###############################
+# Aux tags written by SSCS_maker on SSCSs and singletons (and carried over to corrected singletons), so later stages
+# take the molecule identity from typed tags instead of parsing query names (tags starting with 'Z' are reserved for
+# local use by the SAM specification):
+BARCODE_TAG = 'ZB'  # Z: barcode in R1/R2 order of the read pair (as in query name)
+BARCODE_R1_TAG = 'Z1'  # Z: R1 half of barcode
+BARCODE_R2_TAG = 'Z2'  # Z: R2 half of barcode
+STRAND_TAG = 'ZS'  # Z: strand of origin ('pos' or 'neg', see which_strand)
+FAMILY_SIZE_TAG = 'ZF'  # i: family size
+MOLECULE_TAG = 'ZM'  # Z: molecule id shared by both reads of both strands (barcode of pos strand, coordinates, cigars
+#                           and absolute insert size, see family_tags)
+MOLECULE_TAG_TYPES = ((BARCODE_TAG, 'Z'), (BARCODE_R1_TAG, 'Z'), (BARCODE_R2_TAG, 'Z'), (STRAND_TAG, 'Z'),
+                      (FAMILY_SIZE_TAG, 'i'), (MOLECULE_TAG, 'Z'))
+
+
 ###############################
 #          Functions          #
 ###############################
@@ -43,6 +135,9 @@ def bed_separator(bedfile):
 
     with open(bedfile) as f:
         for line in f:
+            # Skip comments (e.g. region plan parameters)
+            if line.startswith('#'):
+                continue
             chr_arm = line.split('\t')
             chr_key = '{}_{}'.format(chr_arm[0], chr_arm[3])
             start = int(chr_arm[1])
@@ -66,17 +161,11 @@ def which_read(flag):
     >>> which_read(177)
     'R2'
     """
-    read1 = [99, 83, 67, 115, 81, 97, 65, 113]
-    read2 = [147, 163, 131, 179, 161, 145, 129, 177]
+    read = READ_NAMES[FLAG_TABLE[flag] & READ_MASK]
 
-    if flag in read1:
-        read = 'R1'
-    elif flag in read2:
-        read = 'R2'
-    else:
+    if read is None:
         print('UNMAPPED READ ERROR')
         print(flag)
-        read = None
 
     return read
 
@@ -125,24 +214,19 @@ def which_strand(read):
     Flag = 131 -> 'pos'
     Flag = 81 -> 'neg'
     """
-    # Flags indicating strand direction
-    pos = [99, 147, 67, 131]
-    neg = [83, 163, 115, 179]
-    no_ori = [65, 129, 113, 177, 81, 161, 97, 145]  # direction not defined
+    code = FLAG_TABLE[read.flag]
+    strand_class = code & STRAND_MASK
 
-    if read.flag in pos:
+    if strand_class == STRAND_POS:
         strand = 'pos'
-    elif read.flag in neg:
+    elif strand_class == STRAND_NEG:
         strand = 'neg'
-    elif read.flag in no_ori:
-        # Determine orientation of flags with no defined direction using order
-        # of chr coor
-        if (read.reference_id < read.next_reference_id and which_read(read.flag) == 'R1') or \
-                (read.reference_id > read.next_reference_id and which_read(read.flag) == 'R2') or \
-                (read.reference_id == read.next_reference_id and which_read(read.flag) == 'R1' and
-                 read.reference_start < read.next_reference_start) or \
-                (read.reference_id == read.next_reference_id and which_read(read.flag) == 'R2' and
-                 read.reference_start > read.next_reference_start):
+    elif strand_class == STRAND_NO_ORI:
+        # Determine orientation of flags with no defined direction using order of chr coor ('pos' if R1 is before
+        # its mate or R2 is after its mate)
+        read_coor = (read.reference_id, read.reference_start)
+        mate_coor = (read.next_reference_id, read.next_reference_start)
+        if (code & FLAG_R1 and read_coor < mate_coor) or (code & FLAG_R2 and read_coor > mate_coor):
             strand = 'pos'
         else:
             strand = 'neg'
@@ -183,10 +267,9 @@ def cigar_order(read, mate):
             [163] 137M10S
     """
     ori_strand = which_strand(read)
-    read_num = which_read(read.flag)
+    code = FLAG_TABLE[read.flag]
 
-    if (ori_strand == 'pos' and read_num == 'R1') or (
-            ori_strand == 'neg' and read_num == 'R2'):
+    if (ori_strand == 'pos' and code & FLAG_R1) or (ori_strand == 'neg' and code & FLAG_R2):
         cigar = '{}_{}'.format(read.cigarstring,
                                mate.cigarstring)
     else:
@@ -249,17 +332,41 @@ def sscs_qname(read, mate, barcode, cigar):
     return query_tag
 
 
+def swap_barcode(barcode):
+    """(str) -> str
+    Return barcode with R1 and R2 barcodes swapped (i.e. barcode of the complementary strand).
+
+    Barcode lists may contain barcodes of different lengths, so R1 and R2 barcodes are separated by '.'
+
+    >>> swap_barcode('GTCT')
+    'CTGT'
+    >>> swap_barcode('GTC.TAAG')
+    'TAAG.GTC'
+    """
+    if '.' in barcode:
+        r1_barcode, r2_barcode = barcode.split('.', 1)
+        return r2_barcode + '.' + r1_barcode
+
+    # number of barcode bases, avoids complications if num bases change
+    barcode_bases = len(barcode) // 2
+    # duplex barcode is the reverse (e.g. AT|GC -> GC|AT [dup])
+    return barcode[barcode_bases:] + barcode[:barcode_bases]
+
+
 def unique_tag(read, barcode, cigar):
-    """(pysam.calignedsegment.AlignedSegment, str, str) -> str
+    """(pysam.calignedsegment.AlignedSegment, str, str) -> tuple
     Return unique identifier tag for one read of a strand of a molecule.
 
     Tag uses following characteristics to group reads belonging to the same strand of an individual molecule (PCR dupes):
-    [Barcode]_[Read Chr]_[Read Start]_[Mate Chr]_[Mate Start]_[Cigar String]_[Orientation]_[ReadNum]
-    e.g. TTTG_24_58847416_24_58847448_137M10S_147M_fwd_R1
+    ((Molecule key), Strand bit)
+    - Molecule key: ([Barcode], [Read Chr], [Read Start], [Mate Chr], [Mate Start], [Cigar String], [Orientation])
+    - Strand bit: 0 = R1, 1 = R2
+    e.g. (('TTTG', 24, 58847416, 24, 58847448, '137M10S_147M', 'fwd'), 0)
 
     Notes:
-        - barcode always in order of R1/R2 for each read pair as determined from tag_to_header.py extraction of tags
-          from fastq files
+        - barcode of R2 reads is swapped into R1/R2 order of the complementary strand, so both strands of a molecule
+          share the same molecule key and only differ by strand bit (complementary tag is a single dict lookup, see
+          duplex_tag)
         - paired reads have ordered cigar strings of read and mate (see cigar_order fx for details) - important to have
         both for easy duplex tag search (if we didn't track both, you'd have to look for the corresponding mate cigar
         each time)
@@ -275,34 +382,35 @@ def unique_tag(read, barcode, cigar):
     (-) TT-----------GT
        R2 --->   <--- R1
 
-    R1 of (+) -> TTTG_24_58847416_24_58847448_137M10S_147M_fwd_R1
+    R1 of (+) -> (('TTTG', 24, 58847416, 24, 58847448, '137M10S_147M', 'fwd'), 0)
     NB500964:12:HTTG2BGXX:4:22601:26270:1144|TTTG	99	24	58847416	17	137M10S	24	58847448	137
 
-    R2 of (+) -> TTTG_24_58847448_24_58847416_137M10S_147M_rev_R2
+    R2 of (+) -> (('TGTT', 24, 58847448, 24, 58847416, '137M10S_147M', 'rev'), 1)
     NB500964:12:HTTG2BGXX:4:22601:26270:1144|TTTG	147	24	58847448	17	147M	24	58847416	147
 
-    R1 of (-) -> TGTT_24_58847448_24_58847416_137M10S_147M_rev_R1
+    R1 of (-) -> (('TGTT', 24, 58847448, 24, 58847416, '137M10S_147M', 'rev'), 0)
 
-    R2 of (-) -> TGTT_24_58847416_24_58847448_137M10S_147M_fwd_R2
+    R2 of (-) -> (('TTTG', 24, 58847416, 24, 58847448, '137M10S_147M', 'fwd'), 1)
     """
     orientation = 'fwd'
     if read.is_reverse:
         orientation = 'rev'
 
-    readNum = which_read(read.flag)
+    # Strand bit (reads without a read number flag are grouped with R1)
+    strand = 1 if FLAG_TABLE[read.flag] & FLAG_R2 else 0
+    if strand:
+        barcode = swap_barcode(barcode)
 
     # Unique identifier for strand of individual molecules
-    tag = '{}_{}_{}_{}_{}_{}_{}_{}'.format(barcode,  # mol barcode
-                                           read.reference_id,  # chr
-                                           # start (0-based)
-                                           read.reference_start,
-                                           read.next_reference_id,  # mate chr
-                                           read.next_reference_start,  # mate start
-                                           cigar,
-                                           orientation,  # strand direction
-                                           readNum
-                                           )
-    return tag
+    molecule_key = (barcode,  # mol barcode (in R1/R2 order of the R1 read)
+                    read.reference_id,  # chr
+                    read.reference_start,  # start (0-based)
+                    read.next_reference_id,  # mate chr
+                    read.next_reference_start,  # mate start
+                    cigar,
+                    orientation)  # strand direction
+
+    return molecule_key, strand
 
 
 def read_bam(
@@ -316,14 +424,19 @@ def read_bam(
         read_chr=None,
         read_start=None,
         read_end=None,
-        barcode_delim=None):
-    """(bamfile, dict, dict, dict, dict, bamfile, bool, str, int, int) ->
+        barcode_delim=None,
+        max_family_size=None,
+        family_qnames=None,
+        reads=None,
+        umi_tag=None):
+    """(bamfile, dict, dict, dict, dict, bamfile, bool, str, int, int, str, int, dict, iterable, str) ->
     dict, dict, dict, dict, int, int, int
 
     === Input ===
     - bamfile (pysam.AlignmentFile object): uncollapsed BAM file
 
-    - pair_dict: dictionary of paired reads based on query name to process data in pairs
+    - pair_dict: dictionary of paired reads based on query name to process data in pairs (collections.defaultdict(list)
+                 or pair_store.PairStore to spill reads waiting for distant mates to disk)
 
     - read_dict: dictionary of bamfile reads grouped by unique molecular tags
 
@@ -338,7 +451,8 @@ def read_bam(
     # For large bamfiles that are split into regions
     - read_chr (str): chromosome region to fetch reads
     - read_start (int): starting position to fetch reads
-    - read_end (int): stopping position to fetch reads
+    - read_end (int): stopping position to fetch reads (exclusive, reads starting at read_end belong to the next
+                      region)
 
     # For duplex consensus making
     - duplex: any string or bool [that is not None] specifying duplex consensus making [e.g. TRUE], necessary for
@@ -347,10 +461,24 @@ def read_bam(
     # For bams with barcodes extracted by other software and placed into read name with different delimiters
     - barcode_delim (str): sequence before barcode (e.g. '|' for 'HWI-D00331:196:C900FANXX:7:1110:14056:43945|TTTT')
 
+    # For bams with barcodes in an aux tag (e.g. RX:Z:TTTG or RX:Z:TT-TG with '-' between R1 and R2 barcodes)
+    - umi_tag (str): tag holding the barcode, read instead of parsing the query name (barcode_delim is ignored, reads
+                     without the tag are counted as bad spacer reads)
+
+    # For reads that were already fetched (e.g. windows of an indexed BAM)
+    - reads: iterable of reads to group instead of fetching from bamfile (region filter is not applied, read_end is
+             only used to keep pending reads whose mate is within the region in memory, see pair_store.PairStore)
+
+    # For ultra-deep families (e.g. amplicon hotspots)
+    - max_family_size (int): maximum number of reads kept per family, reads past the cap are reservoir sampled so kept
+                             reads are a uniform sample of the family (tag_dict still records the true family size)
+    - family_qnames: dictionary of query names already added to each family {read_tag: {qname, ..etc}}, keep across
+                     calls (and remove tags once written) to detect reads fetched twice across regions
+
     === Output ===
     1) read_dict: dictionary of bamfile reads grouped by unique molecular tags
                   Example: {read_tag: [<pysam.calignedsegment.AlignedSegment>, <pysam.calignedsegment.AlignedSegment>]}
-                  - Key: [Barcode]_[Read Chr]_[Read Start]_[Mate Chr]_[Mate Start]_[Cigar String]_[Strand]_[Orientation]_[ReadNum]
+                  - Key: ((Molecule key), Strand bit) (see unique_tag)
                   - Value: List of reads (pysam object)
 
     2) tag_dict: integer dictionary indicating number of reads in each read family
@@ -374,11 +502,20 @@ def read_bam(
                          - supplementary reads: multiple parts of sequence align to multiple locations
     """
     # Fetch data given genome coordinates
-    if read_chr is None:
+    if reads is not None:
+        bamLines = reads
+        read_chr = None
+    elif read_chr is None:
         bamLines = bamfile.fetch(until_eof=True)
     else:
         bamLines = bamfile.fetch(read_chr, read_start, read_end)
 
+    if family_qnames is None:
+        family_qnames = collections.defaultdict(set)
+
+    # Pending pairs that spill to disk (see pair_store.PairStore) track scan position
+    advance = getattr(pair_dict, 'advance', None)
+
     # Initialize counters
     unmapped = 0
     unmapped_mate = 0
@@ -392,32 +529,39 @@ def read_bam(
             # pysam fetch will retrieve reads that fall outside region due to pairing (we filter out to prevent double
             # counting as we'll be fetching those reads again when we iterate
             # through the next region)
-            if line.reference_start < read_start or line.reference_start > read_end:
+            if line.reference_start < read_start or line.reference_start >= read_end:
                 continue
 
+        if advance is not None:
+            advance(line.reference_id, line.reference_start, read_end)
+
         counter += 1
 
         ######################
         #    Filter Reads    #
         ######################
         # === 1) FILTER OUT UNMAPPED / MULTIPLE MAPPING READS ===
-        mate_unmapped = [73, 89, 121, 153, 185, 137]
+        category = FLAG_TABLE[line.flag] & FILTER_MASK
         badRead = True
 
-        # Check if delimiter is found in read
-        if barcode_delim is not None and barcode_delim not in line.qname:
+        # Check if barcode is found in read (UMI tag, or delimiter in query name)
+        if umi_tag is not None:
+            bad_barcode = not line.has_tag(umi_tag)
+        else:
+            bad_barcode = barcode_delim is not None and barcode_delim not in line.qname
+
+        if bad_barcode:
             bad_spacer += 1
-        elif line.is_unmapped:
+        elif category == FILTER_PASS:
+            badRead = False
+        elif category == FILTER_UNMAPPED:
             unmapped += 1
             counter -= 1
-        elif line.flag in mate_unmapped:
+        elif category == FILTER_MATE_UNMAPPED:
             unmapped_mate += 1
-        elif line.is_secondary:
-            multiple_mapping += 1
-        elif line.is_supplementary:
-            multiple_mapping += 1
         else:
-            badRead = False
+            # Secondary/supplementary reads
+            multiple_mapping += 1
 
         # Write bad reads to file
         if badRead and badRead_bam is not None:
@@ -435,28 +579,38 @@ def read_bam(
                 # === Create consensus identifier ===
                 # Extract molecular barcode, barcodes in diff position for SSCS
                 # vs DCS generation
-                if duplex is None or duplex == False:
-                    if barcode_delim is None:
-                        # SSCS query name:
-                        # H1080:278:C8RE3ACXX:6:1308:18882:18072|CACT
-                        barcode = read.qname.split("|")[1]
-                    else:
-                        barcode = read.qname.split(barcode_delim)[1]
+                if duplex and read.has_tag(MOLECULE_TAG):
+                    # Consensus reads carry their molecule identity as aux tags (see family_tags), so neither query
+                    # names nor cigars and coordinates have to be parsed
+                    consensus_tag = (read.get_tag(MOLECULE_TAG), read.get_tag(STRAND_TAG))
+                    tags = [molecule_tag(read), molecule_tag(mate)]
                 else:
-                    # DCS query name: CCTG_12_25398000_12_25398118_neg:5
-                    barcode = read.qname.split("_")[0]
-
-                # Consensus_tag cigar (ordered by strand and read)
-                cigar = cigar_order(read, mate)
-                # Assign consensus tag as new query name for paired consensus
-                # reads
-                consensus_tag = sscs_qname(read, mate, barcode, cigar)
+                    if duplex is None or duplex == False:
+                        if umi_tag is not None:
+                            # UMI tag: RX:Z:CACT, or RX:Z:CA-CT with R1 and R2 barcodes separated (see swap_barcode)
+                            barcode = read.get_tag(umi_tag).replace('-', '.')
+                        elif barcode_delim is None:
+                            # SSCS query name:
+                            # H1080:278:C8RE3ACXX:6:1308:18882:18072|CACT
+                            barcode = read.qname.split("|")[1]
+                        else:
+                            barcode = read.qname.split(barcode_delim)[1]
+                    else:
+                        # DCS query name: CCTG_12_25398000_12_25398118_neg:5
+                        barcode = read.qname.split("_")[0]
+
+                    # Consensus_tag cigar (ordered by strand and read)
+                    cigar = cigar_order(read, mate)
+                    # Assign consensus tag as new query name for paired consensus
+                    # reads
+                    consensus_tag = sscs_qname(read, mate, barcode, cigar)
+                    # Molecular identifier for grouping reads belonging to the
+                    # same read of a strand of a molecule
+                    tags = [unique_tag(read, barcode, cigar), unique_tag(mate, barcode, cigar)]
 
                 for i in range(2):
                     read_i = pair_dict[line.qname][i]
-                    # Molecular identifier for grouping reads belonging to the
-                    # same read of a strand of a molecule
-                    tag = unique_tag(read_i, barcode, cigar)
+                    tag = tags[i]
 
                     ######################
                     #   Assign to Dict   #
@@ -465,6 +619,7 @@ def read_bam(
                     if tag not in read_dict and tag not in tag_dict:
                         read_dict[tag] = [read_i]
                         tag_dict[tag] += 1
+                        family_qnames[tag].add(read_i.qname)
 
                         # Group paired unique tags using consensus tag
                         if consensus_tag not in csn_pair_dict:
@@ -487,11 +642,18 @@ def read_bam(
                             # Manual inspection should be done on these reads
                         else:
                             csn_pair_dict[consensus_tag].append(tag)
-                    elif tag in tag_dict and read not in read_dict[tag]:
+                    elif tag in tag_dict and read_i.qname not in family_qnames[tag]:
                         # Append reads sharing the same unique tag together
                         # (PCR dupes)
-                        read_dict[tag].append(read_i)
+                        family_qnames[tag].add(read_i.qname)
                         tag_dict[tag] += 1
+                        if max_family_size is None or len(read_dict[tag]) < max_family_size:
+                            read_dict[tag].append(read_i)
+                        else:
+                            # Reservoir sampling: n-th read replaces a kept read with probability cap / n
+                            keep_index = randint(0, tag_dict[tag] - 1)
+                            if keep_index < max_family_size:
+                                read_dict[tag][keep_index] = read_i
                     else:
                         # Data fetch error - line read twice (if its found in
                         # tag_dict and read_dict)
@@ -548,14 +710,9 @@ def consensus_flag(bam_reads):
     max_flag = [i for i, j in count_flags if j == count_flags[0][1]]
 
     if len(max_flag) != 1:
-        if 99 in max_flag:
-            flag = 99
-        elif 83 in max_flag:
-            flag = 83
-        elif 147 in max_flag:
-            flag = 147
-        elif 163 in max_flag:
-            flag = 163
+        ranked_flag = [i for i in max_flag if i in CONSENSUS_FLAG_RANK]
+        if ranked_flag:
+            flag = min(ranked_flag, key=CONSENSUS_FLAG_RANK.get)
         else:
             # If flag not properly paired/mapped, randomly select from max
             flag = max_flag[randint(0, len(max_flag) - 1)]
@@ -565,8 +722,8 @@ def consensus_flag(bam_reads):
     return flag
 
 
-def create_aligned_segment(bam_reads, sscs, sscs_qual, query_name):
-    """(list, str, list, list, str) -> pysam object
+def create_aligned_segment(bam_reads, sscs, sscs_qual, query_name, tags=None):
+    """(list, str, list, list, str, list) -> pysam object
     Return consensus read representing list of reads from the same molecule.
 
     Bam file characteristics:
@@ -586,6 +743,7 @@ def create_aligned_segment(bam_reads, sscs, sscs_qual, query_name):
         - Proportion score (ps) -> we calculated in consensus_maker
             ->  Tags starting with ‘X’, ‘Y’ or ‘Z’ and tags containing lowercase letters in either position are reserved
                 for local use and will not be formally defined in any future version of these specifications.
+        - Molecule tags (tags [(tag, value, value type)], see family_tags)
     """
     # Use first read in list as template (all reads should share same cigar,
     # template length, and coor)
@@ -615,6 +773,8 @@ def create_aligned_segment(bam_reads, sscs, sscs_qual, query_name):
         SSCS_read.set_tag('RG', read_mode("get_tag('RG')", bam_reads))
     except BaseException:
         pass
+    for tag, value, value_type in tags or []:
+        SSCS_read.set_tag(tag, value, value_type)
 
     return SSCS_read
 
@@ -636,48 +796,143 @@ def reverse_seq(seq):
     return rev_comp
 
 
+def family_tags(tag, read, consensus_tag, family_size):
+    """(tuple, pysam.calignedsegment.AlignedSegment, str, int) -> list
+    Return molecule aux tags [(tag, value, value type)] of read family tag (see unique_tag) with consensus tag (see
+    sscs_qname), read is any read of the family.
+
+    The barcode is taken from the molecule key, where it is swapped into R1/R2 order of the complementary strand for R2
+    reads, so it is swapped back for those. The molecule id is the consensus tag without strand, with the barcode of
+    the pos strand, so it is the same for both strands of a molecule.
+
+    Test cases:
+    >>> header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000}]})
+    >>> read = pysam.AlignedSegment(header)
+    >>> read.flag, read.reference_id, read.next_reference_id = 163, 0, 0
+    >>> tag = (('TTTG', 0, 416, 0, 448, '137M10S_147M', 'fwd'), 1)
+    >>> family_tags(tag, read, 'TGTT_0_416_0_448_137M10S_147M_neg_148', 3)[:5]
+    [('ZB', 'TGTT', 'Z'), ('Z1', 'TG', 'Z'), ('Z2', 'TT', 'Z'), ('ZS', 'neg', 'Z'), ('ZF', 3, 'i')]
+    >>> family_tags(tag, read, 'TGTT_0_416_0_448_137M10S_147M_neg_148', 3)[5]
+    ('ZM', 'TTTG_0_416_0_448_137M10S_147M_148', 'Z')
+    """
+    barcode = tag[0][0] if tag[1] == 0 else swap_barcode(tag[0][0])
+    strand = which_strand(read)
+
+    if '.' in barcode:
+        r1_barcode, r2_barcode = barcode.split('.', 1)
+    else:
+        r1_barcode, r2_barcode = barcode[:len(barcode) // 2], barcode[len(barcode) // 2:]
+
+    # Molecule id: consensus tag with barcode of pos strand and without strand
+    tag_coor, _, insert_size = consensus_tag[len(barcode) + 1:].rpartition('_')
+    molecule = '{}_{}_{}'.format(barcode if strand == 'pos' else swap_barcode(barcode),
+                                 tag_coor.rpartition('_')[0],
+                                 insert_size)
+
+    return [(BARCODE_TAG, barcode, 'Z'),
+            (BARCODE_R1_TAG, r1_barcode, 'Z'),
+            (BARCODE_R2_TAG, r2_barcode, 'Z'),
+            (STRAND_TAG, strand, 'Z'),
+            (FAMILY_SIZE_TAG, family_size, 'i'),
+            (MOLECULE_TAG, molecule, 'Z')]
+
+
+def molecule_tags(read):
+    """(pysam.calignedsegment.AlignedSegment) -> list
+    Return molecule aux tags [(tag, value, value type)] of read, empty if read has none (e.g. made by an earlier version
+    of SSCS_maker).
+    """
+    if not read.has_tag(MOLECULE_TAG):
+        return []
+    return [(tag, read.get_tag(tag), value_type) for tag, value_type in MOLECULE_TAG_TYPES]
+
+
+def molecule_tag(read):
+    """(pysam.calignedsegment.AlignedSegment) -> tuple
+    Return unique identifier tag (see unique_tag) of a consensus read from its molecule aux tags:
+    ((Molecule id, Segment), Strand bit)
+    - Segment: 0 = R1 of pos strand (or R2 of neg strand), 1 = R2 of pos strand (or R1 of neg strand)
+    - Strand bit: 0 = R1, 1 = R2
+
+    As in unique_tag, complementary reads (e.g. pos R1 and neg R2) only differ by strand bit (see duplex_tag).
+
+    Test cases:
+    >>> header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000}]})
+    >>> read = pysam.AlignedSegment(header)
+    >>> read.flag = 99
+    >>> read.set_tag('ZM', 'TTTG_0_416_0_448_137M10S_147M_148')
+    >>> read.set_tag('ZS', 'pos')
+    >>> molecule_tag(read)
+    (('TTTG_0_416_0_448_137M10S_147M_148', 0), 0)
+    >>> read.flag = 163
+    >>> read.set_tag('ZS', 'neg')
+    >>> duplex_tag(molecule_tag(read))
+    (('TTTG_0_416_0_448_137M10S_147M_148', 0), 0)
+    """
+    strand = 1 if FLAG_TABLE[read.flag] & FLAG_R2 else 0
+    segment = strand if read.get_tag(STRAND_TAG) == 'pos' else 1 - strand
+    return (read.get_tag(MOLECULE_TAG), segment), strand
+
+
 def duplex_tag(tag):
-    """(str) -> str
+    """(tuple) -> tuple
     Return tag for duplex read.
 
-    Things to be changed in tag to find its complementary tag:
-    1) barcode: molecular identifiers get swapped (e.g. 2 based identifiers on each side of DNA fragment)
-               (+) 5' AT-------CG  3' -> ATGC
-               (-)    AT-------CG     <- GCAT
-    2) read: R1 -> R2
+    Complementary strands share the same molecule key (barcode swapped and read number flipped, see unique_tag), so
+    the duplex tag only differs by strand bit.
 
     Note: don't need to swap cigar strings as they are already ordered by strand (pos R1 correspond to neg R2)
-    ** Barcode lists may contain barcodes of different lengths, so R1 and R2 barcodes are
-    separated by '.'**
 
     Test cases:
-    >>> duplex_tag('GTCT_1_1507809_7_55224319_98M_98M_fwd_R1')
-    'CTGT_1_1507809_7_55224319_98M_98M_neg_fwd_R2'
-    >>> duplex_tag('GTCT_7_55224319_1_1507809_98M_98M_rev_R2')
-    'CTGT_7_55224319_1_1507809_98M_98M_neg_rev_R1'
-    >>> duplex_tag('CTGT_1_1507809_7_55224319_98M_98M_fwd_R2')
-    'GTCT_1_1507809_7_55224319_98M_98M_pos_fwd_R1'
-    >>> duplex_tag('CTGT_7_55224319_1_1507809_98M_98M_rev_R1')
-    'GTCT_7_55224319_1_1507809_98M_98M_pos_rev_R2'
+    >>> duplex_tag((('GTCT', 1, 1507809, 7, 55224319, '98M_98M', 'fwd'), 0))
+    (('GTCT', 1, 1507809, 7, 55224319, '98M_98M', 'fwd'), 1)
+    >>> duplex_tag((('GTCT', 7, 55224319, 1, 1507809, '98M_98M', 'rev'), 1))
+    (('GTCT', 7, 55224319, 1, 1507809, '98M_98M', 'rev'), 0)
     """
-    split_tag = tag.split('_')
-    # 1) Barcode needs to be swapped
-    barcode = split_tag[0]
-    # Separate R1 and R2 barcodes with '.' separator
-    if re.search('\.', barcode) is not None:
-        split_index = barcode.index('.')
-        split_tag[0] = barcode[split_index + 1:] + '.' + barcode[:split_index]
-    else:
-        # number of barcode bases, avoids complications if num bases change
-        barcode_bases = int(len(barcode) / 2)
-        # duplex barcode is the reverse (e.g. AT|GC -> GC|AT [dup])
-        split_tag[0] = barcode[barcode_bases:] + barcode[:barcode_bases]
-
-    # 2) Opposite read number in duplex
-    read_num = split_tag[8]
-    if read_num == 'R1':
-        split_tag[8] = 'R2'
-    else:
-        split_tag[8] = 'R1'
+    return tag[0], 1 - tag[1]
+
+
+class NullBam:
+    """Stand-in for an output BAM file that is not requested (see --discard of the stage scripts).
+
+    Reads are only counted, so stages skip compressing and writing files that would be removed anyway. Unlike passing
+    None, read_bam still treats bad reads as bad reads.
+
+    >>> bam = NullBam()
+    >>> bam.write('read')
+    >>> bam.written
+    1
+    """
+
+    def __init__(self):
+        self.written = 0
 
-    return '_'.join(split_tag)
+    def write(self, read):
+        self.written += 1
+
+    def close(self):
+        pass
+
+
+def alignment_suffix(path):
+    """(str) -> str
+    Return file extension (format) of alignment file, '.cram' for CRAM files and '.bam' otherwise.
+
+    >>> alignment_suffix('sample.sscs.sorted.cram')
+    '.cram'
+    >>> alignment_suffix('sample.sscs.bam')
+    '.bam'
+    """
+    return '.cram' if path.endswith('.cram') else '.bam'
+
+
+def open_alignment(path, mode, reference=None, **kwargs):
+    """(str, str, str) -> pysam.AlignmentFile
+    Return BAM or CRAM file (by extension) opened with BAM mode ("rb", "wb" or "wbu"). CRAM files are read and written
+    against reference (FASTA), which is required to decode and encode their sequences. CRAM has no uncompressed mode,
+    so "wbu" writes a regular CRAM file.
+    """
+    if alignment_suffix(path) == '.cram':
+        mode = mode.replace('b', 'c').replace('u', '')
+        kwargs['reference_filename'] = reference
+    return pysam.AlignmentFile(path, mode, **kwargs)
@@ -1,11 +1,5 @@
 #!/usr/bin/env python3
 
-import os
-import matplotlib as mpl
-if os.environ.get('DISPLAY','') == '':
-     print('no display found. Using non-interactive Agg backend')
-     mpl.use('Agg')
-
 ###############################################################
 #
 #                       Extract Barcodes
@@ -40,6 +34,8 @@ if os.environ.get('DISPLAY','') == '':
 # 1. A Read 1 FASTQ file with barcodes added to the FASTQ header
 # 2. A Read 2 FASTQ file with barcodes added to the FASTQ header
 # 3. A text file summarizing barcode stats
+# 4. A text file of raw barcode counts (base counts per barcode position for patterns, counts per barcode for lists),
+#    formatted (into "barcode_table.txt") and plotted by the report step (report.py) - "barcode_counts.txt"
 #
 ###############################################################
 
@@ -48,12 +44,8 @@ if os.environ.get('DISPLAY','') == '':
 ################
 from argparse import ArgumentParser
 from gzip import open as gzopen
-from Bio import SeqIO
-import pandas as pd
-import numpy as np
 import re
 import sys
-import matplotlib.pyplot as plt
 
 
 #######################
@@ -103,23 +95,43 @@ def find_all(a_str, sub):
 
 def create_nuc_dict(nuc_lst):
     """ (list) -> dict
-    Takes the nucleotide list and converts it to a dictionary of binary arrays.
-    e.g. A => {"A":[1, 0, 0, 0, 0]}
+    Takes the nucleotide list and converts it to a dictionary of column indices.
+    e.g. ['A', 'C'] => {"A": 0, "C": 1}
     """
-    nuc_dict = {}
-    for nuc_x in nuc_lst:
-        nuc_arr = np.array([nuc_y == nuc_x for nuc_y in nuc_lst]).astype(int)
-        nuc_dict.update({nuc_x: nuc_arr})
-    return nuc_dict
+    return {nuc: i for i, nuc in enumerate(nuc_lst)}
+
 
+def count_bases(counter, seq, nuc_dict):
+    """ (list, string, dict) -> None
+    Add nucleotides of sequence to per position base counter (rows = positions, columns = nuc_lst order).
 
-def seq_to_mat(seq, nuc_dict):
-    """ (string, dict) -> np.matrix
-    Converts a string of nucleotides to a matrix of binary nucleotides.
+    >>> counter = [[0, 0, 0, 0, 0], [0, 0, 0, 0, 0]]
+    >>> count_bases(counter, 'AT', create_nuc_dict(['A', 'C', 'G', 'T', 'N']))
+    >>> counter
+    [[1, 0, 0, 0, 0], [0, 0, 0, 1, 0]]
     """
-    nuc_map = [nuc_dict[each_nuc] for each_nuc in list(seq)]
-    nuc_mat = np.asmatrix(nuc_map)
-    return nuc_mat
+    for i, nuc in enumerate(seq):
+        counter[i][nuc_dict[nuc]] += 1
+
+
+def write_barcode_counts(counts_file, nuc_lst, r1_barcode_counter=None, r2_barcode_counter=None, r1_tag_dict=None,
+                         r2_tag_dict=None):
+    """ (str, list, list, list, dict, dict) -> None
+    Write raw barcode counts to tab separated file for the report step.
+
+    - Barcode pattern: base counts of each barcode position for R1 and R2
+    - Barcode list: number of R1 and R2 reads for each barcode
+    """
+    with open(counts_file, 'w') as f:
+        if r1_barcode_counter is not None:
+            f.write('read\tposition\t{}\n'.format('\t'.join(nuc_lst)))
+            for read, counter in [('R1', r1_barcode_counter), ('R2', r2_barcode_counter)]:
+                for i, counts in enumerate(counter):
+                    f.write('{}\t{}\t{}\n'.format(read, i, '\t'.join(str(c) for c in counts)))
+        else:
+            f.write('Barcode\tR1_Count\tR2_Count\n')
+            for barcode in sorted(r1_tag_dict, key=lambda b: (len(b), b)):
+                f.write('{}\t{}\t{}\n'.format(barcode, r1_tag_dict[barcode], r2_tag_dict[barcode]))
 
 
 def extract_barcode(read, plen):
@@ -195,6 +207,8 @@ def main():
     ######################
     #       SETUP        #
     ######################
+    from Bio import SeqIO
+
     # === Initialize input and output files ===
     # Check if file is zipped
     if 'gz' in args.read1:
@@ -243,10 +257,8 @@ def main():
 
             # Column in the following corresponds to A, C, G, T, N
             nuc_dict = create_nuc_dict(nuc_lst)
-            r1_barcode_counter = pd.DataFrame(
-                0, index=np.arange(plen), columns=nuc_lst)
-            r2_barcode_counter = pd.DataFrame(
-                0, index=np.arange(plen), columns=nuc_lst)
+            r1_barcode_counter = [[0] * len(nuc_lst) for i in range(plen)]
+            r2_barcode_counter = [[0] * len(nuc_lst) for i in range(plen)]
     # == Barcode list ==
     else:
         blist = open(args.blist, "r").read().splitlines()
@@ -305,8 +317,8 @@ def main():
                 bad_barcode += 1
             else:
                 # Count barcode bases
-                r1_barcode_counter += seq_to_mat(r1_barcode, nuc_dict)
-                r2_barcode_counter += seq_to_mat(r2_barcode, nuc_dict)
+                count_bases(r1_barcode_counter, r1_barcode, nuc_dict)
+                count_bases(r2_barcode_counter, r2_barcode, nuc_dict)
 
                 # Add barcode and read number to header
                 r1_bc = ''.join([r1_barcode[x] for x in b_index])
@@ -422,61 +434,15 @@ def main():
             bad_spacer,
             bad_barcode,
             good_barcode))
-    # == Barcode pattern ==
+    # Raw counts are formatted (and plotted) by the report step
     if args.bpattern is not None:
-        stats.write(
-            '---BARCODE---\n{}\n-----------\n{}\n'.format(
-                r1_barcode_counter.apply(
-                    lambda x: x / x.sum(),
-                    axis=1),
-                r2_barcode_counter.apply(
-                    lambda x: x / x.sum(),
-                    axis=1)))
-    # == Barcode list ==
+        write_barcode_counts('{}_barcode_counts.txt'.format(args.outfile), nuc_lst,
+                             r1_barcode_counter=r1_barcode_counter,
+                             r2_barcode_counter=r2_barcode_counter)
     else:
-        # Convert dict to dataframes
-        r1_df = pd.DataFrame(sorted(r1_tag_dict.items(), key=lambda kv: (
-            len(kv[0]), kv[0])), columns=["Barcode", "R1_Count"])
-        r2_df = pd.DataFrame(sorted(r2_tag_dict.items(), key=lambda kv: (
-            len(kv[0]), kv[0])), columns=["Barcode", "R2_Count"])
-
-        # Merge dataframes and sum total count
-        df_merge = pd.merge(r1_df, r2_df, on="Barcode")
-        df_merge['Total'] = df_merge['R1_Count'] + df_merge['R2_Count']
-
-        # Order dataframe
-        df_merge = df_merge.sort_values(by="Total", ascending=False)
-
-        # Write stats to file
-        stats.write('---BARCODE---\n{}\n'.format(df_merge))
-
-        # == Create histogram for barcode stats ==
-        fig, ax = plt.subplots()
-        # Set x-axis range to number of barcodes
-        ax.set_xlim(0, len(df_merge.index))
-
-        # the x locations (number of barcodes)
-        ind = np.arange(len(df_merge.index))
-        width = 0.35  # the width of the bars
-        p1 = ax.bar(ind, df_merge['R1_Count'], width, color='g')
-        p2 = ax.bar(ind + width, df_merge['R2_Count'], width, color='y')
-
-        # Label axis
-        ax.set_xticks(ind + width)
-        ax.set_xticklabels(df_merge['Barcode'])
-        for tick in ax.get_xticklabels():
-            tick.set_rotation(90)
-        # Add space to make sure x labels aren't cut off
-        plt.gcf().subplots_adjust(bottom=0.15)
-        plt.tick_params(axis='x', which='both', top=False)
-        plt.tick_params(axis='y', which='both', right=False)
-
-        # Set legends and labels
-        ax.legend((p1[0], p2[0]), ('Read1', 'Read2'))
-        ax.set_title('Barcode frequency')
-        plt.ylabel('Count')
-
-        plt.savefig('{}_barcode_stats.png'.format(args.outfile))
+        write_barcode_counts('{}_barcode_counts.txt'.format(args.outfile), nuc_lst,
+                             r1_tag_dict=r1_tag_dict,
+                             r2_tag_dict=r2_tag_dict)
 
     stats.close()
 
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                         Pair Store
+#
+###############################################################
+# Function:
+# Keep reads waiting for their mate (pair_dict of read_bam) within a memory budget.
+#
+# Reads are paired by query name as the position-sorted BAM is scanned, so a read is pending until the scan reaches
+# its mate. For inter-chromosomal pairs (translocations) and pairs spanning many regions this can be most of the genome
+# later. Above --max-pending reads, pending reads whose mate is beyond the current region (or on another chromosome) are
+# spilled to a temporary BAM chunk sorted by mate position. Mates within the region are read shortly and stay in memory,
+# so reads are not written to disk only to be restored right away. Chunks are merged back (smallest mate position first)
+# as the scan reaches each mate, so a spilled read is always back in memory before its mate is read. Once MAX_CHUNKS
+# chunks are open, they are merged with the newly spilled reads into a single chunk to bound open files.
+#
+# Concepts:
+#    - Pending read: read whose mate has not been read yet
+#    - Mate key: (mate reference id, mate start) of a pending read, i.e. scan position at which it can be paired
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import pysam  # Need to install
+import collections
+import heapq
+import os
+import shutil
+import tempfile
+from itertools import chain
+
+MAX_CHUNKS = 16  # Maximum number of spilled chunks open at once
+
+
+###############################
+#          Pair Store         #
+###############################
+class PairStore(collections.defaultdict):
+    """Pending read pairs ({query name: [reads]}) that spill to disk above max_pending reads.
+
+    Drop-in replacement of collections.defaultdict(list) for pair_dict of read_bam, which calls advance() with the
+    position of every read (and the end of the region being read) before adding it.
+
+    Test cases (spilled reads are back ahead of their mate, i.e. in R1/R2 order, once the scan reaches the mate; 'c' is
+    kept in memory, as its mate is on the chromosome being read):
+    >>> header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]})
+    >>> template = pysam.AlignmentFile(os.path.join(tempfile.mkdtemp(), 'template.bam'), 'wb', header=header)
+    >>> def scan(pairs, name, flag, tid, pos, mate_tid, mate_pos, end=None):
+    ...     read = pysam.AlignedSegment(header)
+    ...     read.query_name, read.flag, read.query_sequence, read.cigarstring = name, flag, 'ACGT', '4M'
+    ...     read.reference_id, read.reference_start = tid, pos
+    ...     read.next_reference_id, read.next_reference_start = mate_tid, mate_pos
+    ...     pairs.advance(tid, pos, end)
+    ...     pairs[name].append(read)
+    >>> pairs = PairStore(template, max_pending=1)
+    >>> for name, pos in [('a', 100), ('b', 200), ('c', 300)]:
+    ...     scan(pairs, name, 99, 0, pos, 1, pos)
+    >>> sorted(pairs), pairs.spilled
+    (['c'], 2)
+    >>> scan(pairs, 'a', 147, 1, 100, 0, 100)
+    >>> [read.flag for read in pairs.pop('a')], sorted(pairs), pairs.spilled
+    ([99, 147], ['c'], 2)
+    >>> scan(pairs, 'b', 147, 1, 200, 0, 200)
+    >>> scan(pairs, 'c', 147, 1, 300, 0, 300)
+    >>> [(name, [read.flag for read in reads]) for name, reads in sorted(pairs.items())], pairs.restored
+    ([('b', [99, 147]), ('c', [99, 147])], 2)
+    >>> pairs.close()
+
+    Test cases (only mates beyond the region end are spilled, open chunks are merged above max_chunks):
+    >>> pairs = PairStore(template, max_pending=1, max_chunks=2)
+    >>> for name, pos, mate_pos in [('a', 100, 900), ('b', 110, 150), ('c', 120, 800), ('d', 130, 700)]:
+    ...     scan(pairs, name, 99, 0, pos, 0, mate_pos, end=500)
+    >>> sorted(pairs), pairs.spilled, len(pairs.heap)
+    (['b', 'c', 'd'], 1, 1)
+    >>> for name, pos, mate_pos in [('e', 140, 600), ('f', 150, 650), ('g', 160, 750)]:
+    ...     scan(pairs, name, 99, 0, pos, 0, mate_pos, end=500)
+    >>> sorted(pairs), pairs.spilled, len(pairs.chunks), len(pairs.heap)
+    (['b', 'g'], 5, 3, 1)
+    >>> scan(pairs, 'b', 147, 0, 150, 0, 110, end=500)
+    >>> for name, pos in [('e', 600), ('f', 650), ('d', 700), ('g', 750), ('c', 800), ('a', 900)]:
+    ...     scan(pairs, name, 147, 0, pos, 0, 0, end=1000)
+    >>> sorted(pairs), pairs.restored
+    (['a', 'b', 'c', 'd', 'e', 'f', 'g'], 5)
+    >>> all([read.flag for read in pairs[name]] == [99, 147] for name in pairs)
+    True
+    >>> pairs.close()
+    >>> template.close()
+    """
+
+    def __init__(self, template, max_pending=None, spill_dir=None, max_chunks=MAX_CHUNKS):
+        super().__init__(list)
+        self.template = template
+        self.max_pending = max_pending
+        self.spill_dir = spill_dir
+        self.max_chunks = max_chunks
+        self.spill_at = max_pending
+        self.tmpdir = None
+        self.chunks = []  # [(AlignmentFile, iterator, path)]
+        self.heap = []  # [(mate tid, mate start, chunk index, read)]
+        self.spilled = 0
+        self.restored = 0
+
+    def advance(self, tid, pos, end=None):
+        """Restore spilled reads whose mate is at or before scan position and spill if above memory budget. Reads are
+        only spilled if their mate is on another chromosome or at or after end (end of the region being read, None if
+        the whole chromosome is read).
+        """
+        heap = self.heap
+        if heap and (tid > heap[0][0] or (tid == heap[0][0] and pos >= heap[0][1])):
+            self._restore(tid, pos)
+
+        if self.spill_at is not None and len(self) > self.spill_at:
+            self._spill(tid, pos, end)
+
+    def _spill(self, tid, pos, end):
+        # Only reads whose mate is still ahead of the scan and outside of the current region are spilled (mates within
+        # the region are read shortly, spilling them would only write reads that are restored right away)
+        spill = []
+        for qname, reads in self.items():
+            if len(reads) == 1:
+                mate_key = (reads[0].next_reference_id, reads[0].next_reference_start)
+                if mate_key > (tid, pos) and (mate_key[0] != tid or (end is not None and mate_key[1] >= end)):
+                    spill.append((mate_key, qname))
+        spill.sort()
+
+        if spill:
+            reads = [self.pop(qname)[0] for mate_key, qname in spill]
+            self.spilled += len(spill)
+
+            # Too many open chunks, merge remaining reads of open chunks (sorted by mate position) with spilled reads
+            merged = self.heap if len(self.heap) >= self.max_chunks else []
+            if merged:
+                reads = heapq.merge(reads, *[chain([read], self.chunks[index][1]) for _, _, index, read in merged],
+                                    key=lambda read: (read.next_reference_id, read.next_reference_start))
+
+            if self.tmpdir is None:
+                self.tmpdir = tempfile.mkdtemp(prefix='pending_pairs.', dir=self.spill_dir)
+            path = os.path.join(self.tmpdir, 'chunk{}.bam'.format(len(self.chunks)))
+
+            with pysam.AlignmentFile(path, 'wb', template=self.template) as chunk:
+                for read in reads:
+                    chunk.write(read)
+
+            if merged:
+                for _, _, index, _ in merged:
+                    chunk, _, chunk_path = self.chunks[index]
+                    chunk.close()
+                    os.remove(chunk_path)
+                self.heap = []
+
+            chunk = pysam.AlignmentFile(path, 'rb', check_sq=False)
+            self.chunks.append((chunk, chunk.fetch(until_eof=True), path))
+            self._next(len(self.chunks) - 1)
+
+        # Reads that could not be spilled stay in memory, spill again once pending reads have doubled
+        self.spill_at = max(self.max_pending, 2 * len(self))
+
+    def _next(self, index):
+        # Push next read of chunk onto merge heap (close chunk once exhausted)
+        chunk, reads, path = self.chunks[index]
+        read = next(reads, None)
+        if read is None:
+            chunk.close()
+            os.remove(path)
+        else:
+            heapq.heappush(self.heap, (read.next_reference_id, read.next_reference_start, index, read))
+
+    def _restore(self, tid=None, pos=None):
+        heap = self.heap
+        while heap and (tid is None or heap[0][0] < tid or (heap[0][0] == tid and heap[0][1] <= pos)):
+            mate_tid, mate_pos, index, read = heapq.heappop(heap)
+            self[read.query_name].insert(0, read)
+            self.restored += 1
+            self._next(index)
+
+    def drain(self):
+        """Restore all spilled reads (e.g. to write out reads whose mate was never found)."""
+        self._restore()
+
+    def close(self):
+        """Remove temporary files."""
+        self.heap = []
+        for chunk, reads, path in self.chunks:
+            if chunk.is_open:
+                chunk.close()
+        self.chunks = []
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
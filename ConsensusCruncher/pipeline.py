@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                          Pipeline
+#
+###############################################################
+# Function:
+# Run the stages of consensus making concurrently (producer/consumer) instead of one region at a time:
+#
+#    reader thread  -> [bounded queue] -> consensus (main thread + worker pool) -> [bounded queue] -> writer thread
+#
+# - Reader: decodes the BAM and groups reads into families (read_bam) in windows of reads, handing over families as
+#   soon as they are complete
+# - Consensus: collapses families, in worker processes if a pool is used (see shm_transport.py)
+# - Writer: serializes and compresses reads to the output BAM files (pysam releases the GIL while writing)
+#
+# Bounded queues provide backpressure, so a slow stage holds at most PIPELINE_QUEUE batches of the stage before it in
+# memory. This keeps all cores busy when the input can't be divided into many regions (single large contig, amplicon
+# panel, no bedfile).
+#
+# Prefetch:
+# For the region by region loops (--prefetch), a background thread fetches and decodes the reads of the next region
+# while the current one is collapsed, hiding BGZF decompression (and network storage) latency. The prefetch thread
+# uses its own handle of the BAM file, as pysam file handles can't be shared between threads. Reads are handed over in
+# windows, so at most PREFETCH_WINDOWS windows are decoded ahead however large a region is (e.g. the whole genome
+# without bedfile).
+#
+# Multiple inputs:
+# Position-sorted BAM files (e.g. SSCS + corrected singletons) are read as one file through an in-process k-way heap
+# merge (merge_reads), instead of being merged and re-sorted on disk first.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import heapq
+import queue
+import sys
+import threading
+
+from consensus_helper import open_alignment
+
+PIPELINE_QUEUE = 4  # Batches waiting between two pipeline stages
+PREFETCH_WINDOWS = 4  # Windows of reads fetched ahead of the reads being grouped (--prefetch)
+WINDOW_READS = 100000  # Reads grouped by the reader before complete families are handed over
+
+_DONE = object()  # End of queue marker
+_REGION_END = object()  # End of region marker (prefetch_regions)
+
+
+###############################
+#          Functions          #
+###############################
+def threaded(iterable, maxsize=PIPELINE_QUEUE):
+    """(iterable, int) -> generator
+    Yield items of iterable, produced ahead by a background thread. At most maxsize items are produced ahead of the
+    consumer. Exceptions raised by the producer are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize)
+    error = []
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put(item)
+        except BaseException as e:
+            error.append(e)
+        finally:
+            items.put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        # Unblock producer waiting on a full queue if the consumer stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    if error:
+        raise error[0]
+
+
+def windows(reads, window_reads=WINDOW_READS):
+    """(iterable, int) -> generator
+    Yield lists of ~window_reads position-sorted reads. Windows are extended so reads starting at the same position
+    are never split, i.e. reads of the next window start after the last read of the current one.
+    """
+    window = []
+    for read in reads:
+        if len(window) >= window_reads and \
+                (read.reference_id, read.reference_start) != (window[-1].reference_id, window[-1].reference_start):
+            yield window
+            window = []
+        window.append(read)
+
+    if window:
+        yield window
+
+
+def position(read):
+    """(pysam.AlignedSegment) -> tuple
+    Return position sort key of read (samtools sort order, reads without reference last).
+    """
+    return (read.reference_id if read.reference_id >= 0 else sys.maxsize, read.reference_start)
+
+
+def merge_reads(iterables):
+    """(list) -> iterator
+    Return iterator over reads of position-sorted iterables in position order (k-way heap merge, nothing is re-sorted).
+    """
+    if len(iterables) == 1:
+        return iter(iterables[0])
+    return heapq.merge(*iterables, key=position)
+
+
+def fetch_region(bamfile, division_coor, x):
+    """(pysam.AlignmentFile, dict, str) -> iterator
+    Return iterator over reads of region x of division coordinates, i.e. the reads read_bam would fetch (all reads if
+    division_coor is [1], otherwise reads starting within half-open region).
+    """
+    if division_coor == [1]:
+        return bamfile.fetch(until_eof=True)
+
+    read_chr = x.rsplit('_', 1)[0]
+    read_start = division_coor[x][0]
+    read_end = division_coor[x][1]
+    # pysam fetch retrieves reads overlapping region, only keep reads starting within region
+    return (line for line in bamfile.fetch(read_chr, read_start, read_end)
+            if read_start <= line.reference_start < read_end)
+
+
+def fetch_merged(bamfiles, division_coor, x):
+    """(list, dict, str) -> iterator
+    Return iterator over reads of region x of several position-sorted BAM files (see fetch_region) in position order.
+    """
+    return merge_reads([fetch_region(bamfile, division_coor, x) for bamfile in bamfiles])
+
+
+def prefetch_regions(bam, division_coor, maxsize=PREFETCH_WINDOWS, reference=None):
+    """(str or list, dict, int, str) -> generator
+    Yield iterator over reads of each region of division coordinates (in order, see fetch_region), fetched and decoded
+    ahead by a background thread with its own handle of bam (or of each of a list of BAM files, see fetch_merged).
+    At most maxsize windows of reads (see windows) are held ahead of the consumer, which may already be windows of the
+    next region. CRAM files are decoded against reference. Pass to read_bam as reads.
+
+    Reads of a region that were not consumed are skipped once the iterator of the next region is requested.
+    """
+    bams = [bam] if isinstance(bam, str) else bam
+
+    def fetch():
+        bamfiles = [open_alignment(b, "rb", reference) for b in bams]
+        try:
+            for x in division_coor:
+                yield from windows(fetch_merged(bamfiles, division_coor, x))
+                yield _REGION_END
+        finally:
+            for bamfile in bamfiles:
+                bamfile.close()
+
+    items = threaded(fetch(), maxsize)
+
+    def region():
+        for item in items:
+            if item is _REGION_END:
+                return
+            yield from item
+
+    for x in division_coor:
+        reads = region()
+        yield reads
+        for read in reads:
+            pass
+
+
+###############################
+#           Writer            #
+###############################
+class Writer:
+    """Write batches of reads to BAM files in a background thread.
+
+    write() blocks once maxsize batches are waiting. Exceptions raised while writing are re-raised by the next write()
+    or close().
+    """
+
+    def __init__(self, maxsize=PIPELINE_QUEUE):
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+            # Keep emptying the queue after an error so write() never blocks
+            if self.error is None:
+                bam, reads = item
+                try:
+                    for read in reads:
+                        bam.write(read)
+                except BaseException as e:
+                    self.error = e
+
+    def write(self, bam, reads):
+        """Queue reads to be written to bam."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((bam, reads))
+
+    def close(self):
+        """Wait for all queued reads to be written."""
+        self.queue.put(_DONE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
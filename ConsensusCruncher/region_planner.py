@@ -0,0 +1,725 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                       Region Planner
+#
+###############################################################
+# Function:
+# Divide a coordinate-sorted BAM file into regions of roughly equal read count for consensus making, instead of
+# relying on a fixed (genome specific) cytoband bedfile.
+#
+# - Per-contig mapped/unmapped read counts are taken from the BAM index (pseudo-bin of each reference)
+# - Read density along each contig is estimated from the linear index (file offset of the first read in every 16 kb
+#   window), so no reads need to be decoded to plan regions
+# - Contigs without any reads are skipped entirely
+# - Region boundaries are moved to the nearest position that no read pair spans (i.e. read and mate start on the same
+#   side of the boundary), so pairs are completed within a single region
+# - Regions are half-open (0-based start, exclusive end as in BED files): a read starting exactly at a boundary belongs
+#   to the region starting there only
+#
+# CRAM files are planned from their CRAI index instead: the reference span and file offset of every slice give the
+# read density (reads estimated at CRAM_SLICE_READS per slice), so CRAM input doesn't need to be converted to BAM.
+#
+# The plan is cached next to the BAM file as "<bam>.regions.bed" (same format as the cytoband files, see
+# bed_separator) and reused as long as the BAM index is older than the plan.
+#
+# Targeted panels:
+# Capture intervals (--targets panel.bed and/or --regions chr:start-end) are padded, merged and processed as regions,
+# so only targeted loci are fetched. Reads outside of the targets are not grouped; SSCS_maker passes them straight
+# through to the bad read BAM.
+#
+# Memory budget:
+# With --max-region-reads N and/or --max-memory MB, regions (from any bedfile, plan or targets) that the BAM index
+# estimates to hold more reads than the budget are recursively split at positions that no read pair spans before
+# fetching, so a hotspot within a region does not blow up the number of reads held in memory at once.
+#
+# Usage:
+# --bedfile auto [--region-reads N] for SSCS_maker.py, DCS_maker.py and singleton_correction.py
+# --targets panel.bed | --regions chr:start-end [chr:start-end ...] [--padding N]
+# --max-region-reads N | --max-memory MB
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import os
+import gzip
+import struct
+import collections
+
+import pysam  # Need to install
+
+from consensus_helper import bed_separator, open_alignment
+
+# Linear index window size (16 kb) and pseudo-bin number holding per-reference read counts (BAM specification)
+LINEAR_WINDOW = 2 ** 14
+PSEUDO_BIN = 37450
+
+# Reads per CRAM slice (htslib default), used to estimate read counts from a CRAI index
+CRAM_SLICE_READS = 10000
+
+# Default number of reads per region
+REGION_READS = 500000
+
+# Default padding (bp) added to both sides of capture targets
+TARGET_PADDING = 250
+
+# Search window around a proposed boundary for a position without spanning read pairs
+CUT_SEARCH = 10000
+CUT_SEARCH_MAX = 1000000
+
+# Approximate memory (bytes) held per read while grouping families (AlignedSegment, query name and dict entries)
+READ_MEMORY = 2000
+
+
+###############################
+#          Functions          #
+###############################
+def find_index(bam):
+    """(str) -> str
+    Return path to BAM index (.bai), or CRAM index (.crai) of a CRAM file, if present, otherwise None.
+    """
+    extension = 'crai' if bam.endswith('.cram') else 'bai'
+    for index in ['{}.{}'.format(bam, extension), '{}.{}'.format(os.path.splitext(bam)[0], extension)]:
+        if os.path.exists(index):
+            return index
+    return None
+
+
+def read_bai(index):
+    """(str) -> list
+    Return per-reference index summary parsed from BAI file.
+
+    Each reference is described by a dict:
+        - mapped: number of mapped reads (from pseudo-bin, 0 if absent)
+        - unmapped: number of placed unmapped reads (from pseudo-bin, 0 if absent)
+        - end_offset: compressed file offset of the end of the reference's reads
+        - offsets: compressed file offset of the first read overlapping each 16 kb window (linear index)
+    """
+    with open(index, 'rb') as f:
+        data = f.read()
+
+    if data[:4] != b'BAI\1':
+        raise ValueError("Not a BAI index: {}".format(index))
+
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    pos = 8
+    refs = []
+
+    for _ in range(n_ref):
+        ref = {'mapped': 0, 'unmapped': 0, 'end_offset': None, 'offsets': []}
+        n_bin = struct.unpack_from('<i', data, pos)[0]
+        pos += 4
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+            if bin_id == PSEUDO_BIN and n_chunk == 2:
+                ref_beg, ref_end, mapped, unmapped = struct.unpack_from('<4Q', data, pos)
+                ref['end_offset'] = ref_end >> 16
+                ref['mapped'] = mapped
+                ref['unmapped'] = unmapped
+            pos += 16 * n_chunk
+
+        n_intv = struct.unpack_from('<i', data, pos)[0]
+        pos += 4
+        ioffsets = struct.unpack_from('<{}Q'.format(n_intv), data, pos)
+        pos += 8 * n_intv
+
+        # Compressed offsets, filling empty leading windows and keeping offsets non-decreasing
+        offsets = [i >> 16 for i in ioffsets]
+        first = next((i for i in offsets if i != 0), 0)
+        last = 0
+        for i in range(len(offsets)):
+            last = max(last, offsets[i] if offsets[i] != 0 else first)
+            offsets[i] = last
+        ref['offsets'] = offsets
+
+        refs.append(ref)
+
+    return refs
+
+
+def read_crai(index, n_ref):
+    """(str, int) -> list
+    Return per-reference index summary (see read_bai) estimated from CRAI file of a CRAM file with n_ref references.
+
+    CRAI lists the reference span and file offset of every slice: read counts are estimated as CRAM_SLICE_READS per
+    slice, and the offset of the first slice overlapping each 16 kb window stands in for the linear index.
+    """
+    refs = [{'mapped': 0, 'unmapped': 0, 'end_offset': None, 'offsets': []} for _ in range(n_ref)]
+
+    with gzip.open(index, 'rt') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 6:
+                continue
+            ref_id, start, span, container, slice_offset, slice_size = (int(i) for i in fields[:6])
+            # Skip unplaced (-1) and multi-reference (-2) slices
+            if not 0 <= ref_id < n_ref:
+                continue
+
+            ref = refs[ref_id]
+            offset = container + slice_offset
+            ref['mapped'] += CRAM_SLICE_READS
+            ref['end_offset'] = max(ref['end_offset'] or 0, offset + slice_size)
+
+            # Slice start is 1-based
+            first = max(0, start - 1) // LINEAR_WINDOW
+            last = max(0, start + span - 2) // LINEAR_WINDOW
+            offsets = ref['offsets']
+            offsets += [None] * (last + 1 - len(offsets))
+            for i in range(first, last + 1):
+                if offsets[i] is None or offset < offsets[i]:
+                    offsets[i] = offset
+
+    # Fill windows without slices and keep offsets non-decreasing (as in read_bai)
+    for ref in refs:
+        offsets = ref['offsets']
+        first = next((i for i in offsets if i is not None), 0)
+        last = 0
+        for i in range(len(offsets)):
+            last = max(last, offsets[i] if offsets[i] is not None else first)
+            offsets[i] = last
+
+    return refs
+
+
+def read_index(index, n_ref):
+    """(str, int) -> list
+    Return per-reference index summary of BAI or CRAI file (see read_bai and read_crai).
+    """
+    if index.endswith('.crai'):
+        return read_crai(index, n_ref)
+    return read_bai(index)
+
+
+def contig_reads(bamfile):
+    """(pysam.AlignmentFile) -> dict
+    Return number of reads (mapped + placed unmapped) of each contig from the BAM index statistics, or estimated from
+    the CRAI index of a CRAM file (which holds no read counts).
+    """
+    if bamfile.is_cram:
+        index = find_index(bamfile.filename.decode())
+        refs = read_crai(index, len(bamfile.references)) if index is not None else []
+        return {contig: ref['mapped'] + ref['unmapped'] for contig, ref in zip(bamfile.references, refs)}
+    return {i.contig: i.mapped + i.unmapped for i in bamfile.get_index_statistics()}
+
+
+def window_weights(ref, contig_length):
+    """(dict, int) -> list
+    Return estimated number of reads starting in each 16 kb window of a reference.
+
+    Compressed bytes between consecutive linear index offsets are used as a proxy for read density and scaled so the
+    windows add up to the number of reads (mapped + placed unmapped) on the reference.
+    """
+    n_windows = max(1, -(-contig_length // LINEAR_WINDOW))
+    offsets = ref['offsets'][:n_windows]
+    total_reads = ref['mapped'] + ref['unmapped']
+
+    if not offsets or total_reads == 0:
+        return [total_reads / n_windows] * n_windows
+
+    end_offset = ref['end_offset'] if ref['end_offset'] is not None else offsets[-1]
+    sizes = [max(0, offsets[i + 1] - offsets[i]) for i in range(len(offsets) - 1)]
+    sizes.append(max(0, end_offset - offsets[-1]))
+    sizes += [0] * (n_windows - len(sizes))
+
+    total_size = sum(sizes)
+    if total_size == 0:
+        return [total_reads / n_windows] * n_windows
+
+    return [total_reads * size / total_size for size in sizes]
+
+
+def spanned(bamfile, contig, lo, hi):
+    """(pysam.AlignmentFile, str, int, int) -> list
+    Return sorted list of (start, end) intervals spanned by read pairs with a read starting between lo and hi.
+
+    A pair spans a position p if its read and mate start on opposite sides of p (start < p <= mate start), i.e. in
+    different half-open regions [.., p) and [p, ..).
+    """
+    intervals = []
+    for read in bamfile.fetch(contig, max(0, lo), hi):
+        if read.is_unmapped or read.mate_is_unmapped or read.reference_id != read.next_reference_id:
+            continue
+        start = min(read.reference_start, read.next_reference_start)
+        end = max(read.reference_start, read.next_reference_start)
+        if end > start:
+            intervals.append((start, end))
+    intervals.sort()
+    return intervals
+
+
+def safe_cut(bamfile, contig, position, contig_length):
+    """(pysam.AlignmentFile, str, int, int) -> int
+    Return the position closest to proposed boundary that no read pair spans.
+
+    The search window is widened until a free position is found (up to CUT_SEARCH_MAX), otherwise the proposed
+    position is returned.
+    """
+    search = CUT_SEARCH
+    while search <= CUT_SEARCH_MAX:
+        lo = max(1, position - search)
+        hi = min(contig_length - 1, position + search)
+        if hi <= lo:
+            break
+
+        # Merge spanned intervals (p is spanned if start < p <= end) and collect free gaps within [lo, hi]
+        free = []
+        cursor = lo
+        for start, end in spanned(bamfile, contig, lo, hi):
+            if start >= cursor:
+                free.append((cursor, min(start, hi)))
+            cursor = max(cursor, end + 1)
+            if cursor > hi:
+                break
+        if cursor <= hi:
+            free.append((cursor, hi))
+
+        if free:
+            # Closest free position to proposed boundary
+            return min((min(max(position, a), b) for a, b in free), key=lambda p: abs(p - position))
+
+        search *= 4
+
+    return position
+
+
+def cut_contig(bamfile, contig, contig_length, weights, region_reads, start=0, end=None):
+    """(pysam.AlignmentFile, str, int, list, int, int, int) -> list
+    Return list of (start, end) regions dividing contig (or part of it) into chunks of ~region_reads reads.
+    """
+    if end is None:
+        end = contig_length
+
+    regions = []
+    region_start = start
+    count = 0
+    first_window = start // LINEAR_WINDOW
+    last_window = -(-end // LINEAR_WINDOW)
+
+    for window in range(first_window, min(last_window, len(weights))):
+        count += weights[window]
+        window_end = min(end, (window + 1) * LINEAR_WINDOW)
+
+        if count >= region_reads and window_end < end:
+            cut = safe_cut(bamfile, contig, window_end, contig_length)
+            if region_start < cut < end:
+                regions.append((region_start, cut))
+                region_start = cut
+                count = 0
+
+    regions.append((region_start, end))
+    return regions
+
+
+def plan_regions(bam, region_reads=REGION_READS, reference=None):
+    """(str, int, str) -> list
+    Return list of (contig, start, end) regions of roughly equal read count based on BAM index and header. CRAM files
+    are decoded against reference to find safe region boundaries.
+
+    Test cases (regions are half-open, so every read is fetched by exactly one region together with its mate, also
+    reads starting exactly at a boundary):
+    >>> import tempfile
+    >>> from pipeline import fetch_region
+    >>> bam = os.path.join(tempfile.mkdtemp(), 'pairs.bam')
+    >>> header = pysam.AlignmentHeader.from_dict({'HD': {'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 100000}]})
+    >>> reads = []
+    >>> for i, start in enumerate(start for start in range(0, 99000, 20) if start % 1000 < 800):
+    ...     for flag, pos, mate in [(99, start, start + 100), (147, start + 100, start)]:
+    ...         read = pysam.AlignedSegment(header)
+    ...         read.query_name, read.flag, read.cigarstring, read.query_sequence = str(i), flag, '50M', 'A' * 50
+    ...         read.reference_id = read.next_reference_id = 0
+    ...         read.reference_start, read.next_reference_start = pos, mate
+    ...         reads.append(read)
+    >>> with pysam.AlignmentFile(bam, 'wb', header=header) as f:
+    ...     for read in sorted(reads, key=lambda read: read.reference_start):
+    ...         _ = f.write(read)
+    >>> _ = pysam.index(bam)
+    >>> regions = plan_regions(bam, region_reads=1000)
+    >>> coor = collections.OrderedDict(('{}_r{}'.format(c, i), (s, e)) for i, (c, s, e) in enumerate(regions))
+    >>> bamfile = pysam.AlignmentFile(bam)
+    >>> fetched = collections.defaultdict(list)
+    >>> for x in coor:
+    ...     for read in fetch_region(bamfile, coor, x):
+    ...         fetched[read.query_name].append(x)
+    >>> any(end in {read.reference_start for read in reads} for contig, start, end in regions)
+    True
+    >>> len(regions) > 1, len(fetched) * 2 == len(reads), all(a == b for a, b in fetched.values())
+    (True, True, True)
+    >>> bamfile.close()
+    """
+    bamfile = open_alignment(bam, "rb", reference)
+    index = find_index(bam)
+    refs = read_index(index, len(bamfile.references)) if index is not None else None
+    # Without a BAI (e.g. CSI index) fall back to uniform density from index statistics
+    stats = {i.contig: i for i in bamfile.get_index_statistics()} if refs is None else {}
+
+    regions = []
+    for tid, contig in enumerate(bamfile.references):
+        contig_length = bamfile.lengths[tid]
+
+        if refs is not None and tid < len(refs):
+            ref = refs[tid]
+        else:
+            ref = {'mapped': stats[contig].mapped if contig in stats else 0,
+                   'unmapped': stats[contig].unmapped if contig in stats else 0,
+                   'end_offset': None,
+                   'offsets': []}
+
+        # Skip contigs without reads
+        if ref['mapped'] + ref['unmapped'] == 0:
+            continue
+
+        weights = window_weights(ref, contig_length)
+        for start, end in cut_contig(bamfile, contig, contig_length, weights, region_reads):
+            regions.append((contig, start, end))
+
+    bamfile.close()
+    return regions
+
+
+def write_plan(regions, plan_file, region_reads):
+    """(list, str, int) -> None
+    Write region plan in cytoband bedfile format (chr, start, end, region name).
+    """
+    with open(plan_file, 'w') as f:
+        f.write('# region_reads={}\n'.format(region_reads))
+        for i, (contig, start, end) in enumerate(regions):
+            f.write('{}\t{}\t{}\tr{}\n'.format(contig, start, end, i))
+
+
+def cached_plan(bam, region_reads=REGION_READS, reference=None):
+    """(str, int, str) -> str
+    Return path to region plan of BAM file, creating (or refreshing) the cached plan next to the BAM if needed.
+
+    If the BAM directory is not writable, the plan is written to the current working directory instead.
+    """
+    plan_file = '{}.regions.bed'.format(bam)
+    if not os.access(os.path.dirname(os.path.abspath(bam)), os.W_OK):
+        plan_file = os.path.basename(plan_file)
+
+    index = find_index(bam)
+    source_mtime = max(os.path.getmtime(i) for i in [bam, index] if i is not None)
+
+    if os.path.exists(plan_file) and os.path.getmtime(plan_file) >= source_mtime:
+        with open(plan_file) as f:
+            if f.readline().strip() == '# region_reads={}'.format(region_reads):
+                return plan_file
+
+    write_plan(plan_regions(bam, region_reads, reference), plan_file, region_reads)
+    return plan_file
+
+
+def parse_region(region):
+    """(str) -> tuple
+    Return (contig, start, end) 0-based half-open interval from samtools style region (1-based, inclusive).
+
+    >>> parse_region('chr7:55241614-55241736')
+    ('chr7', 55241613, 55241736)
+    >>> parse_region('chr7')
+    ('chr7', 0, None)
+    """
+    if ':' not in region:
+        return region, 0, None
+
+    contig, coor = region.rsplit(':', 1)
+    start, end = coor.replace(',', '').split('-')
+    return contig, int(start) - 1, int(end)
+
+
+def read_targets(targets):
+    """(str) -> list
+    Return list of (contig, start, end) intervals from (capture panel) BED file.
+    """
+    intervals = []
+    with open(targets) as f:
+        for line in f:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            intervals.append((fields[0], int(fields[1]), int(fields[2])))
+    return intervals
+
+
+def merge_targets(intervals, contigs, padding=TARGET_PADDING):
+    """(list, dict, int) -> list
+    Return padded and merged intervals sorted by contig order of the BAM header.
+
+    - intervals: (contig, start, end) intervals (end None = end of contig)
+    - contigs: dictionary of contig lengths in BAM header order {contig: length}
+    - padding: bp added to both sides of each interval (intervals within 2x padding are merged)
+    """
+    order = {contig: i for i, contig in enumerate(contigs)}
+
+    padded = []
+    for contig, start, end in intervals:
+        if contig not in order:
+            print('Target contig {} not found in BAM header, skipping'.format(contig))
+            continue
+        length = contigs[contig]
+        end = length if end is None else end
+        padded.append((order[contig], max(0, start - padding), min(length, end + padding), contig))
+    padded.sort()
+
+    merged = []
+    for tid, start, end, contig in padded:
+        if merged and merged[-1][0] == contig and start <= merged[-1][2]:
+            merged[-1] = (contig, merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((contig, start, end))
+
+    return merged
+
+
+def target_coordinates(bam, targets=None, regions=None, padding=TARGET_PADDING):
+    """(str, str, list, int) -> dict
+    Return padded and merged capture intervals as division coordinates (same format as bed_separator).
+    """
+    bamfile = open_alignment(bam, "rb")
+    contigs = collections.OrderedDict(zip(bamfile.references, bamfile.lengths))
+    bamfile.close()
+
+    intervals = []
+    if targets is not None:
+        intervals += read_targets(targets)
+    if regions is not None:
+        intervals += [parse_region(region) for region in regions]
+
+    coor = collections.OrderedDict()
+    for i, (contig, start, end) in enumerate(merge_targets(intervals, contigs, padding)):
+        coor['{}_target{}'.format(contig, i)] = (start, end)
+
+    return coor
+
+
+def offtarget_coordinates(bamfile, division_coor):
+    """(pysam.AlignmentFile, dict) -> list
+    Return list of half-open (contig, start, end) intervals not covered by division coordinates on contigs containing
+    reads. Regions are half-open as well, so a gap starts at the end of the region before it.
+    """
+    covered = collections.defaultdict(list)
+    for x in division_coor:
+        covered[x.rsplit('_', 1)[0]].append(division_coor[x])
+
+    stats = contig_reads(bamfile)
+
+    gaps = []
+    for contig, length in zip(bamfile.references, bamfile.lengths):
+        if stats.get(contig, 0) == 0:
+            continue
+        cursor = 0
+        for start, end in sorted(covered[contig]):
+            if start > cursor:
+                gaps.append((contig, cursor, start))
+            cursor = max(cursor, end)
+        if cursor < length:
+            gaps.append((contig, cursor, length))
+
+    return gaps
+
+
+def write_offtarget(bamfile, outbam, gaps):
+    """(pysam.AlignmentFile, pysam.AlignmentFile, list) -> int
+    Write reads starting outside of the targets to outbam without grouping, return number of reads written.
+
+    Test cases (a read starting at the end of a target is off-target only, the one before it on-target only):
+    >>> import tempfile
+    >>> from pipeline import fetch_region
+    >>> bam = os.path.join(tempfile.mkdtemp(), 'reads.bam')
+    >>> header = pysam.AlignmentHeader.from_dict({'HD': {'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}]})
+    >>> with pysam.AlignmentFile(bam, 'wb', header=header) as f:
+    ...     for start in [50, 100, 199, 200, 500]:
+    ...         read = pysam.AlignedSegment(header)
+    ...         read.query_name, read.flag, read.cigarstring, read.query_sequence = str(start), 0, '10M', 'A' * 10
+    ...         read.reference_id, read.reference_start = 0, start
+    ...         _ = f.write(read)
+    >>> _ = pysam.index(bam)
+    >>> bamfile = pysam.AlignmentFile(bam)
+    >>> coor = {'chr1_target0': (100, 200)}
+    >>> class Reads(list):
+    ...     write = list.append
+    >>> offtarget = Reads()
+    >>> write_offtarget(bamfile, offtarget, offtarget_coordinates(bamfile, coor))
+    3
+    >>> [read.reference_start for read in fetch_region(bamfile, coor, 'chr1_target0')]
+    [100, 199]
+    >>> [read.reference_start for read in offtarget]
+    [50, 200, 500]
+    >>> bamfile.close()
+    """
+    count = 0
+    for contig, start, end in gaps:
+        for read in bamfile.fetch(contig, start, end):
+            # Reads overlapping a gap but starting within a target were already processed
+            if start <= read.reference_start < end:
+                outbam.write(read)
+                count += 1
+    return count
+
+
+def region_budget(max_region_reads=None, max_memory=None):
+    """(int, int) -> int
+    Return maximum number of reads per region from read and/or memory (MB) budget (None if no budget given).
+
+    >>> region_budget(1000000, 100)
+    50000
+    >>> region_budget() is None
+    True
+    """
+    budgets = []
+    if max_region_reads is not None:
+        budgets.append(max_region_reads)
+    if max_memory is not None:
+        budgets.append(max_memory * 1000000 // READ_MEMORY)
+
+    return min(budgets) if budgets else None
+
+
+def estimate_reads(weights, start, end):
+    """(list, int, int) -> float
+    Return estimated number of reads starting between start and end from 16 kb window weights.
+    """
+    total = 0
+    for window in range(start // LINEAR_WINDOW, min(len(weights), -(-end // LINEAR_WINDOW))):
+        lo = max(start, window * LINEAR_WINDOW)
+        hi = min(end, (window + 1) * LINEAR_WINDOW)
+        total += weights[window] * (hi - lo) / LINEAR_WINDOW
+    return total
+
+
+def weighted_midpoint(weights, start, end):
+    """(list, int, int) -> int
+    Return position dividing estimated reads between start and end in half.
+    """
+    half = estimate_reads(weights, start, end) / 2
+    count = 0
+    for window in range(start // LINEAR_WINDOW, min(len(weights), -(-end // LINEAR_WINDOW))):
+        lo = max(start, window * LINEAR_WINDOW)
+        hi = min(end, (window + 1) * LINEAR_WINDOW)
+        window_reads = weights[window] * (hi - lo) / LINEAR_WINDOW
+        if window_reads > 0 and count + window_reads >= half:
+            # Assume uniform density within window
+            return lo + int((half - count) / window_reads * (hi - lo))
+        count += window_reads
+
+    return (start + end) // 2
+
+
+def split_region(bamfile, contig, contig_length, weights, start, end, max_reads):
+    """(pysam.AlignmentFile, str, int, list, int, int, int) -> list
+    Return list of half-open (start, end) intervals recursively splitting region until each holds at most max_reads
+    (estimated) reads, cutting at positions no read pair spans (see safe_cut). Adjacent intervals share their boundary
+    position, which belongs to the second interval only.
+    """
+    if end - start < 2 or estimate_reads(weights, start, end) <= max_reads:
+        return [(start, end)]
+
+    cut = safe_cut(bamfile, contig, weighted_midpoint(weights, start, end), contig_length)
+    # No position within region to cut at (e.g. all reads start at the same position)
+    if not start < cut < end:
+        return [(start, end)]
+
+    return split_region(bamfile, contig, contig_length, weights, start, cut, max_reads) + \
+        split_region(bamfile, contig, contig_length, weights, cut, end, max_reads)
+
+
+def budget_coordinates(bam, division_coor, max_reads, reference=None):
+    """(str, dict, int, str) -> dict
+    Return division coordinates with regions estimated (from BAM index) to hold more than max_reads reads split into
+    smaller regions. Split regions are named '<region>-<i>'.
+
+    Test cases (split regions are half-open like their parent, every read is fetched once together with its mate):
+    >>> import tempfile
+    >>> from pipeline import fetch_region
+    >>> bam = os.path.join(tempfile.mkdtemp(), 'pairs.bam')
+    >>> header = pysam.AlignmentHeader.from_dict({'HD': {'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 100000}]})
+    >>> reads = []
+    >>> for i, start in enumerate(start for start in range(0, 99000, 20) if start % 1000 < 800):
+    ...     for flag, pos, mate in [(99, start, start + 100), (147, start + 100, start)]:
+    ...         read = pysam.AlignedSegment(header)
+    ...         read.query_name, read.flag, read.cigarstring, read.query_sequence = str(i), flag, '50M', 'A' * 50
+    ...         read.reference_id = read.next_reference_id = 0
+    ...         read.reference_start, read.next_reference_start = pos, mate
+    ...         reads.append(read)
+    >>> with pysam.AlignmentFile(bam, 'wb', header=header) as f:
+    ...     for read in sorted(reads, key=lambda read: read.reference_start):
+    ...         _ = f.write(read)
+    >>> _ = pysam.index(bam)
+    >>> coor = budget_coordinates(bam, collections.OrderedDict([('chr1_p', (0, 100000))]), 500)
+    >>> bamfile = pysam.AlignmentFile(bam)
+    >>> fetched = collections.defaultdict(list)
+    >>> for x in coor:
+    ...     for read in fetch_region(bamfile, coor, x):
+    ...         fetched[read.query_name].append(x)
+    >>> len(coor) > 8, len(fetched) * 2 == len(reads), all(a == b for a, b in fetched.values())
+    (True, True, True)
+    >>> bamfile.close()
+    """
+    bamfile = open_alignment(bam, "rb", reference)
+    contigs = dict(zip(bamfile.references, range(len(bamfile.references))))
+    index = find_index(bam)
+    refs = read_index(index, len(bamfile.references)) if index is not None else None
+    stats = {i.contig: i for i in bamfile.get_index_statistics()} if refs is None else {}
+
+    contig_weights = {}
+    coor = collections.OrderedDict()
+    for x in division_coor:
+        contig = x.rsplit('_', 1)[0]
+        start, end = division_coor[x]
+        if contig not in contigs:
+            coor[x] = (start, end)
+            continue
+
+        tid = contigs[contig]
+        contig_length = bamfile.lengths[tid]
+        if contig not in contig_weights:
+            if refs is not None and tid < len(refs):
+                ref = refs[tid]
+            else:
+                ref = {'mapped': stats[contig].mapped if contig in stats else 0,
+                       'unmapped': stats[contig].unmapped if contig in stats else 0,
+                       'end_offset': None,
+                       'offsets': []}
+            contig_weights[contig] = window_weights(ref, contig_length)
+
+        pieces = split_region(bamfile, contig, contig_length, contig_weights[contig], start, min(end, contig_length),
+                              max_reads)
+        if len(pieces) == 1:
+            coor[x] = (start, end)
+        else:
+            for i, piece in enumerate(pieces):
+                coor['{}-{}'.format(x, i)] = piece
+
+    bamfile.close()
+    return coor
+
+
+def division_coordinates(bam, bedfile=None, region_reads=REGION_READS, targets=None, regions=None,
+                         padding=TARGET_PADDING, max_region_reads=None, reference=None):
+    """(str, str, int, str, list, int, int, str) -> dict or list
+    Return coordinates to divide BAM file into regions for consensus making.
+
+    - targets/regions: padded and merged capture intervals only (see target_coordinates)
+    - bedfile None: no division ([1], the whole file is processed at once)
+    - bedfile 'auto': balanced regions planned from the BAM index (see plan_regions)
+    - otherwise: regions of the given bedfile (e.g. cytoband)
+
+    With max_region_reads, regions above the budget are split further (see budget_coordinates). CRAM files are decoded
+    against reference.
+    """
+    if targets is not None or regions is not None:
+        coor = target_coordinates(bam, targets, regions, padding)
+    elif bedfile is None:
+        return [1]
+    elif bedfile == 'auto':
+        coor = bed_separator(cached_plan(bam, region_reads, reference))
+    else:
+        coor = bed_separator(bedfile)
+
+    if max_region_reads is not None:
+        coor = budget_coordinates(bam, coor, max_region_reads, reference)
+
+    return coor
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                           Report
+#
+###############################################################
+# Function:
+# Format and plot raw count files written by the core stages. Heavy modules (pandas, matplotlib) are only imported
+# here, when a report is made, so extract_barcodes.py and the consensus stages start quickly.
+#
+# Usage:
+# python3 report.py --input FILE [FILE ...]
+#
+# Arguments:
+# --input FILE      Raw count files, report type is determined by file name:
+#                     - "<sample>.read_families.txt" (SSCS_maker.py)     -> "<sample>_tag_fam_size.png"
+#                     - "<sample>_barcode_counts.txt" (extract_barcodes.py) -> "<sample>_barcode_stats.png" (barcode
+#                       list only) and barcode frequency tables "<sample>_barcode_table.txt"
+#
+# Outputs are overwritten, so reports can be regenerated (e.g. with the 'report' mode of ConsensusCruncher.py).
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import os
+import math
+from argparse import ArgumentParser
+
+
+###############################
+#          Functions          #
+###############################
+def plot_backend():
+    """() -> module
+    Return matplotlib.pyplot, using non-interactive Agg backend if no display is found.
+    """
+    import matplotlib as mpl
+    if os.environ.get('DISPLAY', '') == '':
+        mpl.use('Agg')
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def family_size_report(read_families, plot_file):
+    """(str, str) -> None
+    Plot tag family size distribution (x-axis: family size, y-axis: fraction of reads) from read families file.
+    """
+    plt = plot_backend()
+
+    fam_size = []
+    frequency = []
+    with open(read_families) as f:
+        next(f)  # header
+        for line in f:
+            if not line.strip():
+                continue
+            size, freq = line.split('\t')
+            fam_size.append(int(size))
+            frequency.append(int(freq))
+
+    if not fam_size:
+        return
+
+    # Read fraction = family size * frequency of family / total reads
+    total_reads = sum(i * j for i, j in zip(fam_size, frequency))
+    read_fraction = [(i * j) / total_reads for i, j in zip(fam_size, frequency)]
+
+    plt.figure()
+    plt.bar(fam_size, read_fraction)
+    # Determine read family size range to standardize plot axis
+    plt.xlim([0, math.ceil(max(fam_size) / 10) * 10])
+    plt.savefig(plot_file)
+    plt.close()
+
+
+def barcode_report(barcode_counts, table_file, plot_file):
+    """(str, str, str) -> None
+    Write barcode frequency tables to table file and plot barcode frequency (barcode list only).
+    """
+    import pandas as pd
+
+    counts = pd.read_csv(barcode_counts, sep='\t')
+    stats = open(table_file, 'w')
+
+    # == Barcode pattern ==
+    if 'position' in counts.columns:
+        tables = []
+        for read in ['R1', 'R2']:
+            barcode_counter = counts[counts['read'] == read].drop(columns=['read', 'position'])
+            barcode_counter.index = range(len(barcode_counter.index))
+            tables.append(barcode_counter.apply(lambda x: x / x.sum(), axis=1))
+        stats.write('---BARCODE---\n{}\n-----------\n{}\n'.format(tables[0], tables[1]))
+        stats.close()
+        return
+
+    # == Barcode list ==
+    df_merge = counts
+    df_merge['Total'] = df_merge['R1_Count'] + df_merge['R2_Count']
+
+    # Order dataframe
+    df_merge = df_merge.sort_values(by="Total", ascending=False)
+
+    # Write stats to file
+    stats.write('---BARCODE---\n{}\n'.format(df_merge))
+    stats.close()
+
+    # == Create histogram for barcode stats ==
+    import numpy as np
+    plt = plot_backend()
+
+    fig, ax = plt.subplots()
+    # Set x-axis range to number of barcodes
+    ax.set_xlim(0, len(df_merge.index))
+
+    # the x locations (number of barcodes)
+    ind = np.arange(len(df_merge.index))
+    width = 0.35  # the width of the bars
+    p1 = ax.bar(ind, df_merge['R1_Count'], width, color='g')
+    p2 = ax.bar(ind + width, df_merge['R2_Count'], width, color='y')
+
+    # Label axis
+    ax.set_xticks(ind + width)
+    ax.set_xticklabels(df_merge['Barcode'])
+    for tick in ax.get_xticklabels():
+        tick.set_rotation(90)
+    # Add space to make sure x labels aren't cut off
+    plt.gcf().subplots_adjust(bottom=0.15)
+    plt.tick_params(axis='x', which='both', top=False)
+    plt.tick_params(axis='y', which='both', right=False)
+
+    # Set legends and labels
+    ax.legend((p1[0], p2[0]), ('Read1', 'Read2'))
+    ax.set_title('Barcode frequency')
+    plt.ylabel('Count')
+
+    plt.savefig(plot_file)
+    plt.close()
+
+
+def report(infile):
+    """(str) -> None
+    Create report for raw count file based on its file name.
+    """
+    if infile.endswith('.read_families.txt'):
+        family_size_report(infile, '{}_tag_fam_size.png'.format(infile.rsplit('.read_families.txt', 1)[0]))
+    elif infile.endswith('_barcode_counts.txt'):
+        outfile = infile.rsplit('_barcode_counts.txt', 1)[0]
+        barcode_report(infile, '{}_barcode_table.txt'.format(outfile), '{}_barcode_stats.png'.format(outfile))
+    else:
+        raise ValueError("Unknown report input (expected *.read_families.txt or *_barcode_counts.txt): {}".format(
+            infile))
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    # Command-line parameters
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--input",
+        action="store",
+        dest="input",
+        nargs='+',
+        help="Raw count files (*.read_families.txt and/or *_barcode_counts.txt)",
+        required=True)
+    args = parser.parse_args()
+
+    for infile in args.input:
+        report(infile)
+
+
+if __name__ == "__main__":
+    main()
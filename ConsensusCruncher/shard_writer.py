@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Shard Writer
+#
+###############################################################
+# Function:
+# Write consensus outputs into per-chromosome BAM shards, so later stages (DCS_maker.py, singleton_correction.py) can
+# start on a chromosome as soon as it is complete instead of after the whole genome (see --chrom-pipeline of
+# ConsensusCruncher.py).
+#
+# - Reads of pairs within a chromosome are written to "<shard dir>/<contig>.<output>.bam"
+# - Reads of pairs spanning chromosomes (translocations) are written to "<shard dir>/interchromosomal.<output>.bam", as
+#   they are only complete once the scan reaches their mate. This shard is sealed last.
+# - A chromosome shard is sealed (all its outputs closed) once a read of another chromosome is written, i.e. the
+#   position-sorted scan has moved on. Regions of a contig must therefore be processed contiguously, and batches of
+#   reads spanning chromosomes written contig by contig (see contig_batches of SSCS_maker.py).
+# - Sealed shards are appended to "<shard dir>/manifest.txt" (shard name and one BAM per output, tab separated),
+#   followed by a "#done" line once all shards are sealed
+#
+# Shards are unsorted, in the same way as the whole-genome outputs of the stage.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import os
+
+import pysam  # Need to install
+
+INTERCHROMOSOMAL = 'interchromosomal'
+MANIFEST = 'manifest.txt'
+MANIFEST_DONE = '#done'
+
+
+###############################
+#        Shard Writer         #
+###############################
+class ShardOutput:
+    """One output of a ShardWriter (e.g. SSCS reads), used in place of a pysam.AlignmentFile opened for writing."""
+
+    def __init__(self, shards, name):
+        self.shards = shards
+        self.name = name
+
+    def write(self, read):
+        self.shards.write(self.name, read)
+
+    def close(self):
+        """Shards are closed by ShardWriter.close()."""
+        pass
+
+
+class ShardWriter:
+    """Write outputs (e.g. ['sscs', 'singleton']) of a position-sorted scan into per-chromosome BAM shards."""
+
+    def __init__(self, shard_dir, template, outputs, mode="wb"):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.template = template
+        self.outputs = list(outputs)
+        self.mode = mode  # "wbu" for uncompressed shards
+        self.manifest = os.path.join(shard_dir, MANIFEST)
+        self.shards = {}  # {shard: {output: pysam.AlignmentFile}}
+        self.sealed = set()
+        self.current = None
+
+        open(self.manifest, 'w').close()
+
+    def output(self, name):
+        """Return writable output name."""
+        return ShardOutput(self, name)
+
+    def path(self, shard, output):
+        """Return path to BAM file of output of shard."""
+        return os.path.join(self.shard_dir, '{}.{}.bam'.format(shard, output))
+
+    def write(self, output, read):
+        if read.reference_id != read.next_reference_id:
+            shard = INTERCHROMOSOMAL
+        else:
+            shard = self.template.get_reference_name(read.reference_id)
+            if shard != self.current:
+                # Scan moved on to another chromosome
+                for contig in [s for s in self.shards if s != INTERCHROMOSOMAL]:
+                    self.seal(contig)
+                self.current = shard
+
+        if shard not in self.shards:
+            if shard in self.sealed:
+                raise ValueError("Shard of {} already sealed, regions of a contig must be processed contiguously".format(
+                    shard))
+            self.shards[shard] = {o: pysam.AlignmentFile(self.path(shard, o), self.mode, template=self.template)
+                                  for o in self.outputs}
+
+        self.shards[shard][output].write(read)
+
+    def seal(self, shard):
+        """Close BAM files of shard and add shard to manifest."""
+        for bam in self.shards.pop(shard).values():
+            bam.close()
+        self.sealed.add(shard)
+
+        # Single write per line so readers of the manifest never see a partial entry
+        with open(self.manifest, 'a') as f:
+            f.write('\t'.join([shard] + [self.path(shard, o) for o in self.outputs]) + '\n')
+
+    def close(self):
+        """Seal remaining shards (interchromosomal shard last) and mark manifest as complete."""
+        for shard in sorted(self.shards, key=lambda s: s == INTERCHROMOSOMAL):
+            self.seal(shard)
+
+        with open(self.manifest, 'a') as f:
+            f.write(MANIFEST_DONE + '\n')
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                   Shared Memory Transport
+#
+###############################################################
+# Function:
+# Pass batches of read families to consensus worker processes (and consensus records back) through
+# multiprocessing.shared_memory instead of pickling pysam objects.
+#
+# A batch of families is packed into one flat shared memory block holding concatenated sequence and quality bytes,
+# read/family offsets and per-read flag, MAPQ and TLEN. Only the block name is sent to a worker, which reads the
+# families through PackedRead proxies (views on the block) so consensus functions written for pysam reads run
+# unchanged. Consensus records are returned in a shared memory block the same way.
+#
+# Layout of a family block (arrays ordered by item size to keep them aligned):
+#    header          int64[3]            number of families, reads, bases
+#    family offsets  int64[families + 1] index of first read of each family
+#    read offsets    int64[reads + 1]    index of first base of each read
+#    tlen            int32[reads]
+#    flag            uint16[reads]
+#    mapq            uint8[reads]
+#    sequence        uint8[bases]        ASCII bases
+#    quality         uint8[bases]        Phred scores
+#
+# Layout of a consensus block:
+#    header          int64[2]            number of records, bases
+#    offsets         int64[records + 1]  index of first base of each record
+#    sequence        uint8[bases]
+#    quality         uint8[bases]
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import array
+import collections
+from multiprocessing import resource_tracker, shared_memory
+
+BATCH_FAMILIES = 1000  # Families per shared memory block sent to a worker
+
+
+###############################
+#        Packed Reads         #
+###############################
+class PackedRead:
+    """Read of a family block exposing the AlignedSegment attributes used for consensus making.
+
+    Qualities are a view on the shared memory block (no copy), sequence is decoded once per read.
+    """
+    __slots__ = ('query_sequence', 'query_qualities', 'query_length', 'flag', 'mapping_quality', 'template_length')
+
+    def __init__(self, sequence, qualities, flag, mapping_quality, template_length):
+        self.query_sequence = str(sequence, 'ascii')
+        self.query_qualities = qualities
+        self.query_length = len(qualities)
+        self.flag = flag
+        self.mapping_quality = mapping_quality
+        self.template_length = template_length
+
+    def infer_query_length(self):
+        return self.query_length
+
+
+def _layout(buf, header_size, arrays):
+    """(memoryview, int, list) -> list of memoryview
+    Return typed views of arrays [(typecode, length)] packed back to back after header of header_size int64.
+    """
+    views = []
+    offset = 8 * header_size
+    for typecode, length in arrays:
+        size = array.array(typecode).itemsize * length
+        views.append(buf[offset:offset + size].cast(typecode))
+        offset += size
+    return views
+
+
+def _block(arrays):
+    """(list) -> SharedMemory
+    Return new shared memory block holding arrays back to back.
+    """
+    size = sum(len(a) * a.itemsize for a in arrays)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    offset = 0
+    for a in arrays:
+        n = len(a) * a.itemsize
+        shm.buf[offset:offset + n] = a.tobytes()
+        offset += n
+    return shm
+
+
+def pack_families(families):
+    """(list) -> SharedMemory
+    Return shared memory block holding families (lists of reads).
+    """
+    family_offsets = array.array('q', [0])
+    read_offsets = array.array('q', [0])
+    tlen = array.array('i')
+    flag = array.array('H')
+    mapq = array.array('B')
+    sequence = bytearray()
+    quality = bytearray()
+
+    for family in families:
+        for read in family:
+            sequence += read.query_sequence.encode('ascii')
+            quality += bytes(read.query_qualities)
+            read_offsets.append(len(sequence))
+            tlen.append(read.template_length)
+            flag.append(read.flag)
+            mapq.append(read.mapping_quality)
+        family_offsets.append(len(flag))
+
+    header = array.array('q', [len(families), len(flag), len(sequence)])
+    return _block([header, family_offsets, read_offsets, tlen, flag, mapq,
+                   array.array('B', sequence), array.array('B', quality)])
+
+
+def unpack_families(buf):
+    """(memoryview) -> list of lists of PackedRead
+    Return families of family block buf. Views must be released (families deleted) before the block is closed.
+    """
+    n_families, n_reads, n_bases = buf[:24].cast('q')
+    family_offsets, read_offsets, tlen, flag, mapq, sequence, quality = _layout(
+        buf, 3, [('q', n_families + 1), ('q', n_reads + 1), ('i', n_reads), ('H', n_reads), ('B', n_reads),
+                 ('B', n_bases), ('B', n_bases)])
+
+    families = []
+    for f in range(n_families):
+        family = []
+        for r in range(family_offsets[f], family_offsets[f + 1]):
+            start, end = read_offsets[r], read_offsets[r + 1]
+            family.append(PackedRead(sequence[start:end], quality[start:end], flag[r], mapq[r], tlen[r]))
+        families.append(family)
+    return families
+
+
+def pack_consensus(records):
+    """(list) -> SharedMemory
+    Return shared memory block holding consensus records [(sequence, qualities)].
+    """
+    offsets = array.array('q', [0])
+    sequence = bytearray()
+    quality = bytearray()
+    for seq, qual in records:
+        sequence += seq.encode('ascii')
+        quality += bytes(qual)
+        offsets.append(len(sequence))
+
+    header = array.array('q', [len(records), len(sequence)])
+    return _block([header, offsets, array.array('B', sequence), array.array('B', quality)])
+
+
+def unpack_consensus(buf):
+    """(memoryview) -> list of tuples
+    Return consensus records [(sequence, qualities)] of consensus block buf (copied out of the block).
+    """
+    n_records, n_bases = buf[:16].cast('q')
+    offsets, sequence, quality = _layout(buf, 2, [('q', n_records + 1), ('B', n_bases), ('B', n_bases)])
+
+    records = [(str(sequence[offsets[i]:offsets[i + 1]], 'ascii'), list(quality[offsets[i]:offsets[i + 1]]))
+               for i in range(n_records)]
+    offsets.release()
+    sequence.release()
+    quality.release()
+    return records
+
+
+###############################
+#           Workers           #
+###############################
+def _untrack(shm):
+    """(SharedMemory) -> None
+    Stop resource tracker of worker process from unlinking block owned by parent process when the worker exits.
+    """
+    resource_tracker.unregister(shm._name, 'shared_memory')
+
+
+def consensus_worker(name, func, args, batch=False):
+    """(str, function, tuple, bool) -> str
+    Apply func(family, *args) -> (sequence, qualities) to families of family block name (run in worker process), or
+    func(families, *args) -> [(sequence, qualities)] to all families at once if batch.
+    Return name of consensus block holding the results, to be unlinked by the caller.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    _untrack(shm)
+    try:
+        families = unpack_families(shm.buf)
+        if batch:
+            records = func(families, *args)
+        else:
+            records = [func(family, *args) for family in families]
+        del families
+    except Exception as error:
+        # Frames of the traceback still hold views of the block, drop them so the block can be closed
+        error.with_traceback(None)
+        families = None
+        shm.close()
+        raise
+    shm.close()
+
+    result = pack_consensus(records)
+    _untrack(result)
+    result.close()
+    return result.name
+
+
+def _collect(pending):
+    """(deque) -> list
+    Wait for oldest batch of pending [(family block, async result)], free its blocks and return its records.
+    """
+    shm, result = pending.popleft()
+    try:
+        name = result.get()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    out = shared_memory.SharedMemory(name=name)
+    try:
+        return unpack_consensus(out.buf)
+    finally:
+        out.close()
+        out.unlink()
+
+
+def parallel_consensus(pool, processes, func, families, args=(), batch_size=BATCH_FAMILIES, in_flight=None,
+                       batch=False):
+    """(Pool, int, function, list, tuple, int, int, bool) -> generator
+    Yield func(family, *args) for each family (in order), computed by the processes workers of pool in batches of
+    batch_size families. With batch, func(families, *args) collapses a whole batch at once (e.g. batch_consensus_maker).
+
+    At most in_flight batches (default: 2 per worker) are held in shared memory at once. func must be importable by
+    the workers (module level function).
+    """
+    if in_flight is None:
+        in_flight = 2 * processes
+
+    pending = collections.deque()
+    try:
+        for i in range(0, len(families), batch_size):
+            if len(pending) >= in_flight:
+                yield from _collect(pending)
+            shm = pack_families(families[i:i + batch_size])
+            pending.append((shm, pool.apply_async(consensus_worker, (shm.name, func, args, batch))))
+
+        while pending:
+            yield from _collect(pending)
+    finally:
+        # Free blocks of batches left behind (e.g. worker error), and consensus blocks of those batches that workers
+        # already created (they are no longer tracked by the workers, see consensus_worker)
+        for shm, result in pending:
+            shm.close()
+            shm.unlink()
+            try:
+                name = result.get()
+            except Exception:
+                continue
+            out = shared_memory.SharedMemory(name=name)
+            out.close()
+            out.unlink()
@@ -17,9 +17,24 @@
 # Python3 singleton_correction.py [--singleton Singleton BAM] [--bedfile BEDFILE]
 #
 # Arguments:
-# --singleton SingletonBAM  input singleton BAM file
+# --singleton SingletonBAM  input singleton BAM (or CRAM) file, outputs follow its format
+# --reference FASTA         Reference genome the CRAM files are read and written against
 # --bedfile BEDFILE         Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt -
 #                           See bed_separator.R for making your own bed file based on specific coordinates)
+#                           Use 'auto' to plan regions of balanced read count from the BAM index (region_planner.py)
+# --region-reads N         Approximate number of reads per region for '--bedfile auto' (default: 500000)
+# --targets BED            Capture panel BED file, only padded and merged targets are processed (alternative: --regions)
+# --sscs-lookup MODE       'region' (default): load SSCSs of each region, 'index': only fetch SSCSs at the start
+#                           coordinates of complementary strands of singletons from the indexed SSCS BAM
+# --max-pending N           Spill reads waiting for distant mates to temporary BAM files above N pending reads
+# --max-region-reads N      Split regions holding more reads (estimated from BAM index) at positions no pair spans
+# --max-memory MB           Memory budget for reads of a region, regions above budget are split
+# --prefetch                Fetch and decode the next region (singletons and SSCSs) in a background thread while the
+#                           current one is corrected
+# --discard uncorrected     Only count uncorrected singletons instead of writing them to "uncorrected.bam"
+# --stats FILE              Stats file to append summary statistics to (default: "stats.txt" of SSCS_maker.py)
+# --uncompressed            Write output BAM files uncompressed (intermediates that are sorted afterwards), also for
+#                           CRAM input
 #
 # Inputs:
 # 1. A position-sorted BAM file containing paired-end single reads with barcode identifiers in the header/query name
@@ -32,7 +47,9 @@
 #    "uncorrected.bam"
 # 4. A text file containing summary statistics (Total singletons, Singleton Correction by SSCS, % Singleton Correction by SSCS,
 #    Singleton Correction by Singletons, % Singleton Correction by Singletons, Uncorrected Singletons)
-#    - "stats.txt" (Stats pended to same stats file as SSCS)
+#    - "stats.txt" (Stats pended to same stats file as SSCS, or to --stats)
+# 5. (Optional) Trace events for the stage and each genomic region (incl. reads pending mates) appended to the --trace
+#    file
 #
 # Concepts:
 #    - Read family: reads that share the same molecular barcode, chr, and start
@@ -53,11 +70,58 @@ import os
 import inspect
 
 from consensus_helper import *
+from trace_helper import Tracer, file_size
+from region_planner import *
+from pair_store import PairStore
+from pipeline import prefetch_regions
 
 
 ###############################
 #       Helper Functions      #
 ###############################
+# Complementary strand start positions closer than this (bp) are fetched in the same window
+LOOKUP_GAP = 300
+
+
+def complement_reads(sscs_bam, tags):
+    """(pysam.AlignmentFile, iterable) -> list
+    Return SSCS reads (and their mates) starting at the coordinates of the complementary strands of tags, fetched from
+    the indexed SSCS BAM.
+
+    Complementary strands share the molecule key of a tag (see unique_tag), so only SSCSs starting exactly at the read
+    and mate start of singletons can correct them. Nearby start positions are merged into windows to limit the number
+    of fetches.
+    """
+    starts = collections.defaultdict(set)
+    for molecule_key, strand in tags:
+        starts[molecule_key[1]].add(molecule_key[2])
+        starts[molecule_key[3]].add(molecule_key[4])
+
+    reads = []
+    for ref_id in sorted(starts):
+        if ref_id < 0:
+            continue
+        contig = sscs_bam.get_reference_name(ref_id)
+        positions = sorted(starts[ref_id])
+
+        windows = []
+        lo = hi = positions[0]
+        for pos in positions[1:]:
+            if pos - hi > LOOKUP_GAP:
+                windows.append((lo, hi))
+                lo = pos
+            hi = pos
+        windows.append((lo, hi))
+
+        for lo, hi in windows:
+            for read in sscs_bam.fetch(contig, lo, hi + 1):
+                # Fetch also returns reads overlapping window, only keep reads starting at wanted positions
+                if lo <= read.reference_start <= hi and read.reference_start in starts[ref_id]:
+                    reads.append(read)
+
+    return reads
+
+
 def duplex_consensus(read1, read2):
     """(pysam.calignedsegment.AlignedSegment, pysam.calignedsegment.AlignedSegment) ->
     pysam.calignedsegment.AlignedSegment
@@ -92,7 +156,7 @@ def strand_correction(
         query_name,
         singleton_dict,
         sscs_dict=None):
-    """(str, str, dict, dict) -> Pysam.AlignedSegment
+    """(tuple, tuple, str, dict, dict) -> Pysam.AlignedSegment
     Return 'corrected' singleton using complement read from opposite strand (either found in SSCS or singleton).
 
     Quality score calculated from singleton and complementary read. Read template based on singleton.
@@ -106,7 +170,8 @@ def strand_correction(
         complement_read = sscs_dict[duplex_tag][0]
 
     dcs = duplex_consensus(read, complement_read)
-    dcs_read = create_aligned_segment([read], dcs[0], dcs[1], query_name)
+    # Keep molecule aux tags of singleton (see family_tags)
+    dcs_read = create_aligned_segment([read], dcs[0], dcs[1], query_name, molecule_tags(read))
 
     return dcs_read
 
@@ -134,7 +199,108 @@ def main():
         action="store",
         dest="bedfile",
         help="Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt - \
-                        See bed_separator.R for making your own bed file based on a target panel/specific coordinates)",
+                        See bed_separator.R for making your own bed file based on a target panel/specific coordinates). \
+                        Use 'auto' to plan regions of balanced read count from the BAM index",
+        required=False)
+    parser.add_argument(
+        "--region-reads",
+        action="store",
+        dest="region_reads",
+        type=int,
+        default=REGION_READS,
+        help="Approximate number of reads per region when regions are planned with '--bedfile auto', default: {}".format(
+            REGION_READS),
+        required=False)
+    parser.add_argument(
+        "--targets",
+        action="store",
+        dest="targets",
+        help="Capture panel BED file, only (padded and merged) target intervals are processed",
+        required=False)
+    parser.add_argument(
+        "--regions",
+        action="store",
+        dest="regions",
+        nargs='+',
+        help="Regions to process (e.g. chr7:55241614-55241736), alternative to --targets",
+        required=False)
+    parser.add_argument(
+        "--padding",
+        action="store",
+        dest="padding",
+        type=int,
+        default=TARGET_PADDING,
+        help="Padding (bp) added to both sides of targets/regions, default: {}".format(TARGET_PADDING),
+        required=False)
+    parser.add_argument(
+        "--sscs-lookup",
+        action="store",
+        dest="sscs_lookup",
+        choices=['region', 'index'],
+        default='region',
+        help="'region': load all SSCSs of each region, 'index': only fetch SSCSs at the coordinates of complementary "
+             "strands of singletons from the indexed SSCS BAM (I/O and memory scale with singletons), default: region",
+        required=False)
+    parser.add_argument(
+        "--max-region-reads",
+        action="store",
+        dest="max_region_reads",
+        type=int,
+        help="Split regions estimated (from BAM index) to hold more reads than this at positions no read pair spans",
+        required=False)
+    parser.add_argument(
+        "--max-memory",
+        action="store",
+        dest="max_memory",
+        type=int,
+        help="Approximate memory budget (MB) for reads of a region, regions above budget are split",
+        required=False)
+    parser.add_argument(
+        "--max-pending",
+        action="store",
+        dest="max_pending",
+        type=int,
+        help="Maximum number of reads waiting for their mate kept in memory, reads with distant mates (e.g. "
+             "translocations) are spilled to temporary BAM files next to the output, default: no limit",
+        required=False)
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        dest="prefetch",
+        help="Fetch and decode reads of the next region in a background thread while the current region is collapsed",
+        required=False)
+    parser.add_argument(
+        "--uncompressed",
+        action="store_true",
+        dest="uncompressed",
+        help="Write output BAM files uncompressed (intermediates to be sorted)",
+        required=False)
+    parser.add_argument(
+        "--reference",
+        action="store",
+        dest="reference",
+        help="Reference genome (FASTA) to read and write CRAM files",
+        required=False)
+    parser.add_argument(
+        "--discard",
+        action="store",
+        dest="discard",
+        nargs='+',
+        choices=['uncorrected'],
+        default=[],
+        help="Outputs not written (reads are only counted)",
+        required=False)
+    parser.add_argument(
+        "--stats",
+        action="store",
+        dest="stats",
+        help="Stats file to append summary statistics to (default: stats file of SSCS_maker next to the singletons)",
+        required=False)
+    parser.add_argument(
+        "--trace",
+        action="store",
+        dest="trace",
+        help="Trace event file to append stage and region timings to (chrome://tracing / Perfetto format)",
         required=False)
     args = parser.parse_args()
 
@@ -142,37 +308,45 @@ def main():
     #       SETUP        #
     ######################
     start_time = time.time()
+    tracer = Tracer(args.trace, 'singleton_correction')
+    stage_span = tracer.begin('Singleton Correction', children=True)
     # ===== Initialize input and output bam files =====
-    singleton_bam = pysam.AlignmentFile(args.singleton, "rb")
+    singleton_bam = open_alignment(args.singleton, "rb", args.reference)
     # Infer SSCS bam from singleton bamfile (by removing extensions)
-    sscs_bam = pysam.AlignmentFile(
-        '{}.sscs{}'.format(
-            args.singleton.split('.singleton')[0],
-            args.singleton.split('.singleton')[1]),
-        "rb")
-    sscs_correction_bam = pysam.AlignmentFile('{}.sscs.correction.bam'.format(
-        args.singleton.split('.singleton')[0]), 'wb', template=singleton_bam)
-    singleton_correction_bam = pysam.AlignmentFile(
-        '{}.singleton.correction.bam'.format(
-            args.singleton.split('.singleton')[0]),
-        'wb',
-        template=singleton_bam)
-    uncorrected_bam = pysam.AlignmentFile(
-        '{}.uncorrected.bam'.format(
-            args.singleton.split('.singleton')[0]),
-        'wb',
+    sscs_file = '{}.sscs{}'.format(
+        args.singleton.split('.singleton')[0],
+        args.singleton.split('.singleton')[1])
+    sscs_bam = open_alignment(sscs_file, "rb", args.reference)
+    mode = 'wbu' if args.uncompressed else 'wb'
+    # Uncompressed intermediates are always BAM (CRAM is always compressed)
+    suffix = '.bam' if args.uncompressed else alignment_suffix(args.singleton)
+    sscs_correction_bam = open_alignment('{}.sscs.correction{}'.format(
+        args.singleton.split('.singleton')[0], suffix), mode, args.reference, template=singleton_bam)
+    singleton_correction_bam = open_alignment(
+        '{}.singleton.correction{}'.format(
+            args.singleton.split('.singleton')[0], suffix),
+        mode,
+        args.reference,
         template=singleton_bam)
+    if 'uncorrected' in args.discard:
+        uncorrected_bam = NullBam()
+    else:
+        uncorrected_bam = open_alignment(
+            '{}.uncorrected{}'.format(
+                args.singleton.split('.singleton')[0], suffix),
+            mode,
+            args.reference,
+            template=singleton_bam)
 
-    stats = open(
-        '{}.stats.txt'.format(
-            args.singleton.split('.singleton')[0]),
-        'a')
+    if args.stats is None:
+        args.stats = '{}.stats.txt'.format(args.singleton.split('.singleton')[0])
+    stats = open(args.stats, 'a')
 
     # ===== Initialize dictionaries =====
     # dict that remembers order of entries
     singleton_dict = collections.OrderedDict()
     singleton_tag = collections.defaultdict(int)
-    singleton_pair = collections.defaultdict(list)
+    singleton_pair = PairStore(singleton_bam, args.max_pending, os.path.dirname(os.path.abspath(args.singleton)))
     singleton_csn_pair = collections.defaultdict(list)
 
     sscs_dict = collections.OrderedDict()
@@ -196,16 +370,26 @@ def main():
     uncorrected_singleton = 0
 
     counter = 0  # Total singletons
+    max_pending = 0  # Max reads waiting for their mate after a region
 
     #######################
     #   SPLIT BY REGION   #
     #######################
-    if args.bedfile is not None:
-        division_coor = bed_separator(args.bedfile)
-    else:
-        division_coor = [1]
+    division_coor = division_coordinates(args.singleton, args.bedfile, args.region_reads,
+                                         targets=args.targets, regions=args.regions, padding=args.padding,
+                                         max_region_reads=region_budget(args.max_region_reads, args.max_memory),
+                                         reference=args.reference)
 
     last_chr = "chrM"
+    if args.prefetch:
+        prefetched = prefetch_regions(args.singleton, division_coor, reference=args.reference)
+        # SSCSs are only fetched for whole regions with --sscs-lookup region
+        prefetched_sscs = None
+        if args.sscs_lookup != 'index':
+            prefetched_sscs = prefetch_regions(sscs_file, division_coor, reference=args.reference)
+    else:
+        prefetched = None
+        prefetched_sscs = None
     for x in division_coor:
         if division_coor == [1]:
             read_chr = None
@@ -216,18 +400,15 @@ def main():
             read_start = division_coor[x][0]
             read_end = division_coor[x][1]
 
-            # === Reset dictionaries ===
+            # === Reset SSCSs waiting for mates ===
             if last_chr != read_chr:
-                singleton_tag = collections.defaultdict(int)
-                # Its okay to clear SSCS dicts after each region as correction
-                # can only be done within the same coor
-                sscs_dict = collections.OrderedDict()
-                sscs_tag = collections.defaultdict(int)
                 sscs_pair = collections.defaultdict(list)
-                sscs_csn_pair = collections.defaultdict(list)
 
                 last_chr = read_chr
 
+        region_span = tracer.begin(str(x), 'region')
+        region_written = 0
+
         # === Store singleton reads in dictionaries ===
         singleton = read_bam(singleton_bam,
                              pair_dict=singleton_pair,
@@ -238,7 +419,8 @@ def main():
                              duplex=True,
                              read_chr=read_chr,
                              read_start=read_start,
-                             read_end=read_end
+                             read_end=read_end,
+                             reads=None if prefetched is None else next(prefetched)
                              )
 
         singleton_dict = singleton[0]
@@ -251,6 +433,18 @@ def main():
         singleton_multiple_mappings += singleton[6]
 
         # === Store SSCS reads in dictionaries ===
+        if args.sscs_lookup == 'index':
+            # Only SSCSs that can correct singletons of this region
+            sscs_dict = collections.OrderedDict()
+            sscs_tag = collections.defaultdict(int)
+            sscs_pair = collections.defaultdict(list)
+            sscs_csn_pair = collections.defaultdict(list)
+            sscs_reads = complement_reads(sscs_bam, [tag for tags in singleton_csn_pair.values() for tag in tags])
+        elif prefetched_sscs is not None:
+            sscs_reads = next(prefetched_sscs)
+        else:
+            sscs_reads = None
+
         sscs = read_bam(sscs_bam,
                         pair_dict=sscs_pair,
                         read_dict=sscs_dict,  # keeps track of paired tags
@@ -260,7 +454,8 @@ def main():
                         duplex=True,
                         read_chr=read_chr,
                         read_start=read_start,
-                        read_end=read_end
+                        read_end=read_end,
+                        reads=sscs_reads
                         )
 
         sscs_dict = sscs[0]
@@ -282,28 +477,30 @@ def main():
                 # If not, add to 'uncorrected' bamfile
                 duplex = duplex_tag(tag)
                 # Reflect corrected singleton (uncorrected won't have our
-                # unique ID tag)
-                query_name = readPair + ':1'
+                # unique ID tag), singletons are named [consensus tag]:1 by SSCS_maker
+                query_name = singleton_dict[tag][0].query_name
 
                 # 1) Singleton correction by complementary SSCS
-                if duplex in sscs_dict.keys():
+                if duplex in sscs_dict:
                     corrected_read = strand_correction(
                         tag, duplex, query_name, singleton_dict, sscs_dict=sscs_dict)
                     sscs_dup_correction += 1
                     sscs_correction_bam.write(corrected_read)
+                    region_written += 1
 
                     del sscs_dict[duplex]
                     del singleton_dict[tag]
 
                 # 2) Singleton correction by complementary Singletons
-                elif duplex in singleton_dict.keys():
+                elif duplex in singleton_dict:
                     corrected_read = strand_correction(
                         tag, duplex, query_name, singleton_dict)
                     singleton_dup_correction += 1
                     singleton_correction_bam.write(corrected_read)
+                    region_written += 1
                     correction_dict[tag] = duplex
 
-                    if duplex in correction_dict.keys():
+                    if duplex in correction_dict:
                         del singleton_dict[tag]
                         del singleton_dict[duplex]
                         del correction_dict[tag]
@@ -314,16 +511,34 @@ def main():
                 else:
                     uncorrected_bam.write(singleton_dict[tag][0])
                     uncorrected_singleton += 1
+                    region_written += 1
                     del singleton_dict[tag]
 
             del singleton_csn_pair[readPair]
 
+        # === Expire region bookkeeping ===
+        # Complementary strands share read and mate start coordinates, so their read pairs are completed (and tagged)
+        # in the same region. Once a region is processed no partner can appear for its tags, only reads waiting for
+        # their mate are kept (pending) and memory is bounded by region size.
+        singleton_dict.clear()
+        singleton_tag.clear()
+        correction_dict.clear()
+        sscs_dict.clear()
+        sscs_tag.clear()
+        sscs_csn_pair.clear()
+
+        pending = len(singleton_pair) + len(sscs_pair)
+        max_pending = max(max_pending, pending)
+
+        tracer.end(region_span, reads=singleton[4] + sscs[4], written=region_written, pending=pending)
+
     ######################
     #       SUMMARY      #
     ######################
-    sscs_correction_frac = (sscs_dup_correction / singleton_counter) * 100
+    # Chromosome shards (--chrom-pipeline) may hold no singletons
+    sscs_correction_frac = (sscs_dup_correction / singleton_counter) * 100 if singleton_counter else 0
     singleton_correction_frac = (
-        singleton_dup_correction / singleton_counter) * 100
+        singleton_dup_correction / singleton_counter) * 100 if singleton_counter else 0
 
     summary_stats = '''# === Singleton Correction ===
 Total singletons: {}
@@ -335,8 +550,10 @@ Uncorrected Singletons: {} \n'''.format(counter, sscs_dup_correction, sscs_corre
 
     stats.write(summary_stats)
     print(summary_stats)
+    print('Max reads pending mates after a region: {}'.format(max_pending))
 
     # Close files
+    singleton_pair.close()
     singleton_bam.close()
     sscs_bam.close()
     sscs_correction_bam.close()
@@ -344,6 +561,13 @@ Uncorrected Singletons: {} \n'''.format(counter, sscs_dup_correction, sscs_corre
     uncorrected_bam.close()
     stats.close()
 
+    prefix = args.singleton.split('.singleton')[0]
+    tracer.end(stage_span,
+               reads=singleton_counter + sscs_counter,
+               bytes=file_size('{}.sscs.correction{}'.format(prefix, suffix),
+                               '{}.singleton.correction{}'.format(prefix, suffix),
+                               '{}.uncorrected{}'.format(prefix, suffix)))
+
 
 ###############################
 #            Main             #
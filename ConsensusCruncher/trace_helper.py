@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Trace Helper
+#
+###############################################################
+# Function:
+# Record begin/end events for pipeline stages, genomic regions, sorting, indexing and merging in the Trace Event
+# format understood by chrome://tracing and Perfetto.
+#
+# Every process of a sample appends its events to the same trace file (one JSON event per line, written with a single
+# append so concurrent stages do not interleave partial lines). The consensus driver opens the file before the first
+# stage and converts it into a complete JSON document once the last stage has finished.
+#
+# Event arguments:
+#   - wall_s: wall clock time of the span (seconds)
+#   - cpu_s: CPU time of the span (seconds), including child processes for external tools (e.g. samtools) that were
+#            waited for with wait_child within the span. Child CPU time is taken from the resource usage of each child,
+#            so spans of threads running children concurrently (stage graph, shard jobs) only count their own children.
+#   - reads: number of reads processed within the span (if known)
+#   - bytes: number of bytes written within the span (if known)
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import os
+import json
+import time
+import threading
+import subprocess
+from contextlib import contextmanager
+
+
+###############################
+#          Functions          #
+###############################
+def cpu_time(children=False):
+    """(bool) -> float
+    Return CPU time (user + system) used by this process (and all its terminated child processes if children is True).
+    """
+    t = os.times()
+    if children:
+        return t.user + t.system + t.children_user + t.children_system
+    return t.user + t.system
+
+
+def wait_child(process, span=None):
+    """(subprocess.Popen, dict) -> int
+    Wait for child process and return its exit status. CPU time (user + system) used by the child and the descendants
+    it waited for is added to 'child_cpu_s' of span (see Tracer.span), which is counted in the CPU time of the span.
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if span is not None:
+        span['child_cpu_s'] = span.get('child_cpu_s', 0) + usage.ru_utime + usage.ru_stime
+    return process.returncode
+
+
+def run_child(cmd, span=None, **kwargs):
+    """(list, dict) -> int
+    Run command (string if shell=True is given) like subprocess.call and return its exit status, adding its CPU time
+    to span (see wait_child).
+    """
+    return wait_child(subprocess.Popen(cmd, **kwargs), span)
+
+
+def file_size(*paths):
+    """(str) -> int
+    Return combined size (bytes) of files that exist.
+    """
+    return sum(os.path.getsize(path) for path in paths if path is not None and os.path.exists(path))
+
+
+def start_trace(trace_file):
+    """(str) -> None
+    Create an empty trace file that stages can append events to.
+    """
+    with open(trace_file, 'w') as f:
+        f.write('[\n')
+
+
+def finish_trace(trace_file):
+    """(str) -> list
+    Convert appended trace events into a complete JSON trace document and return the events.
+    """
+    events = []
+    with open(trace_file) as f:
+        for line in f:
+            line = line.strip().rstrip(',')
+            if line in ('', '[', ']'):
+                continue
+            events.append(json.loads(line))
+
+    # Sort by timestamp as stages running in parallel append out of order
+    events.sort(key=lambda event: event['ts'])
+
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    return events
+
+
+class Tracer:
+    """Append Trace Event format begin/end events for a single process to a shared trace file.
+
+    If no trace file is given, spans are still timed but nothing is written, so callers do not need to check whether
+    tracing is enabled.
+    """
+
+    def __init__(self, trace_file=None, process_name=None):
+        self.trace_file = trace_file
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+        if self.trace_file is not None and process_name is not None:
+            self._write({'name': 'process_name',
+                         'ph': 'M',
+                         'pid': self.pid,
+                         'tid': threading.get_ident(),
+                         'ts': time.time() * 1e6,
+                         'args': {'name': process_name}})
+
+    def _write(self, event):
+        """Append event as a single line so concurrent writers never interleave."""
+        line = (json.dumps(event) + ',\n').encode()
+        with self.lock:
+            fd = os.open(self.trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def event(self, name, cat, ph, args=None):
+        """Write a single event (ph: 'B' = begin, 'E' = end, 'i' = instant)."""
+        if self.trace_file is None:
+            return
+
+        event = {'name': name,
+                 'cat': cat,
+                 'ph': ph,
+                 'pid': self.pid,
+                 'tid': threading.get_ident(),
+                 'ts': time.time() * 1e6}
+        if args:
+            event['args'] = args
+        if ph == 'i':
+            event['s'] = 'p'
+
+        self._write(event)
+
+    def begin(self, name, cat='stage', children=False):
+        """Emit begin event and return span handle to be passed to end().
+
+        With children, the CPU time of all child processes terminated within the span is counted (only for spans
+        enclosing all other work of the process, e.g. a whole sample).
+        """
+        self.event(name, cat, 'B')
+        return name, cat, time.time(), cpu_time(children), children
+
+    def end(self, span, **args):
+        """Emit end event for span with wall/CPU time and any counters given (e.g. reads, bytes)."""
+        name, cat, wall_start, cpu_start, children = span
+        child_cpu = args.pop('child_cpu_s', 0)
+        args['wall_s'] = round(time.time() - wall_start, 6)
+        args['cpu_s'] = round(cpu_time(children) - cpu_start + child_cpu, 6)
+        self.event(name, cat, 'E', args)
+
+    @contextmanager
+    def span(self, name, cat='stage', **args):
+        """Time a block of work and emit begin/end events.
+
+        Yields a dict that callers can update with 'reads' and 'bytes' (or any other counters) before the span ends,
+        and pass to wait_child/run_child to count the CPU time of child processes.
+        """
+        span = self.begin(name, cat)
+        try:
+            yield args
+        finally:
+            self.end(span, **args)